@@ -0,0 +1,556 @@
+"""
+ ------------- benchmark.py  ------------
+ Load test and benchmark for gc_dz.py.  Starts a throwaway PostgreSQL server in a
+ temporary directory, creates the gcdz, f500 and sctn schemas (followed by
+ schema_updates.sql) filled with synthetic data at a chosen scale, and calls
+ application() directly with WSGI environ dictionaries for the main pages and Ajax
+ actions, as mod_wsgi would.  For each page or action it reports latency
+ percentiles, Python CPU time, SQL statements and connections per request (from
+ dbtrace.py), the response size and the peak Python memory allocated (tracemalloc):
+
+     python3 benchmark.py [--companies N] [--years N] [--indicators N] [--platforms N]
+                          [--listed N] [--requests N] [--only NAME] [--accept-encoding CODINGS]
+                          [--cells] [--json FILE] [--baseline FILE] [--keep]
+
+ --listed adds companies with a file for the latest year but no assessment data,
+ to time long listings cheaply, eg for a 20,000 row F500 listing:
+
+     python3 benchmark.py --listed 20000 --only "f500 list"
+
+ --accept-encoding sends an Accept-Encoding header (eg gzip) with each request, so
+ the sizes reported are those of the compressed responses (see httpzip.py), and
+ the times include compressing them.
+
+ Tests named '304' request a page again with the ETag it was sent with, as a
+ browser does when the page is shown again, and time the '304 Not Modified' reply.
+ Tests named 'scores' call scoring.py directly, in a transaction of their own:
+ recomputing the scores a changed score cell counts towards, against rebuilding
+ the scores of the file and of all the files.  Tests named 'form' read all the
+ values of a file, and write one, in the cell rows of f500.xldata and in the
+ file's document in f500.xldocs (see xldocs.py).  The pages read the documents
+ unless --cells is given, so runs with and without it compare the two layouts.
+
+ The PostgreSQL server programs (initdb, pg_ctl) must be on the PATH, or in the
+ directory given by environment variable PG_BIN.  The application connects to the
+ fixture through GCDZ_DSN (see dbauth.py), so the trasepad database is never used.
+ Data is generated from a fixed random seed, so runs at the same scale can be
+ compared: save a run with --json, and give that file as --baseline after a change
+ to show the difference in median times.
+"""
+import os, sys, io, json, time, math, random, shutil, argparse, tempfile, subprocess, tracemalloc, logging
+from urllib.parse import urlencode
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# local modules
+import scoring
+import xldocs
+
+# default scale of the synthetic data, and requests timed for each page or action
+default_scale = {'companies': 100, 'years': 3, 'indicators': 40, 'platforms': 100, 'listed': 0}
+default_requests = 20
+
+# tables read by gc_dz.py that are not created by schema_updates.sql, with the indexes the live
+# database has on them.  f500.xldata derives the column and row from the cell reference, as the
+# input form only writes xlcell
+base_schema = """
+CREATE SCHEMA gcdz;
+CREATE SCHEMA f500;
+CREATE SCHEMA sctn;
+
+CREATE TABLE gcdz.users (userid INTEGER PRIMARY KEY, username TEXT, email TEXT, permit INTEGER);
+CREATE TABLE gcdz.logins (userid INTEGER, sessionid TEXT, timeon TIMESTAMP, ipaddr TEXT, timeout TIMESTAMP);
+CREATE INDEX logins_sessionid_idx ON gcdz.logins (sessionid);
+CREATE TABLE gcdz.menus (id SERIAL PRIMARY KEY, menutext TEXT, module TEXT, permitflag INTEGER, prtorder INTEGER);
+CREATE TABLE gcdz.stats (sessionid TEXT, module TEXT, timein TIMESTAMP);
+CREATE TABLE gcdz.def_data (sessionid TEXT, ddtag TEXT, ddinfo JSONB,
+    CONSTRAINT defdata_pk PRIMARY KEY (sessionid, ddtag));
+
+CREATE TABLE f500.dirtree (dtid INTEGER PRIMARY KEY, cotype TEXT, ayear INTEGER);
+CREATE TABLE f500.filelist (flid INTEGER PRIMARY KEY, dtid INTEGER, flname TEXT, fltime TIMESTAMP);
+CREATE TABLE f500.xlcohdr (flid INTEGER PRIMARY KEY, coname TEXT);
+CREATE VIEW f500.company_file AS SELECT d.cotype, d.ayear, x.coname, x.flid FROM f500.xlcohdr AS x
+    INNER JOIN f500.filelist AS f USING (flid) INNER JOIN f500.dirtree AS d USING (dtid);
+CREATE TABLE f500.coflids (flid INTEGER PRIMARY KEY, ucid INTEGER, main BOOLEAN);
+CREATE TABLE f500.commodities (cid INTEGER PRIMARY KEY, commodity TEXT);
+CREATE TABLE f500.comtraders (flid INTEGER, cid INTEGER, PRIMARY KEY (flid, cid));
+CREATE TABLE f500.commodity_scores (flid INTEGER, cid INTEGER, score REAL, assd BOOLEAN, PRIMARY KEY (flid, cid));
+CREATE TABLE f500.survey_status_texts (statid INTEGER PRIMARY KEY, status TEXT);
+CREATE TABLE f500.survey_status (flid INTEGER PRIMARY KEY, statid INTEGER, sessionid TEXT, lastupd TIMESTAMP);
+CREATE TABLE f500.ind_groups (igid INTEGER PRIMARY KEY, heading TEXT, ayear INTEGER, cotype TEXT, indgrp INTEGER);
+CREATE TABLE f500.ind_main (inid INTEGER PRIMARY KEY, indgrp INTEGER, indnum INTEGER, indtext TEXT, guide TEXT,
+    scoring TEXT, maxpts REAL, cotype TEXT, ayear INTEGER);
+CREATE TABLE f500.ind_detail (detid INTEGER PRIMARY KEY, inid INTEGER, sid INTEGER, cid INTEGER, atype INTEGER,
+    xlrow INTEGER);
+CREATE INDEX ind_detail_inid_idx ON f500.ind_detail (inid);
+CREATE TABLE f500.assmnt_parts (atype INTEGER, ptid INTEGER, ptlabel TEXT, ptype TEXT, alist TEXT[], layout TEXT,
+    xlcol TEXT, PRIMARY KEY (atype, ptid));
+CREATE TABLE f500.xldata (xlid SERIAL PRIMARY KEY, flid INTEGER, xlcell TEXT, xltext TEXT,
+    xlcol TEXT GENERATED ALWAYS AS (substring(xlcell from '^[A-Z]+')) STORED,
+    xlrow INTEGER GENERATED ALWAYS AS (substring(xlcell from '[0-9]+$')::INTEGER) STORED);
+CREATE INDEX xldata_flid_cell_idx ON f500.xldata (flid, xlcell);
+CREATE INDEX xldata_flid_row_idx ON f500.xldata (flid, xlrow, xlcol);
+CREATE TABLE f500.xldata_audit (xlid INTEGER, sid TEXT, ts TIMESTAMP, oldval TEXT, newval TEXT);
+CREATE TABLE f500.cscore_cells (cid INTEGER, cass TEXT, ayear INTEGER);
+CREATE TABLE f500.documents (docid SERIAL PRIMARY KEY, flid INTEGER, inid INTEGER, sid INTEGER, cid INTEGER,
+    cell TEXT, url TEXT, sessid TEXT, ts TIMESTAMP);
+
+CREATE TABLE sctn.organs (orgid INTEGER PRIMARY KEY, orgnm TEXT, orgurl TEXT);
+CREATE TABLE sctn.platforms (platid INTEGER PRIMARY KEY, platname TEXT, platurl TEXT, orgid INTEGER);
+CREATE TABLE sctn.sheets (sheetid INTEGER PRIMARY KEY, platid INTEGER);
+CREATE TABLE sctn.questions (qid INTEGER PRIMARY KEY, question TEXT, drow INTEGER, nrow INTEGER);
+CREATE TABLE sctn.xldata (sheetid INTEGER, xlrow INTEGER, xlcol TEXT, xlcell TEXT);
+CREATE INDEX sctn_xldata_idx ON sctn.xldata (sheetid, xlrow, xlcol);
+CREATE TABLE sctn.features (fid INTEGER PRIMARY KEY, question TEXT, tablehdr TEXT);
+CREATE TABLE sctn.flevels (fid INTEGER, lvl INTEGER, ftext TEXT, flag INTEGER);
+CREATE TABLE sctn.platform_flags (platid INTEGER, fid INTEGER, bit_or INTEGER);
+CREATE TABLE sctn.flag_check (fid INTEGER, flags INTEGER);
+"""
+
+# menu entries: module, menu text, print order
+menus = [('cmatch', 'Company lists and name matching', 1), ('f500', 'Forest 500 company lists', 2),
+    ('f500a', 'Forest 500 assessments', 0), ('f500b', 'Forest 500 data input', 0), ('doc', 'Cached document', 0),
+    ('xlx', 'Forest 500 workbook export', 0),
+    ('sctn', 'SCTN survey system', 3), ('sctndd', 'SCTN data tool', 4)]
+
+commodities = ['Palm oil', 'Soy', 'Cattle products', 'Leather', 'Timber', 'Pulp and paper']
+
+# assessment parts for the single assessment type: ptid, label, type, options, layout, column.  Type 'S'
+# is the score shown on the assessment page
+assmnt_parts = [(1, 'Assessment', 'A', ['Yes', 'Partly', 'No'], '', 'E'),
+    (2, 'Score', 'B', ['1', '0.5', '0'], '', 'F'), (3, 'Notes', 'F', None, '+', 'G'),
+    (4, 'Source', 'G', None, '', 'H'), (5, 'Total', 'S', None, '', 'I')]
+
+words = """forest company policy supply chain deforestation commitment palm soy cattle timber paper sourcing
+    traceability report annual sustainability certified suppliers monitoring zero conversion regions
+    risk public target progress disclosure volume mills plantations smallholders grievance""".split()
+
+# remote address and session ID used by the benchmark user
+remote_addr = '127.0.0.1'
+bench_sid = 'BenchSession0001'
+
+# Accept-Encoding header sent with each request (--accept-encoding), none if empty
+accept_encoding = ''
+
+def find_program(name):
+    # path of a PostgreSQL server program, from PG_BIN or the PATH
+    pg_bin = os.environ.get('PG_BIN', '')
+    path = os.path.join(pg_bin, name) if pg_bin > '' else shutil.which(name)
+    if path is None or not os.path.exists(path):
+        raise RuntimeError("PostgreSQL program '%s' not found - put it on the PATH or set PG_BIN" % name)
+    return path
+
+def start_server(datadir):
+    # creates and starts a PostgreSQL server in 'datadir', listening only on a unix socket there.
+    # Durability is switched off, as the data is thrown away.  Returns the connection string
+    subprocess.run([find_program('initdb'), '-D', datadir, '-U', 'bench', '-A', 'trust', '-E', 'UTF8',
+        '--no-sync'], check=True, stdout=subprocess.DEVNULL)
+    options = "-k %s -c listen_addresses='' -c fsync=off -c synchronous_commit=off -c full_page_writes=off" % datadir
+    subprocess.run([find_program('pg_ctl'), '-D', datadir, '-o', options, '-l', os.path.join(datadir, 'server.log'),
+        '-w', 'start'], check=True, stdout=subprocess.DEVNULL)
+    return 'host=%s dbname=postgres user=bench' % datadir
+
+def stop_server(datadir):
+    # stops the server started by start_server
+    subprocess.run([find_program('pg_ctl'), '-D', datadir, '-m', 'fast', '-w', 'stop'], stdout=subprocess.DEVNULL)
+
+def some_text(rnd, nwords, lines=1):
+    # random text of about 'nwords' words in 'lines' lines
+    return '\n'.join(' '.join(rnd.choice(words) for w in range(nwords // lines)).capitalize() + '.'
+        for n in range(lines))
+
+def some_url(rnd):
+    # a random link to a (non-existent) report
+    return 'https://www.example-%s.com/reports/%s-%s.pdf' % (rnd.choice(words), rnd.choice(words), rnd.randint(1, 999))
+
+def create_schema(qry):
+    # creates the base tables, then applies schema_updates.sql
+    qry.execute(base_schema)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_updates.sql')) as fh:
+        qry.execute(fh.read())
+
+def load_data(qry, scale, rnd):
+    # fills the tables with synthetic data at 'scale' (see default_scale).  Returns a dictionary of
+    # the IDs used by the benchmark requests: files by year and type, indicators, platforms
+    insert = psycopg2.extras.execute_values
+    years = list(range(2020 - scale['years'], 2020))
+    # users, menus and the benchmark session
+    qry.execute("INSERT INTO gcdz.users VALUES (0, 'guest', '', 0), (1, 'bench', 'bench@example.com', 1279)")
+    insert(qry, "INSERT INTO gcdz.menus (module, menutext, prtorder, permitflag) VALUES %s",
+        [m + (1,) for m in menus])
+    qry.execute("INSERT INTO gcdz.logins VALUES (1, %s, NOW(), %s, NULL)", (bench_sid, remote_addr))
+    # commodities, assessment parts and form status texts
+    insert(qry, "INSERT INTO f500.commodities VALUES %s", list(enumerate(commodities, 1)))
+    insert(qry, "INSERT INTO f500.assmnt_parts VALUES %s", [(1,) + p for p in assmnt_parts])
+    insert(qry, "INSERT INTO f500.survey_status_texts VALUES %s",
+        [(0, 'Not started'), (1, 'Viewed'), (2, 'Edited'), (3, 'Complete')])
+    # indicators for each year and company type, in 4 groups.  Group 2 of the company assessment is
+    # commodity-specific, with a detail row (and so a row in the assessment sheet) for each commodity
+    (ind_rows, group_rows, detail_rows) = ([], [], [])
+    details = {}
+    per_group = max(1, scale['indicators'] // 4)
+    for (y, ayear) in enumerate(range(2014, 2020)):
+        if ayear not in years:
+            continue
+        for (t, cotype) in enumerate(('CO', 'FI')):
+            xlrow = 10
+            details[(ayear, cotype)] = []
+            for grp in range(1, 5):
+                igid = (y + 1) * 100 + (t + 1) * 10 + grp
+                group_rows.append((igid, 'Indicator group %s: %s' % (grp, some_text(rnd, 4)), ayear, cotype, grp))
+                for num in range(1, per_group + 1):
+                    inid = igid * 100 + num
+                    ind_rows.append((inid, grp, num, some_text(rnd, 40, 2), some_text(rnd, 60, 3),
+                        some_text(rnd, 30, 2), 2, cotype, ayear))
+                    for cid in (range(1, len(commodities) + 1) if cotype == 'CO' and grp == 2 else [None]):
+                        detail = (len(detail_rows) + 1, inid, None, cid, 1, xlrow)
+                        detail_rows.append(detail)
+                        details[(ayear, cotype)].append(detail)
+                        xlrow += 1
+    insert(qry, "INSERT INTO f500.ind_groups VALUES %s", group_rows)
+    insert(qry, "INSERT INTO f500.ind_main VALUES %s", ind_rows)
+    insert(qry, "INSERT INTO f500.ind_detail VALUES %s", detail_rows)
+    # cells holding 'Y' for each commodity assessed in a company's sheet
+    insert(qry, "INSERT INTO f500.cscore_cells VALUES %s",
+        [(cid, 'B%s' % (cid + 2), ayear) for cid in range(1, len(commodities) + 1) for ayear in years])
+    # companies (one in five a financial institution) with a file for each year
+    dtids = {}
+    for ayear in years:
+        for cotype in ('CO', 'FI'):
+            dtids[(ayear, cotype)] = len(dtids) + 1
+    insert(qry, "INSERT INTO f500.dirtree VALUES %s", [(dtid, cotype, ayear) for ((ayear, cotype), dtid) in dtids.items()])
+    flids = {key: [] for key in dtids}
+    nextflid = 1
+    for ucid in range(1, scale['companies'] + 1):
+        cotype = 'FI' if ucid % 5 == 0 else 'CO'
+        coname = '%s %s %s' % (rnd.choice(words).capitalize(), rnd.choice(words).capitalize(),
+            rnd.choice(['Group', 'Holdings', 'Ltd', 'SA', 'Inc', 'Bank', 'Capital']))
+        traded = rnd.sample(range(1, len(commodities) + 1), rnd.randint(1, 4))
+        (files, names, links, traders, status, cells, docs) = ([], [], [], [], [], [], [])
+        for ayear in years:
+            flid = nextflid
+            nextflid += 1
+            flids[(ayear, cotype)].append(flid)
+            files.append((flid, dtids[(ayear, cotype)], 'F500_%s_%s.xlsx' % (ayear, coname.replace(' ', '_')),
+                '%s-03-01' % ayear))
+            names.append((flid, coname))
+            links.append((flid, ucid, ayear == years[-1]))
+            status.append((flid, rnd.randint(0, 3), None, None))
+            if cotype == 'CO':
+                for cid in range(1, len(commodities) + 1):
+                    cells.append((flid, 'B%s' % (cid + 2), 'Y' if cid in traded else 'N'))
+                for cid in traded:
+                    traders.append((flid, cid))
+            # assessment sheet: a value for each part of each indicator
+            for (detid, inid, sid, cid, atype, xlrow) in details[(ayear, cotype)]:
+                score = rnd.choice(['1', '0.5', '0'])
+                cells.append((flid, 'E%s' % xlrow, {'1': 'Yes', '0.5': 'Partly', '0': 'No'}[score]))
+                cells.append((flid, 'F%s' % xlrow, score))
+                cells.append((flid, 'G%s' % xlrow, some_text(rnd, 25, rnd.randint(1, 3))))
+                url = some_url(rnd)
+                cells.append((flid, 'H%s' % xlrow, url))
+                cells.append((flid, 'I%s' % xlrow, score))
+                docs.append((flid, inid, inid, cid, 'H%s' % xlrow, url, bench_sid))
+        insert(qry, "INSERT INTO f500.filelist VALUES %s", files)
+        insert(qry, "INSERT INTO f500.xlcohdr VALUES %s", names)
+        insert(qry, "INSERT INTO f500.coflids VALUES %s", links)
+        insert(qry, "INSERT INTO f500.survey_status VALUES %s", status)
+        if len(traders) > 0:
+            insert(qry, "INSERT INTO f500.comtraders VALUES %s", traders)
+        insert(qry, "INSERT INTO f500.xldata (flid, xlcell, xltext) VALUES %s", cells, page_size=1000)
+        insert(qry, """INSERT INTO f500.documents (flid, inid, sid, cid, cell, url, sessid, ts)
+            VALUES %s""", docs, template="(%s, %s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+    # companies listed for the latest year only, without assessment data
+    listed = [(flid, 'Listed %s %s Ltd' % (rnd.choice(words).capitalize(), flid))
+        for flid in range(nextflid, nextflid + scale['listed'])]
+    if len(listed) > 0:
+        insert(qry, "INSERT INTO f500.filelist VALUES %s", [(flid, dtids[(years[-1], 'CO')],
+            'F500_%s_%s.xlsx' % (years[-1], flid), '%s-03-01' % years[-1]) for (flid, coname) in listed],
+            page_size=1000)
+        insert(qry, "INSERT INTO f500.xlcohdr VALUES %s", listed, page_size=1000)
+        insert(qry, "INSERT INTO f500.coflids VALUES %s",
+            [(flid, scale['companies'] + n, True) for (n, (flid, coname)) in enumerate(listed, 1)], page_size=1000)
+        insert(qry, "INSERT INTO f500.survey_status VALUES %s",
+            [(flid, 0, None, None) for (flid, coname) in listed], page_size=1000)
+    # SCTN platforms, most with a survey sheet, and the questions and features of the survey
+    norgs = max(1, scale['platforms'] // 3)
+    insert(qry, "INSERT INTO sctn.organs VALUES %s",
+        [(orgid, 'Organisation %s %s' % (orgid, rnd.choice(words)), some_url(rnd)) for orgid in range(1, norgs + 1)])
+    platids = list(range(1, scale['platforms'] + 1))
+    insert(qry, "INSERT INTO sctn.platforms VALUES %s", [(platid, '%s %s platform' % (rnd.choice(words).capitalize(),
+        rnd.choice(words)), some_url(rnd), rnd.randint(1, norgs)) for platid in platids])
+    sheets = [(platid, platid) for platid in platids if platid % 5 != 0]
+    insert(qry, "INSERT INTO sctn.sheets VALUES %s", sheets)
+    questions = [(qid, some_text(rnd, 10) + '?', 5 + qid * 4, 1 if qid <= 14 else 3) for qid in range(1, 21)]
+    insert(qry, "INSERT INTO sctn.questions VALUES %s", questions)
+    answers = []
+    for (sheetid, platid) in sheets:
+        for (qid, question, drow, nrow) in questions:
+            for xlrow in range(drow, drow + nrow):
+                for xlcol in (['C', 'D'] if qid <= 14 else ['D']):
+                    answers.append((sheetid, xlrow, xlcol, some_text(rnd, 8)))
+    insert(qry, "INSERT INTO sctn.xldata VALUES %s", answers, page_size=1000)
+    insert(qry, "INSERT INTO sctn.features VALUES %s",
+        [(fid, some_text(rnd, 8) + '?', rnd.choice(words).capitalize()) for fid in range(1, 9)])
+    insert(qry, "INSERT INTO sctn.flevels VALUES %s",
+        [(fid, lvl, some_text(rnd, 3), 1 << (lvl - 1)) for fid in range(1, 9) for lvl in range(1, 5)])
+    insert(qry, "INSERT INTO sctn.platform_flags VALUES %s",
+        [(platid, fid, rnd.randint(1, 15)) for platid in platids for fid in range(1, 9)])
+    # indicator, commodity and total scores from the assessment sheets
+    scoring.rebuild(qry)
+    qry.execute("ANALYZE")
+    qry.execute("SELECT count(*) FROM f500.xldata")
+    cells = qry.fetchone()[0]
+    # only platforms with a sheet are linked to the survey form from the platform list
+    return {'years': years, 'flids': flids, 'details': details, 'platids': [platid for (sheetid, platid) in sheets],
+        'cells': cells}
+
+def make_environ(query, post=None, ajax=False):
+    # WSGI environ for a request to the application: GET with 'query' (a dictionary), or POST if
+    # 'post' (a dictionary) is given.  'ajax' marks it as a jquery Ajax call
+    body = urlencode(post, doseq=True).encode() if post is not None else b''
+    environ = {'REQUEST_METHOD': 'POST' if post is not None else 'GET', 'REQUEST_SCHEME': 'https',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '443', 'SCRIPT_NAME': '/exec', 'SCRIPT_FILENAME': 'gc_dz.py',
+        'REMOTE_ADDR': remote_addr, 'QUERY_STRING': urlencode(query), 'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'wsgi.input': io.BytesIO(body),
+        'wsgi.url_scheme': 'https', 'wsgi.errors': sys.stderr}
+    environ['REQUEST_URI'] = '/exec?' + environ['QUERY_STRING']
+    if ajax:
+        environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    if accept_encoding > '':
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    return environ
+
+def scenarios(fix, rnd):
+    # the pages and Ajax actions timed, as a list of (name, function returning an environ).  Each
+    # request picks a company, indicator or platform at random
+    last = fix['years'][-1]
+    def page(mdl, post=None, sid=bench_sid):
+        return lambda: make_environ({'m': mdl, 'u': sid}, post() if post is not None else None)
+    def ajax(post):
+        return lambda: make_environ({}, post(), ajax=True)
+    def task(fn):
+        # a function called with a cursor of the application and committed, timed as a request (see run_request)
+        return lambda: fn
+    def revalidate(make):
+        # the same request again with the ETag of the page sent for it (If-None-Match), as when a browser
+        # shows a page it has kept (see httpcache.py).  The first request is not timed
+        def make_again():
+            environ = make()
+            body = environ['wsgi.input'].getvalue()
+            headers = {}
+            def start_response(status, response_headers):
+                headers.update(response_headers)
+            for chunk in sys.modules['gc_dz'].application(environ, start_response):
+                pass
+            environ = dict(environ, HTTP_IF_NONE_MATCH=headers.get('ETag', ''))
+            environ['wsgi.input'] = io.BytesIO(body)
+            return environ
+        return make_again
+    def detail(cotype='CO', ayear=last):
+        # a company file, and a random indicator detail row of its year and type
+        flid = rnd.choice(fix['flids'][(ayear, cotype)])
+        return (flid, rnd.choice(fix['details'][(ayear, cotype)]))
+    def f500_list(listopt):
+        return lambda: {'Update': 'Update', 'ayear': str(last), 'cotype': 'CO', 'filter': '', 'listopt': str(listopt)}
+    def select():
+        (flid, (detid, inid, sid, cid, atype, xlrow)) = detail()
+        score = rnd.choice(['1', '0.5', '0'])
+        return {'action': 'f500b.select', 'sessid': bench_sid, 'flid': flid, 'cell': 'E%s' % xlrow,
+            'cell_s': 'F%s' % xlrow, 'optval': score, 'opttxt': {'1': 'Yes', '0.5': 'Partly', '0': 'No'}[score]}
+    def rescore(qry):
+        # a new score in a random score cell, and the scores it counts towards
+        (flid, (detid, inid, sid, cid, atype, xlrow)) = detail()
+        qry.execute("UPDATE f500.xldata SET xltext=%s WHERE flid=%s AND xlcell=%s",
+            (rnd.choice(['1', '0.5', '0']), flid, 'F%s' % xlrow))
+        scoring.rescore_cells(qry, flid, ['F%s' % xlrow])
+    def form_read(layout):
+        # all the values of a random company file
+        def read(qry):
+            flid = detail()[0]
+            if layout == 'doc':
+                return xldocs.load(qry, flid)
+            qry.execute("SELECT xlcell, xltext FROM f500.xldata WHERE flid=%s ORDER BY xlid", (flid,))
+            return {xlcell: xltext for (xlcell, xltext) in qry.fetchall()}
+        return read
+    def form_write(layout):
+        # a new value in a random assessment cell: in the cell rows, kept in the document by the triggers
+        # on xldata as the input form does ('both'); in the cell rows only, with the triggers off; or in the
+        # document only, as a single-key update
+        def write(qry):
+            (flid, (detid, inid, sid, cid, atype, xlrow)) = detail()
+            (cell, text) = ('G%s' % xlrow, some_text(rnd, 25))
+            if layout == 'doc':
+                qry.execute("UPDATE f500.xldocs SET cells = jsonb_set(cells, ARRAY[%s], to_jsonb(%s::TEXT)) WHERE flid=%s",
+                    (cell, text, flid))
+                return
+            if layout == 'cells':
+                qry.execute("SET LOCAL session_replication_role = replica")
+            qry.execute("UPDATE f500.xldata SET xltext=%s WHERE flid=%s AND xlcell=%s", (text, flid, cell))
+        return write
+    def table_c():
+        (flid, (detid, inid, sid, cid, atype, xlrow)) = detail()
+        return {'action': 'f500b.tableC', 'inid': inid, 'flid': flid, 'cid': cid or 0, 'refid': inid}
+    def sql_query(sql, rec_from):
+        # a page of 10 rows of the result of 'sql' in the SQL query tool
+        return {'action': 'sql.query', 'sessid': bench_sid, 'query': sql, 'rec_from': rec_from, 'rec_by': 10}
+    cell_query = 'SELECT * FROM f500.xldata ORDER BY xltext, flid, xlcell'
+    def ind_notes():
+        (flid, (detid, inid, sid, cid, atype, xlrow)) = detail('CO', fix['years'][0])
+        return {'action': 'f500a.indNotes', 'inid': inid, 'cid': cid or 0, 'sid': 0, 'flid': flid, 'imgid': 1,
+            'sessid': bench_sid}
+    tests = [('menu', page('menu'))]
+    tests += [('f500 list %s' % n, page('f500', f500_list(n))) for n in range(1, 6)]
+    tests += [
+        ('f500a assessment', page('f500a', lambda: {'FileID': detail('CO', fix['years'][0])[0]})),
+        ('f500a assessment FI', page('f500a', lambda: {'FileID': detail('FI', fix['years'][0])[0]})),
+        ('f500a assessment 304', revalidate(page('f500a', lambda: {'FileID': detail('CO', fix['years'][0])[0]}))),
+        ('f500 list 1 304', revalidate(page('f500', f500_list(1)))),
+        ('f500b input form', page('f500b', lambda: {'FileID': detail()[0]})),
+        ('sctn list', page('sctn')),
+        ('sctn platform', page('sctn', lambda: {'platid': rnd.choice(fix['platids'])})),
+        ('sctndd data tool', page('sctndd', sid='auto_login__sctn')),
+        ('sctndd filtered', page('sctndd', lambda: {'Q1': ['1', '2'], 'Q3': ['4'], 'C2': '1'}, sid='auto_login__sctn')),
+        ('ajax f500.colist', ajax(lambda: {'action': 'f500.colist', 'cofind': rnd.choice(words)[:3],
+            'ayear': str(last), 'cotype': 'CO', 'sid': bench_sid})),
+        ('ajax f500a.indNotes', ajax(ind_notes)),
+        ('ajax f500b.tableC', ajax(table_c)),
+        ('ajax f500b.select', ajax(select)),
+        ('scores incremental', task(rescore)),
+        ('scores rebuild file', task(lambda qry: scoring.rebuild(qry, [detail()[0]]))),
+        ('scores full rebuild', task(scoring.rebuild)),
+        ('form read cells', task(form_read('cells'))),
+        ('form read doc', task(form_read('doc'))),
+        ('form write cells', task(form_write('cells'))),
+        ('form write doc', task(form_write('doc'))),
+        ('form write both', task(form_write('both'))),
+        ('ajax sql.query page', ajax(lambda: sql_query(cell_query, rnd.randint(1, fix['cells'])))),
+        ('ajax sql.query new', ajax(lambda: sql_query(cell_query + ' LIMIT %s' % rnd.randint(1, fix['cells']), 1)))]
+    return tests
+
+def run_request(gc_dz, environ):
+    # calls the application once.  Returns (seconds, CPU seconds in this process, status, response size,
+    # dbtrace summary)
+    response = {}
+    def start_response(status, headers):
+        response['status'] = status
+    (t0, cpu0) = (time.perf_counter(), time.process_time())
+    if callable(environ):
+        # a task (see scenarios), given a transaction of its own
+        gc_dz.dbtrace.request_start('task')
+        qry = gc_dz.getCursor()
+        qry.connection.autocommit = False
+        environ(qry)
+        qry.connection.commit()
+        qry.connection.close()
+        (response['status'], size) = ('200 OK', 0)
+        gc_dz.dbtrace.request_end(response['status'])
+    else:
+        size = sum(len(chunk) for chunk in gc_dz.application(environ, start_response))
+    (secs, cpu) = (time.perf_counter() - t0, time.process_time() - cpu0)
+    return (secs, cpu, response['status'], size, gc_dz.dbtrace.last_summary())
+
+def percentile(values, pct):
+    # nearest-rank percentile of a list of numbers
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(math.ceil(pct / 100.0 * len(ordered))) - 1))]
+
+def run_scenario(gc_dz, make, nreq):
+    # times 'nreq' requests (after one to warm up), then measures peak memory over a few more with
+    # tracemalloc, which slows Python down too much to run while timing.  Returns a dictionary of results
+    run_request(gc_dz, make())
+    (times, cpus, queries, conns, dbsecs, sizes, errors) = ([], [], [], [], [], [], 0)
+    for n in range(nreq):
+        (secs, cpu, status, size, summary) = run_request(gc_dz, make())
+        times.append(secs)
+        cpus.append(cpu)
+        sizes.append(size)
+        queries.append(summary['queries'])
+        conns.append(summary['connections'])
+        dbsecs.append(summary['db'])
+        if summary['error'] or status[:3] not in ('200', '304'):
+            errors += 1
+    tracemalloc.start()
+    for n in range(min(nreq, 3)):
+        run_request(gc_dz, make())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'requests': nreq, 'p50': percentile(times, 50), 'p90': percentile(times, 90),
+        'p99': percentile(times, 99), 'max': max(times), 'mean': sum(times) / nreq, 'cpu': sum(cpus) / nreq,
+        'queries': sum(queries) / nreq, 'connections': sum(conns) / nreq, 'db': sum(dbsecs) / nreq,
+        'size': sum(sizes) / nreq, 'peak_kb': peak / 1024.0, 'errors': errors}
+
+def report(results, baseline=None):
+    # prints a table of results, with the change in median time from 'baseline' (results of an earlier run)
+    print('%-22s %5s %8s %8s %8s %8s %8s %8s %6s %8s %8s %8s %s' % ('', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'cpu ms', 'queries', 'conns', 'db ms', 'out KB', 'peak KB', 'errors' if baseline is None else 'errors  p50 vs base'))
+    for (name, r) in results.items():
+        line = '%-22s %5s %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %6.1f %8.1f %8.1f %8.0f %6s' % (name, r['requests'],
+            r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000, r['max'] * 1000, r.get('cpu', 0) * 1000, r['queries'],
+            r['connections'], r['db'] * 1000, r['size'] / 1024.0, r['peak_kb'], r['errors'])
+        if baseline is not None and name in baseline:
+            line += '  %+6.1f%%' % ((r['p50'] / baseline[name]['p50'] - 1) * 100)
+        print(line)
+
+def main():
+    # sets up the fixture, runs the benchmarks and reports them
+    parser = argparse.ArgumentParser(description='Benchmark gc_dz.py against a throwaway PostgreSQL database')
+    for (key, value) in default_scale.items():
+        parser.add_argument('--' + key, type=int, default=value, help='data scale (default %s)' % value)
+    parser.add_argument('--requests', type=int, default=default_requests, help='requests timed for each test')
+    parser.add_argument('--only', default='', help='run only tests whose name contains this text')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the data and requests')
+    parser.add_argument('--accept-encoding', default='', help='Accept-Encoding header sent, eg gzip')
+    parser.add_argument('--cells', action='store_true', help='pages read the cells of f500.xldata, not f500.xldocs')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    parser.add_argument('--keep', action='store_true', help='leave the server running at the end')
+    args = parser.parse_args()
+    global accept_encoding
+    accept_encoding = args.accept_encoding
+    scale = {key: getattr(args, key) for key in default_scale}
+    scale['years'] = max(1, min(scale['years'], 6))
+    rnd = random.Random(args.seed)
+    datadir = tempfile.mkdtemp(prefix='gcdz-bench-')
+    try:
+        dsn = start_server(datadir)
+        t0 = time.perf_counter()
+        db = psycopg2.connect(dsn)
+        db.autocommit = True
+        qry = db.cursor()
+        create_schema(qry)
+        fix = load_data(qry, scale, rnd)
+        qry.execute("SELECT count(*) FROM f500.xldata")
+        print('-- data loaded in %.1f secs: %s, %s cells --' % (time.perf_counter() - t0,
+            ', '.join('%s %s' % (v, k) for (k, v) in scale.items()), qry.fetchone()[0]))
+        db.close()
+        # the application is imported once the database exists, and connects to it through GCDZ_DSN
+        os.environ['GCDZ_DSN'] = dsn
+        import gc_dz
+        gc_dz.dbtrace.logger.setLevel(logging.WARNING)
+        gc_dz.xldocs.read_docs = not args.cells
+        results = {}
+        for (name, make) in scenarios(fix, rnd):
+            if args.only in name:
+                results[name] = run_scenario(gc_dz, make, args.requests)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as fh:
+                baseline = json.load(fh)['results']
+        report(results, baseline)
+        if args.json:
+            with open(args.json, 'w') as fh:
+                json.dump({'scale': scale, 'requests': args.requests, 'results': results}, fh, indent=1)
+    finally:
+        running = os.path.exists(os.path.join(datadir, 'postmaster.pid'))
+        if args.keep and running:
+            print('-- server left running: psql "%s" (stop with pg_ctl -D %s stop) --' % (dsn, datadir))
+        else:
+            if running:
+                stop_server(datadir)
+            shutil.rmtree(datadir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
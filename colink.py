@@ -0,0 +1,142 @@
+"""
+ ------------- colink.py  ------------
+ Automatic suggestions for the Company Linking Tool (f500_main listing option 2),
+ which groups the company-year files (flid) of the same company under a unique
+ company ID (ucid) in table f500.coflids.
+
+ suggest_links() scores all xlcohdr names against each other with the coscore.py
+ scorer and builds clusters from the strongest pairs first, never joining two
+ clusters that have a file for the same year or that are already linked to
+ different ucids.  Each cluster is proposed for the ucid already used by its
+ members, or a new one.  The proposals, with a confidence score for each file,
+ are saved in f500.colink_suggest, where the linking tool shows them.
+ apply_suggestions() applies the ones accepted by an editor in one transaction.
+
+ suggest_links() is run as a background job (kind 'colink', see jobs.py).
+"""
+import psycopg2
+import psycopg2.extras
+
+# local modules
+import dbauth
+import namematch
+import coscore
+
+def find_clusters(items, threshold=0.8, progress=None):
+    # groups a list of company files (dictionaries with flid, coname, cotype, ayear, ucid) into clusters.
+    # Returns a dictionary of flid -> (cluster, confidence, ucid) for files in clusters of 2 or more, where
+    # cluster is the list position of one file in the cluster, and ucid the cluster's existing ucid or None
+    # 'progress' is an optional function called as progress(done, total) while scoring
+    for (n, co) in enumerate(items):
+        co['_pos'] = n
+    scorer = coscore.build_scorer(items)
+    # candidate pairs (score, i, j) above the threshold, same company type only
+    pairs = []
+    for (i, co) in enumerate(items):
+        if co['coname'] is None:
+            continue
+        for (score, other) in coscore.ranked(scorer, co['coname'], threshold, limit=50, exclude=i):
+            j = other['_pos']
+            if j > i and other['cotype'] == co['cotype']:
+                pairs.append((score, i, j))
+        if progress is not None and i % 200 == 0:
+            progress(i, len(items))
+    # clusters as a union-find structure, with the set of years and ucid of each root
+    parent = list(range(len(items)))
+    years = [set([co['ayear']]) for co in items]
+    ucids = [co['ucid'] for co in items]
+    confidence = [0.0] * len(items)
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    # join the strongest pairs first
+    pairs.sort(key=lambda p: -p[0])
+    for (score, i, j) in pairs:
+        (a, b) = (root(i), root(j))
+        if a == b or not years[a].isdisjoint(years[b]):
+            continue
+        if ucids[a] is not None and ucids[b] is not None and ucids[a] != ucids[b]:
+            continue
+        parent[b] = a
+        years[a] |= years[b]
+        if ucids[a] is None:
+            ucids[a] = ucids[b]
+        confidence[i] = max(confidence[i], score)
+        confidence[j] = max(confidence[j], score)
+    clusters = {}
+    for (i, co) in enumerate(items):
+        if confidence[i] > 0.0:
+            clusters[co['flid']] = (root(i), confidence[i], ucids[root(i)])
+    return clusters
+
+def suggest_links(qry, threshold=0.8, progress=None):
+    # computes link suggestions for all company files and saves them in f500.colink_suggest,
+    # replacing any earlier suggestions not yet dealt with.  Only files whose ucid would change are
+    # saved.  Returns the number of suggestions
+    items = namematch.load_universe(qry)
+    clusters = find_clusters(items, threshold, progress)
+    values = []
+    for co in items:
+        if co['flid'] not in clusters:
+            continue
+        (cluster, score, ucid) = clusters[co['flid']]
+        if ucid is None or co['ucid'] != ucid:
+            # cluster is identified by the flid of one of its files
+            values.append((co['flid'], co['ucid'], ucid, items[cluster]['flid'], round(score, 3)))
+    qry.execute("DELETE FROM f500.colink_suggest WHERE status='open'")
+    psycopg2.extras.execute_values(qry, """INSERT INTO f500.colink_suggest
+        (flid, ucid_current, ucid_proposed, cluster, score, status, ts) VALUES %s""", values,
+        template="(%s, %s, %s, %s, %s, 'open', NOW())")
+    return len(values)
+
+def colink_job(params, progress):
+    # background job handler (see jobs.py) - runs suggest_links() and returns a summary as HTML
+    db = dbauth.dbconn()
+    db.autocommit = True
+    qry = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    nsugg = suggest_links(qry, params.get('threshold', 0.8), progress)
+    db.close()
+    return "<P>%s link suggestions made.  Refresh the Company Linking Tool listing to see them.</P>" % nsugg
+
+def get_suggestions(qry):
+    # returns the open suggestions as a dictionary of flid -> row (sugid, ucid_proposed, cluster, score)
+    qry.execute("SELECT sugid, flid, ucid_proposed, cluster, score FROM f500.colink_suggest WHERE status='open'")
+    return dict((row['flid'], row) for row in qry.fetchall())
+
+def apply_suggestions(qry, sugids):
+    # applies the accepted suggestions in list 'sugids' to f500.coflids in one transaction.
+    # Clusters without an existing ucid are given new ones.  Returns the number of files linked
+    db = qry.connection
+    db.autocommit = False
+    try:
+        qry.execute("""SELECT sugid, flid, ucid_proposed, cluster FROM f500.colink_suggest
+            WHERE status='open' AND sugid = ANY(%s) ORDER BY cluster, flid FOR UPDATE""", (list(sugids),))
+        rows = qry.fetchall()
+        # new ucids, one per cluster, allocated while coflids is locked against other updates
+        qry.execute("LOCK TABLE f500.coflids IN SHARE ROW EXCLUSIVE MODE")
+        qry.execute("SELECT COALESCE(max(ucid), 0) AS maxid FROM f500.coflids")
+        nextid = qry.fetchone()['maxid'] + 1
+        new_ucids = {}
+        values = []
+        for row in rows:
+            ucid = row['ucid_proposed']
+            if ucid is None:
+                if row['cluster'] not in new_ucids:
+                    new_ucids[row['cluster']] = nextid
+                    nextid += 1
+                ucid = new_ucids[row['cluster']]
+            values.append((row['flid'], ucid))
+        # one set-based statement for all the files, adding the coflids rows of files not yet in it
+        psycopg2.extras.execute_values(qry, """INSERT INTO f500.coflids (flid, ucid) VALUES %s
+            ON CONFLICT (flid) DO UPDATE SET ucid=EXCLUDED.ucid""", values)
+        qry.execute("UPDATE f500.colink_suggest SET status='accepted', ts=NOW() WHERE sugid = ANY(%s)",
+            ([row['sugid'] for row in rows],))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.autocommit = True
+    return len(values)
@@ -0,0 +1,136 @@
+"""
+ ------------- coscore.py  ------------
+ Vectorised similarity scoring of company names.  Each name in a universe of
+ companies is reduced to its set of name fragments (namenorm.name_frags), and the
+ fragments are encoded as integer token IDs in flat NumPy arrays, one entry per
+ company-token pair (a sparse, binary document-term matrix in CSR layout).
+ A query name is then scored against every company at once with a few array
+ operations, giving either the Jaccard similarity of the two token sets or the
+ TF-IDF cosine similarity, in which rare words (eg 'wilmar') count for more than
+ common ones (eg 'oil').  Unlike name_frags_equiv(), which only answers yes/no,
+ this gives a ranked list of candidates, and tolerates extra or missing words.
+ best_all() scores a whole list of names in one pass, through the token postings
+ (the items holding each token), so only the items sharing a token with a name
+ are visited, rather than every item once per name.
+"""
+import numpy as np
+from namematch import name_tokens
+
+def build_scorer(items):
+    # builds a scorer for a list of items (dictionaries or rows with a 'coname' field).
+    # Returns a dictionary with:
+    #   'items'   - the list of items
+    #   'vocab'   - token -> token ID
+    #   'doc'     - item number for each item-token entry, with 'tok' the token ID
+    #   'sizes'   - number of distinct tokens for each item
+    #   'idf'     - inverse document frequency for each token ID
+    #   'norms'   - length of each item's TF-IDF vector
+    #   'post'    - item numbers of the entries in token ID order, with 'postptr' the start of each
+    #               token's items in 'post' (and the end of the last)
+    vocab = {}
+    doc = []
+    tok = []
+    for (n, item) in enumerate(items):
+        for t in set(name_tokens(item['coname'])):
+            if t not in vocab:
+                vocab[t] = len(vocab)
+            doc.append(n)
+            tok.append(vocab[t])
+    doc = np.array(doc, dtype=np.int32)
+    tok = np.array(tok, dtype=np.int32)
+    sizes = np.bincount(doc, minlength=len(items)).astype(np.float64)
+    # smoothed idf, as used for unknown tokens in a query (document frequency zero)
+    idf = np.log((len(items) + 1.0) / (np.bincount(tok, minlength=len(vocab)) + 1.0)) + 1.0
+    norms = np.sqrt(np.bincount(doc, weights=idf[tok] ** 2, minlength=len(items)))
+    post = doc[np.argsort(tok, kind='stable')]
+    postptr = np.concatenate(([0], np.cumsum(np.bincount(tok, minlength=len(vocab)))))
+    return {'items': items, 'vocab': vocab, 'doc': doc, 'tok': tok, 'sizes': sizes, 'idf': idf, 'norms': norms,
+        'idf0': np.log(len(items) + 1.0) + 1.0, 'post': post, 'postptr': postptr}
+
+def score_all(scorer, name, method='cosine'):
+    # scores 'name' against every item in the scorer.  Returns a NumPy array of scores (0-1),
+    # one per item.  method is 'jaccard' or 'cosine' (TF-IDF weighted)
+    nitems = len(scorer['items'])
+    tokens = set(name_tokens(name))
+    if len(tokens) == 0 or nitems == 0:
+        return np.zeros(nitems)
+    known = np.array([scorer['vocab'][t] for t in tokens if t in scorer['vocab']], dtype=np.int32)
+    unknown = len(tokens) - len(known)
+    # entries of the document-term matrix for tokens in the query
+    hit = np.isin(scorer['tok'], known)
+    docs = scorer['doc'][hit]
+    if method == 'jaccard':
+        both = np.bincount(docs, minlength=nitems)
+        either = scorer['sizes'] + len(tokens) - both
+        return np.divide(both, either, out=np.zeros(nitems), where=either > 0)
+    elif method == 'cosine':
+        w = scorer['idf'][scorer['tok'][hit]]
+        dot = np.bincount(docs, weights=w ** 2, minlength=nitems)
+        qnorm = np.sqrt(np.sum(scorer['idf'][known] ** 2) + unknown * scorer['idf0'] ** 2)
+        denom = scorer['norms'] * qnorm
+        return np.divide(dot, denom, out=np.zeros(nitems), where=denom > 0)
+    else:
+        raise RuntimeError("Unknown scoring method '%s'" % method)
+
+def ranked(scorer, name, threshold=0.5, limit=20, method='cosine', exclude=None):
+    # returns a list of up to 'limit' (score, item) tuples for items scoring at least 'threshold'
+    # against 'name', best first.  'exclude' is an optional item number to leave out (eg the query
+    # item itself when matching a universe against itself)
+    scores = score_all(scorer, name, method)
+    if exclude is not None:
+        scores[exclude] = 0.0
+    cands = np.flatnonzero(scores >= threshold)
+    # order by score, highest first, ties by item number
+    cands = cands[np.lexsort((cands, -scores[cands]))][:limit]
+    return [(float(scores[n]), scorer['items'][n]) for n in cands]
+
+def best_all(scorer, names, threshold=0.5, method='cosine', block_cells=4000000):
+    # returns the best match for each name in list 'names', scored as by score_all(), as a list with a
+    # (score, item) tuple or None for each name.  Only scores of at least 'threshold' (which must be above 0)
+    # count, and ties go to the lowest item number, as with ranked(.., limit=1).  Names are scored a block
+    # at a time, in a names x items array of at most 'block_cells' scores
+    nitems = len(scorer['items'])
+    best = [None] * len(names)
+    if nitems == 0:
+        return best
+    # known token IDs of the names, with the name each belongs to, and the number of tokens of each name
+    (qname, qtok, ntokens) = ([], [], np.zeros(len(names)))
+    for (n, name) in enumerate(names):
+        tokens = set(name_tokens(name))
+        ntokens[n] = len(tokens)
+        for t in tokens:
+            if t in scorer['vocab']:
+                qname.append(n)
+                qtok.append(scorer['vocab'][t])
+    qname = np.array(qname, dtype=np.int64)
+    qtok = np.array(qtok, dtype=np.int64)
+    if method == 'cosine':
+        known = np.bincount(qname, minlength=len(names))
+        qnorm = np.sqrt(np.bincount(qname, weights=scorer['idf'][qtok] ** 2, minlength=len(names))
+            + (ntokens - known) * scorer['idf0'] ** 2)
+    elif method != 'jaccard':
+        raise RuntimeError("Unknown scoring method '%s'" % method)
+    size = max(1, block_cells // nitems)
+    for first in range(0, len(names), size):
+        last = min(first + size, len(names))
+        (lo, hi) = np.searchsorted(qname, [first, last])
+        # the items holding each token of the names in the block (its postings), with the name it is from
+        starts = scorer['postptr'][qtok[lo:hi]]
+        lens = scorer['postptr'][qtok[lo:hi] + 1] - starts
+        owner = np.repeat(np.arange(lo, hi), lens)
+        docs = scorer['post'][np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(len(owner))]
+        cells = (qname[owner] - first) * nitems + docs
+        if method == 'jaccard':
+            both = np.bincount(cells, minlength=(last - first) * nitems).reshape(last - first, nitems)
+            either = scorer['sizes'] + ntokens[first:last, None] - both
+            scores = np.divide(both, either, out=np.zeros(both.shape), where=both > 0)
+        else:
+            dot = np.bincount(cells, weights=scorer['idf'][qtok[owner]] ** 2,
+                minlength=(last - first) * nitems).reshape(last - first, nitems)
+            denom = scorer['norms'] * qnorm[first:last, None]
+            scores = np.divide(dot, denom, out=np.zeros(dot.shape), where=dot > 0)
+        # the first highest score of each name is the one with the lowest item number
+        top = np.argmax(scores, axis=1)
+        for n in np.flatnonzero(scores[np.arange(last - first), top] >= threshold):
+            best[first + n] = (float(scores[n, top[n]]), scorer['items'][top[n]])
+    return best
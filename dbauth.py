@@ -2,6 +2,7 @@
 # decryption tools
 from cryptography.fernet import Fernet
 import hashlib
+import os
 # postgreSQL interface
 import psycopg2
 import psycopg2.extras
@@ -13,7 +14,11 @@ def dbauth():
     return (a,b)   
 
 def dbconn(): 
-    # logs in to trasepad database and returns a connection object  
+    # logs in to trasepad database and returns a connection object.  If GCDZ_DSN is set in the
+    # environment, connects to that database instead (eg the test database set up by benchmark.py)
+    dsn = os.environ.get('GCDZ_DSN', '')
+    if dsn > '':
+        return psycopg2.connect(dsn)
     (a, b) = dbauth()
     db = psycopg2.connect(Fernet(a).decrypt(b).decode('utf-8')) 
     return db  
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+ ------------- dbtrace.py  ------------
+ Request timing and database query instrumentation for gc_dz.py.  getCursor()
+ creates its cursors with TracingCursor, which records the text, duration, row
+ count and calling function of every statement executed during a web request.
+ application() marks the start and end of each request, and the page and Ajax
+ handlers are run inside rendering(), so the request time can be split into:
+   db     - time spent executing SQL statements
+   render - time in the page or Ajax handler, other than SQL
+   other  - everything else (session checks, request parsing, output encoding)
+ At the end of each request a one-line JSON summary is written to the log (logger
+ 'gcdz.trace', by default standard error, which mod_wsgi sends to the Apache
+ error log).  Pages showing debugging information include a table of the
+ slowest statements so far (see summary_html and list_debug_info in gc_dz.py).
+ State is kept per thread, as mod_wsgi may run several requests at once.
+"""
+import sys, os, time, json, threading, logging
+from contextlib import contextmanager
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# settings: longest statement text kept (chars), statements listed in the log and debug table,
+# and the duration (seconds) above which a statement is logged by itself
+max_sql = 500
+top_n = 10
+slow_secs = 1.0
+
+# log for request summaries and slow statements, written as JSON, one line per entry
+logger = logging.getLogger('gcdz.trace')
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# timings for the request being handled by each thread
+state = threading.local()
+
+# frames in these files are skipped when looking for the function that executed a statement
+skip_files = (os.path.normcase(os.path.abspath(__file__)), os.path.dirname(psycopg2.__file__))
+
+def caller_name():
+    # returns 'function (file:line)' for the first caller outside this module and psycopg2
+    frame = sys._getframe(2)
+    while frame is not None and os.path.normcase(frame.f_code.co_filename).startswith(skip_files):
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return '%s (%s:%s)' % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+
+class TracingCursor(psycopg2.extras.DictCursor):
+    # DictCursor that records each statement in the current request's timings (if a request has started)
+    def execute(self, query, vars=None):
+        req = getattr(state, 'req', None)
+        if req is None:
+            return super().execute(query, vars)
+        t0 = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except Exception as err:
+            error = str(err)
+            raise
+        finally:
+            record_query(req, self.query, time.perf_counter() - t0, self.rowcount, caller_name(), error)
+
+def record_query(req, sql, secs, rows, caller, error=None):
+    # adds a statement to the request timings, and logs it by itself if slow
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    entry = {'sql': ' '.join(str(sql).split())[:max_sql], 'secs': secs, 'rows': rows, 'caller': caller}
+    if error is not None:
+        entry['error'] = error
+    req['queries'].append(entry)
+    req['db'] += secs
+    if secs >= slow_secs:
+        logger.info(json.dumps(dict(entry, event='slow_query', request=req['name'])))
+
+def request_start(name=''):
+    # starts timing a request.  'name' identifies it in the log (see also request_name)
+    state.req = {'name': name, 't0': time.perf_counter(), 'queries': [], 'db': 0.0, 'render': 0.0,
+        'connections': 0, 'error': False}
+
+def request_name(name):
+    # sets the name of the current request, eg the module or Ajax action, once it is known
+    req = getattr(state, 'req', None)
+    if req is not None:
+        req['name'] = name
+
+def connection_opened():
+    # counts a database connection opened for the current request
+    req = getattr(state, 'req', None)
+    if req is not None:
+        req['connections'] += 1
+
+def request_error():
+    # marks the current request as having ended in a program error
+    req = getattr(state, 'req', None)
+    if req is not None:
+        req['error'] = True
+
+@contextmanager
+def rendering():
+    # context manager for the page or Ajax handler: time inside it, less SQL, is counted as render time
+    req = getattr(state, 'req', None)
+    if req is None:
+        yield
+        return
+    (t0, db0) = (time.perf_counter(), req['db'])
+    try:
+        yield
+    finally:
+        req['render'] += (time.perf_counter() - t0) - (req['db'] - db0)
+
+def summary(req=None):
+    # returns a dictionary summarising the timings of the current request so far: name, total, db,
+    # render and other (seconds), the number of statements, rows and connections, the error flag,
+    # and the slowest statements
+    req = req or getattr(state, 'req', None)
+    if req is None:
+        return None
+    total = time.perf_counter() - req['t0']
+    slowest = sorted(req['queries'], key=lambda q: -q['secs'])[:top_n]
+    return {'request': req['name'], 'total': total, 'db': req['db'], 'render': req['render'],
+        'other': max(total - req['db'] - req['render'], 0.0), 'queries': len(req['queries']),
+        'rows': sum(max(q['rows'], 0) for q in req['queries']), 'connections': req['connections'],
+        'error': req['error'], 'slowest': slowest}
+
+def request_end(status='', size=0):
+    # ends timing the current request and writes its summary to the log.  Returns the summary
+    req = getattr(state, 'req', None)
+    if req is None:
+        return None
+    state.req = None
+    result = state.last = summary(req)
+    log = dict(result, event='request', status=status, size=size)
+    for key in ('total', 'db', 'render', 'other'):
+        log[key] = round(log[key] * 1000, 1)
+    log['slowest'] = [{'ms': round(q['secs'] * 1000, 1), 'rows': q['rows'], 'caller': q['caller'],
+        'sql': q['sql'][:100]} for q in result['slowest'][:3]]
+    logger.info(json.dumps(log))
+    return result
+
+def last_summary():
+    # returns the summary of the last request ended by this thread (eg for benchmark.py), or None
+    return getattr(state, 'last', None)
+
+def summary_html():
+    # returns HTML showing the timings of the current request so far, for the debugging section of a page
+    result = summary()
+    if result is None:
+        return ''
+    html = """<P>Request '%(request)s': %(total).3f secs so far - database %(db).3f, rendering %(render).3f,
+        other %(other).3f.  %(queries)s SQL statements, %(rows)s rows.</P>""" % result
+    html += "<TABLE class=debug><TR><TH>Secs</TH><TH>Rows</TH><TH>Called from</TH><TH>SQL</TH></TR>"
+    for q in result['slowest']:
+        html += "<TR><TD>%.4f</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD></TR>" % (q['secs'], q['rows'],
+            q['caller'], q['sql'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'))
+    html += "</TABLE>"
+    return html
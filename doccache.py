@@ -0,0 +1,236 @@
+"""
+ ------------- doccache.py  ------------
+ Local cache of the documents linked as evidence in F500 assessments (table
+ f500.documents).  Documents are downloaded in the background into a
+ content-addressed store: each file is saved under the SHA-256 hash of its contents,
+ so a report linked from many companies, or under several URLs, is kept once.
+ Text is extracted from each document (PDF via the pdftotext utility, if installed,
+ or HTML/plain text) and saved in f500.doc_store with a full text index, and the
+ hash, size, type and fetch status are recorded in f500.documents.
+
+ The indicator notes popup (f500_indNotes in gc_dz.py) uses this to show the status
+ and opening text of each document, with a link to the cached copy (module 'doc').
+ The copies are sent from the site's own address, to a logged-in user, so only
+ types that cannot run script (inline_types) are shown in the browser; the rest,
+ such as HTML pages, are sent as downloads (see document_headers).
+ Fetching is run from the command line (eg daily from cron), or as a background
+ job (kind 'docfetch', see jobs.py):
+
+     python3 doccache.py [max documents]
+"""
+import os, sys, re, time, html, shutil, hashlib, tempfile, subprocess, mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import Request, urlopen
+
+# local modules
+import dbauth
+import linkcheck
+
+# settings: store directory, largest document fetched (bytes), request timeout (seconds),
+# download threads, longest text saved for searching (chars), and how often documents are fetched again
+store_dir = '/var/lib/gcdz/doccache'
+max_size = 50 * 1024 * 1024
+timeout = 30
+max_workers = 4
+max_text = 1000000
+refetch = '90 days'
+
+# types of the cached copies shown in the browser.  PDF is shown by the browser's own viewer, which does
+# not run the document's script in the site's pages
+inline_types = ('application/pdf', 'text/plain')
+
+# patterns used to extract text from HTML
+script_rgx = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+tag_rgx = re.compile(r'<[^>]*>')
+space_rgx = re.compile(r'\s+')
+
+def store_path(sha256):
+    # path of the stored file for a hash, in two levels of sub-directories to keep directories small
+    return os.path.join(store_dir, sha256[:2], sha256[2:4], sha256)
+
+def fetch_url(url):
+    # downloads 'url' to a temporary file in the store directory, computing its hash as it goes.
+    # Returns a dictionary with sha256, size, ctype and tmpfile.  Raises an error if the download fails
+    # or the document is larger than max_size
+    req = Request(url, headers={'User-Agent': linkcheck.user_agent})
+    os.makedirs(store_dir, exist_ok=True)
+    (fd, tmpfile) = tempfile.mkstemp(dir=store_dir, suffix='.part')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            resp = urlopen(req, timeout=timeout)
+            try:
+                ctype = resp.headers.get_content_type()
+                while True:
+                    block = resp.read(65536)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > max_size:
+                        raise RuntimeError("Document larger than %s bytes" % max_size)
+                    digest.update(block)
+                    fh.write(block)
+            finally:
+                resp.close()
+    except Exception:
+        os.remove(tmpfile)
+        raise
+    return {'sha256': digest.hexdigest(), 'size': size, 'ctype': ctype, 'tmpfile': tmpfile}
+
+def store_file(tmpfile, sha256):
+    # moves a downloaded file into the store under its hash, or discards it if the store already has it.
+    # Returns True if the file is new
+    path = store_path(sha256)
+    if os.path.exists(path):
+        os.remove(tmpfile)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmpfile, path)
+    return True
+
+def extract_text(path, ctype):
+    # returns the text of a stored document for searching, as a single line, or '' if the type is not handled
+    if ctype == 'application/pdf':
+        if shutil.which('pdftotext') is None:
+            return ''
+        proc = subprocess.run(['pdftotext', '-q', '-enc', 'UTF-8', path, '-'], stdout=subprocess.PIPE,
+            timeout=120)
+        text = proc.stdout.decode('utf-8', 'replace')
+    elif ctype in ('text/html', 'application/xhtml+xml'):
+        with open(path, 'rb') as fh:
+            text = fh.read().decode('utf-8', 'replace')
+        text = html.unescape(tag_rgx.sub(' ', script_rgx.sub(' ', text)))
+    elif ctype.startswith('text/'):
+        with open(path, 'rb') as fh:
+            text = fh.read().decode('utf-8', 'replace')
+    else:
+        return ''
+    # PostgreSQL text cannot hold NUL characters
+    return space_rgx.sub(' ', text.replace('\x00', ' ')).strip()[:max_text]
+
+def fetch_document(url):
+    # downloads, stores and extracts the text of one document.  Runs on a worker thread, so does not use
+    # the database.  Returns a dictionary with url, status ('ok' or 'dead'), msg, and if downloaded
+    # sha256, size, ctype, text and new (True if not already in the store)
+    result = {'url': url, 'status': 'dead', 'msg': '', 'sha256': None, 'size': None, 'ctype': None}
+    try:
+        doc = fetch_url(url)
+    except Exception as err:
+        result['msg'] = str(err)
+        return result
+    result.update(doc)
+    result['status'] = 'ok'
+    result['msg'] = 'OK'
+    result['new'] = store_file(doc['tmpfile'], doc['sha256'])
+    try:
+        result['text'] = extract_text(store_path(doc['sha256']), doc['ctype'])
+    except Exception as err:
+        result['text'] = ''
+        result['msg'] = "Text not extracted: %s" % err
+    return result
+
+def save_result(qry, result):
+    # records a fetch result in f500.doc_store (new documents only) and f500.documents
+    if result['status'] == 'ok':
+        qry.execute("""INSERT INTO f500.doc_store (sha256, size, ctype, doctext, fetched)
+            VALUES (%(sha256)s, %(size)s, %(ctype)s, %(text)s, NOW()) ON CONFLICT (sha256) DO NOTHING""", result)
+    qry.execute("""UPDATE f500.documents SET status=%(status)s, sha256=COALESCE(%(sha256)s, sha256),
+        size=COALESCE(%(size)s, size), ctype=COALESCE(%(ctype)s, ctype), fetched=NOW(), fetchmsg=%(msg)s
+        WHERE url=%(url)s""", result)
+
+def pending_urls(qry, limit=None):
+    # returns a list of document URLs not yet fetched, or not fetched for 'refetch'
+    qry.execute("""SELECT url FROM f500.documents WHERE fetched IS NULL OR fetched < NOW() - %s::INTERVAL
+        GROUP BY url ORDER BY min(fetched) NULLS FIRST, min(docid) LIMIT %s""", (refetch, limit))
+    return [row[0] for row in qry.fetchall()]
+
+def fetch_pending(qry, limit=None, progress=None):
+    # fetches pending documents on a pool of download threads, saving the results as each finishes.
+    # 'progress' is an optional function called as progress(done, total).  Returns a dictionary of
+    # counts: urls, ok, dead, new (files added to the store), bytes downloaded, and secs
+    t0 = time.perf_counter()
+    urls = pending_urls(qry, limit)
+    stats = {'urls': len(urls), 'ok': 0, 'dead': 0, 'new': 0, 'bytes': 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(fetch_document, url) for url in urls]
+        for (n, fut) in enumerate(as_completed(futures)):
+            result = fut.result()
+            save_result(qry, result)
+            stats[result['status']] += 1
+            if result.get('new'):
+                stats['new'] += 1
+            stats['bytes'] += result['size'] or 0
+            if progress is not None:
+                progress(n + 1, len(urls))
+    stats['secs'] = time.perf_counter() - t0
+    return stats
+
+def docfetch_job(params, progress):
+    # background job handler (see jobs.py) - fetches pending documents and returns a summary as HTML
+    db = dbauth.dbconn()
+    db.autocommit = True
+    qry = db.cursor()
+    stats = fetch_pending(qry, params.get('limit'), progress)
+    db.close()
+    return """<P>%(urls)s documents fetched in %(secs).1f seconds: %(ok)s OK (%(new)s new to the cache),
+        %(dead)s failed, %(bytes)s bytes downloaded.</P>""" % stats
+
+def get_documents(qry, flid, inid, snippet=300):
+    # returns the documents linked for indicator 'inid' of company file 'flid', with cache details and
+    # the first 'snippet' characters of the text, as a list of dictionaries
+    qry.execute("""SELECT d.docid, d.url, d.status, d.size, d.ctype, d.fetched::DATE AS fetched,
+        d.sha256, LEFT(s.doctext, %s) AS snippet FROM f500.documents AS d
+        LEFT JOIN f500.doc_store AS s ON d.sha256=s.sha256
+        WHERE d.flid=%s AND d.inid=%s ORDER BY d.docid""", (snippet, flid, inid))
+    return [dict(row) for row in qry.fetchall()]
+
+def search_documents(qry, terms, limit=20):
+    # full text search of the cached documents.  Returns a list of dictionaries with docid, url, flid,
+    # inid, sha256 and a snippet of text around the matching words (marked with <B> tags), best matches first
+    # each stored document is shown once, for the first link to it
+    qry.execute("""SELECT d.docid, d.url, d.flid, d.inid, s.sha256,
+        ts_headline('english', s.doctext, q, 'MaxFragments=2') AS snippet,
+        ts_rank(to_tsvector('english', s.doctext), q) AS rank
+        FROM f500.doc_store AS s
+        INNER JOIN (SELECT sha256, min(docid) AS docid FROM f500.documents GROUP BY sha256) AS m ON m.sha256=s.sha256
+        INNER JOIN f500.documents AS d ON d.docid=m.docid, plainto_tsquery('english', %s) AS q
+        WHERE to_tsvector('english', s.doctext) @@ q ORDER BY rank DESC, d.docid LIMIT %s""",
+        (terms, limit))
+    return [dict(row) for row in qry.fetchall()]
+
+def document_headers(ctype, docid):
+    # returns (content type, response headers) for sending a cached copy of type 'ctype'.  The browser is
+    # told not to guess another type; types not in inline_types are sent as a download, and all but PDF
+    # (whose viewer will not open in a sandbox) are sandboxed, so no script in them runs as the site
+    ctype = (ctype or 'application/octet-stream').split(';')[0].strip().lower()
+    headers = [('X-Content-Type-Options', 'nosniff')]
+    if ctype != 'application/pdf':
+        headers.append(('Content-Security-Policy', 'sandbox'))
+    if ctype not in inline_types:
+        name = 'document-%s%s' % (docid, mimetypes.guess_extension(ctype) or '')
+        headers.append(('Content-Disposition', 'attachment; filename="%s"' % name))
+        ctype = 'application/octet-stream'
+    return (ctype, headers)
+
+def read_document(qry, docid):
+    # returns (content type, contents as bytes, response headers) of the cached copy of a document, or None
+    # if not cached (see document_headers)
+    qry.execute("SELECT sha256, ctype FROM f500.documents WHERE docid=%s AND sha256 IS NOT NULL", (docid,))
+    if qry.rowcount <= 0:
+        return None
+    row = qry.fetchone()
+    path = store_path(row[0])
+    if not os.path.exists(path):
+        return None
+    (ctype, headers) = document_headers(row[1], docid)
+    with open(path, 'rb') as fh:
+        return (ctype, fh.read(), headers)
+
+# when run from the command line, fetches all pending documents
+if __name__ == '__main__':
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    db = dbauth.dbconn()
+    db.autocommit = True
+    stats = fetch_pending(db.cursor(), limit)
+    print('-- %(urls)s documents in %(secs).1f secs: %(ok)s ok, %(dead)s failed, %(new)s new, %(bytes)s bytes --' % stats)
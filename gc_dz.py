@@ -27,13 +27,12 @@ import cgi, traceback, json
 import os, sys, re, datetime
 import random, string
 from urllib.parse import urlparse
-from urllib.request import urlopen
-import unidecode
 import textwrap
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Python modules for the email system and encryption
-from smtplib import SMTP
-from email.utils import formatdate
 from cryptography.fernet import Fernet
 import hashlib
 
@@ -46,6 +45,24 @@ from trasesdk import TraseCompaniesDB
 
 # local modules
 import dbauth
+from namenorm import name_frags
+import namematch
+import coscore
+import colink
+import jobs
+import linkcheck
+import doccache
+import mailq
+import dbtrace
+import metrics
+import httpzip
+import httpcache
+import sqltool
+import xlexport
+import scoring
+import xldocs
+from htmlbuf import HTMLBuffer, escape
+from htmltpl import Template
 
 def application(environ, start_response):
     """
@@ -57,10 +74,16 @@ def application(environ, start_response):
     error handler for the entire module, and returns an HTML-compatible trace-back
     for any Python errors.
     """
+    # timings and SQL statements for this request are recorded by dbtrace
+    dbtrace.request_start(environ.get('REQUEST_URI', ''))
     try:
         status = '200 OK'
         html = ""
         contentType = "text/html"
+        # True for documents from the document cache, whose compressed copies can be kept (see httpzip.py)
+        cached = False
+        # other response headers given by the page, eg its ETag (see httpcache.py)
+        page_headers = []
         # list of relevant environment variables
         relenvars = ['REMOTE_ADDR', 'REQUEST_SCHEME', 'SERVER_NAME', 'REQUEST_URI',
                      'REQUEST_METHOD', 'QUERY_STRING', 'SCRIPT_FILENAME', 'SCRIPT_NAME']
@@ -79,12 +102,27 @@ def application(environ, start_response):
             # originating IP address not on permitted list - show error page
             #raise RuntimeError("Blocked user!!" )
             html = error_page("Access not allowed (%s://%s )" % (environ['REQUEST_SCHEME'], environ['REMOTE_ADDR']), 1)
+        elif cgi.parse_qs(environ['QUERY_STRING']).get('m', [''])[0] == 'metrics':
+            # request and database metrics (see metrics.py) - protected by a token, not a session
+            dbtrace.request_name('m=metrics')
+            (status, contentType, html) = metrics.metrics_page(environ)
         else:
             # call main page    
             #raise RuntimeError("Testing!" )
             html = page_selector(environ)
+            # pages other than HTML are returned as a tuple (content type, contents as bytes), with a list
+            # of other response headers as a third item if needed (eg the file name of a download)
+            if isinstance(html, tuple):
+                if len(html) == 2:
+                    html += ([],)
+                (contentType, html, page_headers) = html
+                cached = True
+            # pages with an ETag reply with a status and headers as well (see httpcache.py)
+            elif isinstance(html, httpcache.PageReply):
+                (status, page_headers, html) = (html.status, html.headers, html.html)
     except Exception as e:
         # handle any errors in code
+        dbtrace.request_error()
         html += "<PRE>"    
         html += "\n\nAN ERROR OCCURRED IN THE PROGRAM\n\n"
         html += traceback.format_exc()
@@ -118,37 +156,76 @@ def application(environ, start_response):
     # return results to Apache server via mod_wsgi interface
     # Note 'output' must be a string of bytes, not unicode.  Other strings should be 
     # unicode (Python3 default)          
-    output = str.encode(html)
-    response_headers = [('Content-type', contentType),
-                        ('Content-Length', str(len(output)))]
-    start_response(status, response_headers)
-    return [output]
+    # pages built in an HTMLBuffer are encoded in chunks, without joining them into one string.  All the
+    # chunks are made before the response is started, for its size (see htmlbuf.py)
+    if isinstance(html, HTMLBuffer):
+        output = list(html.encoded())
+    else:
+        output = [html if isinstance(html, bytes) else str.encode(html)]
+    size = sum(len(chunk) for chunk in output)
+    metrics.record_request(dbtrace.request_end(status, size), status)
+    if status.startswith('304'):
+        # the browser's copy of the page is current: headers only
+        start_response(status, page_headers + [('Vary', 'Accept-Encoding')])
+        return []
+    # compress the response if the browser accepts it (see httpzip.py)
+    (response_headers, output) = httpzip.compress_response(environ, contentType, output, cached, page_headers)
+    start_response(status, [('Content-type', contentType)] + response_headers)
+    return output
     
+# dispatch tables for page modules (m= parameter) and Ajax actions (action field), built once
+# when the module is loaded by the page_module() and ajax_action() decorators below
+page_modules = {}
+ajax_actions = {}
+
+def page_module(mdl):
+    # decorator registering a function as the handler for module 'mdl', called as fn(mdl, sid, pflag, environ)
+    def register(fn):
+        page_modules[mdl] = fn
+        return fn
+    return register
+
+def ajax_action(actid, params=None, perm=None, reply='json'):
+    # decorator registering a function as the handler for Ajax action 'actid', called as fn(environ, p)
+    # params - dictionary of POST field name -> (type, default).  The type is int, str, 'json' or 'intlist'
+    #          (comma-separated integers), and the fields are converted and passed to the handler as 'p'
+    # perm   - module (in gcdz.menus) the session in field 'sessid' must be permitted for, or None
+    # reply  - 'json' to return the handler's result as JSON, 'html' as JSON {'html': result}, or
+    #          'text' to return it unchanged
+    def register(fn):
+        ajax_actions[actid] = {'handler': fn, 'params': params or {}, 'perm': perm, 'reply': reply}
+        return fn
+    return register
+
+def coerce_params(schema, postFields):
+    # converts POST fields to the types in 'schema' (see ajax_action).  Returns a tuple (params, errors),
+    # where errors is a dictionary of field name -> message for any fields that could not be converted
+    params = {}
+    errors = {}
+    for (name, (ftype, default)) in schema.items():
+        if name not in postFields:
+            params[name] = default
+            continue
+        value = postFields[name][0]
+        try:
+            if ftype == 'json':
+                params[name] = json.loads(value)
+            elif ftype == 'intlist':
+                params[name] = [int(n) for n in value.split(',') if n > '']
+            else:
+                params[name] = ftype(value)
+        except ValueError:
+            errors[name] = "'%s' is not a valid %s" % (value, ftype if isinstance(ftype, str) else ftype.__name__)
+    return (params, errors)
+
 def page_selector(environ):
     # checks login status and selects pages to display based, based on u and m parameters
     # mdl is module to be run; sid is session ID;  pflag is user's permissions (bitwise flags)
     (mdl, sid, pflag) = sessionStart(environ)
-    if mdl == 'menu':
-        # display menus - either active or disabled (grayed out) if not permitted for this user
-        html = mainMenu(sid, environ, pflag)     
-    elif mdl == 'cmatch':
-        # company lists and name matching
-        html = cmatch_tool(mdl, sid, environ)     
-    elif mdl == 'f500':
-        # forest 500 company lists
-        html = f500_main(sid, environ)     
-    elif mdl == 'f500a':
-        # forest 500 past assessments
-        html = f500_assess(sid, environ)     
-    elif mdl == 'f500b':
-        # forest 500 input/edit for 2019+
-        html = f500_input(sid, environ)     
-    elif mdl == 'sctn':
-        # SCTN survey system: latform list, platform detail, survey form
-        html = SCTN_sys(sid, environ)
-    elif mdl == 'sctndd':
-        # SCTN data tool.  This is used by SCTN website.  Test any mods carefully! 
-        html = SCTN_tool(sid, environ)
+    if mdl in page_modules:
+        dbtrace.request_name('m=%s' % mdl)
+        with dbtrace.rendering():
+            html = page_modules[mdl](mdl, sid, pflag, environ)
     elif mdl.find("<HTML>") >= 0:
         # html code has been returned, indicating an error page
         html = mdl    
@@ -158,6 +235,51 @@ def page_selector(environ):
     # return HTML for generated page to be displayed by server
     return html
 
+@page_module('menu')
+def page_menu(mdl, sid, pflag, environ):
+    # display menus - either active or disabled (grayed out) if not permitted for this user
+    return mainMenu(sid, environ, pflag)
+
+@page_module('cmatch')
+def page_cmatch(mdl, sid, pflag, environ):
+    # company lists and name matching
+    return cmatch_tool(mdl, sid, environ)
+
+@page_module('f500')
+def page_f500(mdl, sid, pflag, environ):
+    # forest 500 company lists
+    return f500_main(sid, environ)
+
+@page_module('f500a')
+def page_f500a(mdl, sid, pflag, environ):
+    # forest 500 past assessments
+    return f500_assess(sid, environ)
+
+@page_module('f500b')
+def page_f500b(mdl, sid, pflag, environ):
+    # forest 500 input/edit for 2019+
+    return f500_input(sid, environ)
+
+@page_module('doc')
+def page_doc(mdl, sid, pflag, environ):
+    # cached copy of a document linked in a Forest 500 assessment (see doccache.py)
+    return f500_document(sid, environ)
+
+@page_module('xlx')
+def page_xlx(mdl, sid, pflag, environ):
+    # workbook exported from a Forest 500 assessment (see xlexport.py)
+    return f500_export(sid, environ)
+
+@page_module('sctn')
+def page_sctn(mdl, sid, pflag, environ):
+    # SCTN survey system: latform list, platform detail, survey form
+    return SCTN_sys(sid, environ)
+
+@page_module('sctndd')
+def page_sctndd(mdl, sid, pflag, environ):
+    # SCTN data tool.  This is used by SCTN website.  Test any mods carefully! 
+    return SCTN_tool(sid, environ)
+
 def mainMenu(sid, environ, pflag):
     # displays the main menu - get the menu details
     # sid - session ID, environ - Apache/WSGI environment array, pflag - permit flag for user)
@@ -202,6 +324,16 @@ def getPostFields(environ, getRequest=False):
     else:
         return postFields    
 
+def getFormFields(environ):
+    # returns the fields of a form, sent by POST or by GET.  Forms sent by GET include the module
+    # and session ID fields (m and u), which are left out
+    postFields = getPostFields(environ)
+    if len(postFields) == 0 and environ.get('REQUEST_METHOD', 'GET') == 'GET':
+        postFields = cgi.parse_qs(environ['QUERY_STRING'])
+        postFields.pop('m', None)
+        postFields.pop('u', None)
+    return postFields
+
 def ajaxHandler(environ):
 # process ajax requests
     try:
@@ -209,84 +341,36 @@ def ajaxHandler(environ):
         (postFields, requestBody) = getPostFields(environ, True)
         # get action ID and call approriate action based on that
         actid = postFields.get('action',['0'])[0]
-        if actid=="login":
-            # process login request
-            emailaddr = postFields.get('emailaddr',['0'])[0]
-            ip = environ['REMOTE_ADDR']
-            html = user_login(emailaddr, ip)
-            json_str = json.dumps({'html' : html})   
-        elif actid=="f500.colist":
-            # forest 500 company list matching 'cofind'
-            cofind = postFields.get('cofind',['0'])[0] 
-            ayear = postFields.get('ayear',['0'])[0] 
-            cotype = postFields.get('cotype',['0'])[0]
-            sid = postFields.get('sid',['0'])[0]  
-            html = f500_cofind(sid, ayear, cotype, cofind)
-            json_str = json.dumps({'html' : html})   
-        elif actid=="f500.colink":
-            # forest 500 company link tool
-            mode = int(postFields.get('mode',['0'])[0])
-            flid = int(postFields.get('flid',['0'])[0]) 
-            ucid = int(postFields.get('ucid',['0'])[0]) 
-            f500_colink_ajax(mode, flid, ucid)
-            # this doesn't return anything (all actions are DB updates)
-            json_str = ''   
-        elif actid=="f500.comChkBox":
-            # forest 500 commodity checkbox update
-            sessid = postFields.get('sessid',['0'])[0]
-            flid = int(postFields.get('flid',['0'])[0]) 
-            cid = int(postFields.get('cid',['0'])[0]) 
-            tick = int(postFields.get('tick',['0'])[0]) 
-            reply = f500_comChkBox_ajax(sessid, flid, cid, tick)
-            json_str = json.dumps(reply)
-        elif actid == 'f500a.indNotes':
-            inid   = postFields.get('inid',['0'])[0]      
-            cid    = postFields.get('cid',['0'])[0]       
-            sid    = postFields.get('sid',['0'])[0]       
-            flid   = postFields.get('flid',['0'])[0]
-            imgid  = postFields.get('imgid',['0'])[0]     
-            html = f500_indNotes(inid, cid, sid, flid, imgid)
-            json_str = json.dumps({'html' : html})    
-        elif actid == 'f500b.update':
-            # actions on the data input form.  
-            sid    = postFields.get('sid',['0'])[0]       
-            flid   = postFields.get('fileid',['0'])[0]
-            cell   = postFields.get('cell',['0'])[0]
-            text   = postFields.get('value',['0'])[0]
-            reply  = f500_input_ajax(sid, flid, cell, text)
-            json_str = json.dumps(reply)
-        elif actid == 'f500b.select':
-            sessid = postFields.get('sessid',['0'])[0]
-            flid   = postFields.get('flid',['0'])[0]
-            cell   = postFields.get('cell',['0'])[0]
-            cell_s   = postFields.get('cell_s',['0'])[0]
-            optval   = postFields.get('optval',['0'])[0]
-            opttxt   = postFields.get('opttxt',['0'])[0]
-            reply  = f500_select_ajax(sessid, flid, cell, cell_s, optval, opttxt)
-            json_str = json.dumps(reply)
-        elif actid == 'f500b.save_link':
-            sessid = postFields.get('sessid',['0'])[0]
-            flid   = int(postFields.get('fileid',['0'])[0])
-            cell   = postFields.get('cell',[''])[0]
-            inid = int(postFields.get('inid',['0'])[0])
-            refid = int(postFields.get('refid',['0'])[0])
-            cid = int(postFields.get('cid',['0'])[0])           
-            link_text   = postFields.get('text',[''])[0]
-            reply  = f500_savelink_ajax(sessid, flid, cell, inid, refid, cid, link_text)
-            json_str = json.dumps(reply)
-        elif actid == 'f500b.tableC':
-            # gets HTML for input form.  
-            inid    = postFields.get('inid',['0'])[0]       
-            flid   = postFields.get('flid',['0'])[0]
-            cid   = postFields.get('cid',['0'])[0]
-            refid   = postFields.get('refid',['0'])[0]
-            reply  = f500_input_table_ajax(inid, flid, refid, cid)
-            json_str = reply  # plain HTML is expected here, no JSON wrapper
-        else:
+        if actid not in ajax_actions:
             # unknown action requested   
             raise RuntimeError("Unknown Action '%s' requested" % actid)
+        action = ajax_actions[actid]
+        (p, errors) = coerce_params(action['params'], postFields)
+        if len(errors) > 0:
+            # parameters that could not be converted are reported without calling the handler
+            reply = {'valid': 0, 'ok': 0, 'msg': "Invalid parameters for action '%s'" % actid, 'errors': errors}
+            json_str = json.dumps(reply)
+        else:
+            # actions declaring a permission have the session checked before the handler is called
+            reply = {'valid': 1}
+            if action['perm'] is not None:
+                reply = session_check(postFields.get('sessid',['0'])[0], action['perm'])
+            if reply['valid'] != 1:
+                reply['ok'] = 0
+                json_str = json.dumps(reply)
+            else:
+                dbtrace.request_name('action=%s' % actid)
+                with dbtrace.rendering():
+                    result = action['handler'](environ, p)
+                if action['reply'] == 'json':
+                    json_str = json.dumps(result)
+                elif action['reply'] == 'html':
+                    json_str = json.dumps({'html' : result})
+                else:
+                    json_str = result
     except Exception as e:
         # give traceback and diagnostics in plain text
+        dbtrace.request_error()
         html = "<PRE>\n\nAN ERROR OCCURRED IN THE PROGRAM\n\n"
         html += traceback.format_exc()
         html += "\n\nREQUEST BODY:%s\n" % requestBody
@@ -294,6 +378,125 @@ def ajaxHandler(environ):
         json_str = json.dumps({'html': html}) 
     # return results to Apache server via mod_wsgi interface (Application module)
     return json_str 
+
+@ajax_action('login', {'emailaddr': (str, '0')}, reply='html')
+def ajax_login(environ, p):
+    # process login request
+    return user_login(p['emailaddr'], environ['REMOTE_ADDR'])
+
+@ajax_action('f500.colist', {'cofind': (str, '0'), 'ayear': (str, '0'), 'cotype': (str, '0'), 'sid': (str, '0')},
+    reply='html')
+def ajax_f500_colist(environ, p):
+    # forest 500 company list matching 'cofind'
+    return f500_cofind(p['sid'], p['ayear'], p['cotype'], p['cofind'])
+
+@ajax_action('f500.colink', {'mode': (int, 0), 'flid': (int, 0), 'ucid': (int, 0)}, reply='text')
+def ajax_f500_colink(environ, p):
+    # forest 500 company link tool
+    f500_colink_ajax(p['mode'], p['flid'], p['ucid'])
+    # this doesn't return anything (all actions are DB updates)
+    return ''
+
+@ajax_action('f500.colinkSuggest', {'sessid': (str, '0')}, perm='f500b')
+def ajax_f500_colinkSuggest(environ, p):
+    # start a background job to suggest company links (see colink.py)
+    jobid = jobs.submit_job(getCursor(), p['sessid'], 'colink', {'threshold': 0.8})
+    return {'valid': 1, 'msg': "Suggestion job %s submitted.  Refresh the listing when it is complete." % jobid}
+
+@ajax_action('f500.colinkApply', {'sessid': (str, '0'), 'sugids': ('intlist', [])}, perm='f500b')
+def ajax_f500_colinkApply(environ, p):
+    # apply ticked link suggestions in one transaction
+    nlinked = colink.apply_suggestions(getCursor(), p['sugids'])
+    return {'valid': 1, 'msg': "%s files linked.  Refresh the listing to see the changes." % nlinked}
+
+@ajax_action('f500.comChkBox', {'sessid': (str, '0'), 'flid': (int, 0), 'cid': (int, 0), 'tick': (int, 0)})
+def ajax_f500_comChkBox(environ, p):
+    # forest 500 commodity checkbox update
+    return f500_comChkBox_ajax(p['sessid'], p['flid'], p['cid'], p['tick'])
+
+@ajax_action('f500.comChkBoxBulk', {'sessid': (str, '0'), 'changes': ('json', [])})
+def ajax_f500_comChkBoxBulk(environ, p):
+    # forest 500 commodity checkbox updates in bulk: 'changes' is a JSON list of [flid, cid, tick]
+    changes = [(int(flid), int(cid), int(tick)) for (flid, cid, tick) in p['changes']]
+    return f500_comChkBox_bulk(p['sessid'], changes)
+
+@ajax_action('f500.colinkBulk', {'sessid': (str, '0'), 'changes': ('json', [])})
+def ajax_f500_colinkBulk(environ, p):
+    # forest 500 company link tool updates in bulk: 'changes' is a JSON list of [mode, flid, ucid]
+    changes = [(int(mode), int(flid), int(ucid or 0)) for (mode, flid, ucid) in p['changes']]
+    return f500_colink_bulk(p['sessid'], changes)
+
+@ajax_action('f500a.indNotes', {'inid': (str, '0'), 'cid': (str, '0'), 'sid': (str, '0'), 'flid': (str, '0'),
+    'imgid': (str, '0'), 'sessid': (str, '')}, reply='html')
+def ajax_f500a_indNotes(environ, p):
+    # notes popup for an indicator in the assessment view
+    return f500_indNotes(p['inid'], p['cid'], p['sid'], p['flid'], p['imgid'], p['sessid'])
+
+@ajax_action('f500a.docSearch', {'terms': (str, ''), 'sessid': (str, '')}, perm='f500a', reply='html')
+def ajax_f500a_docSearch(environ, p):
+    # full text search of cached documents (see doccache.py)
+    return f500_docSearch(p['terms'], p['sessid'])
+
+@ajax_action('f500b.update', {'sid': (str, '0'), 'fileid': (str, '0'), 'cell': (str, '0'), 'value': (str, '0')})
+def ajax_f500b_update(environ, p):
+    # actions on the data input form.  
+    return f500_input_ajax(p['sid'], p['fileid'], p['cell'], p['value'])
+
+@ajax_action('f500b.select', {'sessid': (str, '0'), 'flid': (str, '0'), 'cell': (str, '0'), 'cell_s': (str, '0'),
+    'optval': (str, '0'), 'opttxt': (str, '0')})
+def ajax_f500b_select(environ, p):
+    # selection from a drop-down list on the data input form
+    return f500_select_ajax(p['sessid'], p['flid'], p['cell'], p['cell_s'], p['optval'], p['opttxt'])
+
+@ajax_action('f500b.save_link', {'sessid': (str, '0'), 'fileid': (int, 0), 'cell': (str, ''), 'inid': (int, 0),
+    'refid': (int, 0), 'cid': (int, 0), 'text': (str, '')})
+def ajax_f500b_save_link(environ, p):
+    # document link entered on the data input form
+    return f500_savelink_ajax(p['sessid'], p['fileid'], p['cell'], p['inid'], p['refid'], p['cid'], p['text'])
+
+@ajax_action('f500b.link_status', {'sessid': (str, '0'), 'docid': (int, 0)}, perm='f500b')
+def ajax_f500b_link_status(environ, p):
+    # result of the background check of a saved link (see linkcheck.py)
+    qry = getCursor()
+    qry.execute("""SELECT d.url, d.status, l.code, l.msg, l.checked::TEXT FROM f500.documents AS d
+        LEFT JOIN f500.link_checks AS l ON d.url=l.url WHERE d.docid=%s""", (p['docid'],))
+    if qry.rowcount <= 0:
+        raise RuntimeError("Document %s not found" % p['docid'])
+    return dict(qry.fetchone())
+
+@ajax_action('jobs.status', {'sessid': (str, '0'), 'jobid': (int, 0)})
+def ajax_jobs_status(environ, p):
+    # progress and results of a background job (see jobs.py)
+    reply = jobs.job_status(getCursor(), p['jobid'], p['sessid'])
+    if reply is None:
+        raise RuntimeError("Job %s not found for this user" % p['jobid'])
+    return reply
+
+@ajax_action('sql.query', {'sessid': (str, '0'), 'query': (str, ''), 'rec_from': (int, 1), 'rec_by': (int, 10)},
+    perm='sqlq')
+def ajax_sql_query(environ, p):
+    # SQL query tool: a page of the result of a query
+    return processQuery(p['sessid'], p['query'], p['rec_from'], p['rec_by'])
+
+@ajax_action('sql.cancel', {'sessid': (str, '0')}, perm='sqlq')
+def ajax_sql_cancel(environ, p):
+    # SQL query tool: cancels the query running for the session
+    return {'cancelled': sqltool.cancel(getCursor(), p['sessid'])}
+
+@ajax_action('f500.xlexport', {'sessid': (str, '0'), 'flid': (int, 0), 'ayear': (int, 0), 'cotype': (str, '')},
+    perm='f500a')
+def ajax_f500_xlexport(environ, p):
+    # start a background job exporting a company file, or the files of a year, as workbooks (see xlexport.py)
+    if p['flid'] <= 0 and p['ayear'] <= 0:
+        raise RuntimeError("No company file or year given for export")
+    (jobid, name) = xlexport.submit_export(getCursor(), p['sessid'], p['flid'], p['ayear'], p['cotype'])
+    return {'valid': 1, 'jobid': jobid, 'file': name, 'msg': "Export job %s submitted..." % jobid}
+
+@ajax_action('f500b.tableC', {'inid': (str, '0'), 'flid': (str, '0'), 'cid': (str, '0'), 'refid': (str, '0')},
+    reply='text')
+def ajax_f500b_tableC(environ, p):
+    # gets HTML for input form.  plain HTML is expected here, no JSON wrapper
+    return f500_input_table_ajax(p['inid'], p['flid'], p['refid'], p['cid'])
     
 def user_login(emailaddr, ip):
 # checks an email address to see if a registered user.   If they are, sends
@@ -361,7 +564,8 @@ def user_login(emailaddr, ip):
     Data Manager, Global Canopy
     d.alder@globalcanopy.org 
     """ % sid
-    sendMail(mail_from, mail_to, subject, text)
+    # queued for the mail sender (see mailq.py), so the page does not wait for the mail server
+    mailq.queue_mail(qry, mail_from, mail_to, subject, text)
     # return text for home page
     html="""<P><SPAN style="color: green; font-weight: bold;">
     An email has been sent to %s with a link to the portal.</SPAN>  Please use this link 
@@ -371,44 +575,38 @@ def user_login(emailaddr, ip):
     # return text for home page 'reply_div' 
     return html
     
-def processQuery(postFields):
-# processes a query and returns result as an HTML table or error message string
+def processQuery(sid, qtext, rec_from=1, rec_by=10):
+# processes a query and returns a dictionary with the result as an HTML table or error message string, and
+# the records shown.  Only SELECTs are run, read-only, and paged with a cursor held on the server for the
+# session (see sqltool.py)
+    # initialise record counter 
+    record_counter = {'from': 0, 'to': 0, 'by': 10, 'total': 0, 'estimated': 0}
     try:
-        # initialise record counter 
-        record_counter = {'from': 0, 'to': 0, 'by': 10, 'total': 0}
-        # connect to database
-        qry = getCursor()
-        qtext = postFields.get('query',[''])[0]
-        # check if this is a SELECT query
-        if re.match(r'^\s*SELECT\s',qtext, re.I):
-            # yes - get the limit values
-            rec_from = int(postFields.get('rec_from',['1'])[0])
-            rec_by = int(postFields.get('rec_by',['10'])[0])
-            # records counted from base 0, so subtract 1
-            if rec_from > 0:
-                rec_from -= 1
-            # construct limit expression to append to SELECT    
-            limit_expr = " LIMIT " + str(rec_by) + " OFFSET " + str(rec_from)
-            qtext += limit_expr
-            record_counter['from'] = rec_from + 1
-            record_counter['to'] = rec_from + rec_by
-            record_counter['by']= rec_by
-        qry.execute(qtext)
-        record_counter['total']= qry.rowcount
-        if qry.rowcount>0:
-            html = makeHTMLtable(qry)
+        # trailing semicolons are not allowed in a cursor declaration
+        qtext = qtext.strip().rstrip(';')
+        # records counted from base 0, so subtract 1
+        rec_from = max(rec_from - 1, 0)
+        rec_by = max(rec_by, 1)
+        (columns, rows, total, exact) = sqltool.fetch_page(sid, qtext, rec_from, rec_by)
+        record_counter['from'] = rec_from + 1
+        record_counter['to'] = rec_from + len(rows)
+        record_counter['by']= rec_by
+        record_counter['total'] = total
+        record_counter['estimated'] = 0 if exact else 1
+        if len(rows) > 0:
+            html = makeHTMLrows(columns, rows)
         else:    
-            html = "<P>No data returned by query.  Server message: %s</P>" % qry.statusmessage
-    except (psycopg2.Error) as emsg:
-        # if not able to connect or other DB error, give warning message
-        html = ("<P style='font-weight: bold; color: red;'>Data query error:</P><BR><PRE>%s</PRE>" % emsg)
-    json_str = json.dumps({'html': html, 
+            html = "<P>No data returned by query.</P>"
+    except (psycopg2.Error, ValueError) as emsg:
+        # a query refused by the tool, not able to connect or other DB error (including a timeout or
+        # cancellation, or an attempt to write) - give warning message
+        html = ("<P style='font-weight: bold; color: red;'>Data query error:</P><BR><PRE>%s</PRE>" % escape(emsg))
+    return {'html': html, 
         'rec_from' : record_counter['from'],
         'rec_to' : record_counter['to'],
         'rec_by' : record_counter['by'],
-        'rec_total' : record_counter['total']})          
-    return json_str
-   
+        'rec_total' : record_counter['total'],
+        'rec_estimated' : record_counter['estimated']}
 
 def logTempUser(sid, ip):
     """
@@ -453,23 +651,16 @@ def error_page(msg, lgin=0, debug=''):
     # return HTML for page
     return html
     
-def sendMail(fro, to, subject, text, server="localhost"):
-    msg = "From: %s\r\nTo: %s\r\nDate: %s\r\nSubject: %s\r\n\r\n%s" %  \
-        (fro, to, formatdate(localtime=True), subject, text)
-    smtp = SMTP()  
-    smtp.set_debuglevel(1)
-    smtp.connect()  
-    smtp.sendmail(fro, to, msg)
-    smtp.close()
-    
 def getCursor():
     # returns a database cursor for db 'trasepad'
     # get a connection object for trasepad
     db = dbauth.dbconn()
+    dbtrace.connection_opened()
     # make sure autocommit turned on
     db.autocommit = True
     # create PG cursor with dictionary keys for field names             
-    cur = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    # (TracingCursor is a DictCursor that also records timings, see dbtrace.py)
+    cur = db.cursor(cursor_factory=dbtrace.TracingCursor)
     return cur    
    
 def session_id():
@@ -583,7 +774,7 @@ def SCTN_sys(sid, environ):
     <SCRIPT src='js/sctn.js'></SCRIPT>
     <SCRIPT src='js/cookies.js'></SCRIPT>
     """
-    html = HTML_header(title="SCTN Meta-database Tool", extras=jslib)
+    html = HTMLBuffer(HTML_header(title="SCTN Meta-database Tool", extras=jslib))
     debug = ""
     # get post data 
     postFields = getPostFields(environ)
@@ -618,7 +809,7 @@ def SCTN_list(sid):
     <TBODY>
     """
     global scriptnm
-    html = hdr % (scriptnm,sid)
+    html = HTMLBuffer(hdr % (scriptnm,sid))
     # open database connection
     qry = getCursor()
     # get the list of platforms
@@ -629,9 +820,8 @@ def SCTN_list(sid):
     # create HTML for each row
     for row in rows:               
         html += "<TR>" 
-        html += "<TD>%s</TD>" % row['platid']
-        html += "<TD>%s</TD>" % row['platname']
-        html += "<TD><A href=\"%s\" target=_blank>%s</TD>" % (row['platurl'], row['platurl'])
+        html.cells((row['platid'], row['platname']))
+        html += "<TD><A href=\"%s\" target=_blank>%s</TD>" % (escape(row['platurl']), escape(row['platurl']))
         if row['sheetid'] is None:
             # no data - don't show button
             html += "<TD>&nbsp;</TD>"    
@@ -653,7 +843,8 @@ def SCTN_form(platid, sid):
     pname = flds['platname']
     purl = flds['platurl']
     global scriptnm
-    html = """
+    html = HTMLBuffer()
+    html += """
     <TABLE style="width: 1000px;">
         <TR><TD>Survey details for <B>%(NAME)s</B></TD>
             <TD><A href="%(URL)s" target=_blank>%(URL)s</A></TD>
@@ -739,28 +930,8 @@ def SCTN_form(platid, sid):
     html += "</TBODY></TABLE>"     
     return html
 
-def SCTN_tool(sid, environ=None):
-    """
-    Implements the SCTN tool.
-    - sid is session ID, used to related linked calls and recall session data
-    - environ contains GET, POST and other environment data per WSGI specs.
-      If this is None (not supplied) the basic Data Tool page is displayed.
-    """
-    # retrieve POST data if applicable
-    if environ is not None:
-        postFields = getPostFields(environ)
-    else:
-        # no post data 
-        postFields = None
-    # set default columns if nothing selected
-    if postFields is None or len(postFields)==0:    
-        # set postFields to some default columns
-        postFields = {'C1': ['1'],'C3': ['1'],'C5': ['1'],'C6': ['1'],'C8': ['1'],'C10': ['1']}   
-    # HTML for debugging info - left blank if none
-    debug = ""
-    global scriptnm   # *** this needs to be changed, globals inhibit modularization
-    # HTML for the page header
-    header = """
+# page header for the SCTN directory (SCTN_tool), parsed once when the module is loaded (see htmltpl.py)
+sctn_header = Template("""
     <!DOCTYPE html>
     <HTML>
     <HEAD>
@@ -785,15 +956,38 @@ def SCTN_tool(sid, environ=None):
         <BUTTON id=btnData onclick="toggleButton(2)">Columns</BUTTON><SMALL>&nbsp;&nbsp;Select feature columns to include in table</SMALL>
         <!-- <BUTTON class="sctn" id="btnStats" onclick="toggleButton(3)">Stats</Button> -->
     </TR></TABLE>    
-    <FORM action="%s?m=sctndd&u=%s" method=POST>
-    """ % (scriptnm, sid)
-    html = header
+    <FORM action="%(APP)s?m=sctndd&u=%(SID)s" method=POST>
+    """)
+
+def SCTN_tool(sid, environ=None):
+    """
+    Implements the SCTN tool.
+    - sid is session ID, used to related linked calls and recall session data
+    - environ contains GET, POST and other environment data per WSGI specs.
+      If this is None (not supplied) the basic Data Tool page is displayed.
+    """
+    # retrieve POST data if applicable
+    if environ is not None:
+        postFields = getPostFields(environ)
+    else:
+        # no post data 
+        postFields = None
+    # set default columns if nothing selected
+    if postFields is None or len(postFields)==0:    
+        # set postFields to some default columns
+        postFields = {'C1': ['1'],'C3': ['1'],'C5': ['1'],'C6': ['1'],'C8': ['1'],'C10': ['1']}   
+    # HTML for debugging info - left blank if none
+    debug = ""
+    global scriptnm   # *** this needs to be changed, globals inhibit modularization
+    # HTML for the page header (see sctn_header above)
+    html = HTMLBuffer(sctn_header.render({'APP': scriptnm, 'SID': sid}))
     # initialise database cursor
     qry = getCursor()
     # ---------------- Filter form layout and query modifers ----------------
     # form heading and table setup.  Form submit comes back here with SID set
     # and data in POST format.  Submit will hid the form.
-    filter_form ="""
+    filter_form = HTMLBuffer()
+    filter_form += """
     <DIV class=sctn-panel id=filterForm>
     <P class=sctn-data-panel>Show only platforms that include the selected features:</P>
     <TABLE class=sctn-data-panel><TR>
@@ -896,7 +1090,8 @@ def SCTN_tool(sid, environ=None):
             alpha_order.append(row['platid'])                        
     # ---------- columns form section : controls columns to be displayed -------------  
     # HTML for heading section of form
-    data_form ="""
+    data_form = HTMLBuffer()
+    data_form += """
     <DIV class="sctn-data-panel" id="dataForm" style="display: none">
     <P style="font-weight: bold; color: #466c13;">Select columns to display:</P>
     """
@@ -973,9 +1168,11 @@ def SCTN_tool(sid, environ=None):
         # platform counters and colours for row backgrounds
         np = 0
         bgnd = ['plainbg','greenbg']   # white, pale green  
-        # get set of rows to process
+        # get set of rows to process, grouped by platform and feature
         qry.execute(sqltext)
-        rows = qry.fetchall()
+        levels = {}
+        for row in qry.fetchall():
+            levels.setdefault((row['platid'], row['fid']), []).append(row)
         # work through rows grouped by platforms
         for platid in alpha_order:
             if platid in platforms:
@@ -994,16 +1191,15 @@ def SCTN_tool(sid, environ=None):
                         # there may be several entries for each fid number  
                         html += "<TD>"                # start table cell
                         br = ""                       # initially no break before line
-                        # scan data set for matching platform and feature id
-                        for row in rows:
-                            if row['fid'] == fid and row['platid']==platid:
-                                if row['flag'] & fidFlags[fid]:
-                                    # use bold text
-                                    html += br + "<B>" + row['ftext'] + "</B>"
-                                else:
-                                    # normal text    
-                                    html += br + row['ftext']
-                                br = "<BR>"  # break before start of next line
+                        # feature levels for this platform and feature id
+                        for row in levels.get((platid, fid), []):
+                            if row['flag'] & fidFlags[fid]:
+                                # use bold text
+                                html += br + "<B>" + row['ftext'] + "</B>"
+                            else:
+                                # normal text    
+                                html += br + row['ftext']
+                            br = "<BR>"  # break before start of next line
                         html += "</TD>"   # end table cell
                 # end of row                
                 html += "</TR>"
@@ -1021,7 +1217,7 @@ def SCTN_tool(sid, environ=None):
 def f500_main(sid, environ):
     # landing page for F500 tool, also handles GET/POSTs to m=f500 in URI
     # get POST data if any and the name of the calling app (dev or exec)
-    postFields = getPostFields(environ)
+    postFields = getFormFields(environ)
    # set default POST values if none given
     if len(postFields)==0:    
         # set postFields to some default columns
@@ -1031,8 +1227,6 @@ def f500_main(sid, environ):
     # name of calling script (exec or dev)
     scriptnm =  environ['SCRIPT_NAME']  
     js = '<SCRIPT src="https://www.gc-dz.com/js/f500.js"></SCRIPT>'
-    # heading section of page
-    html = HTML_header(css="f500", extras=js, width=1000, menulink=(sid, scriptnm), module="f500")
     # get setting of update button (True if clicked, False otherwise)
     update_btn = postFields.get('Update',[''])[0] == 'Update'
     # set default data values for controls
@@ -1056,9 +1250,21 @@ def f500_main(sid, environ):
         if qry.rowcount>0:
             flds = qry.fetchone()
             dd = flds['ddinfo']
-    # HTML for form heading       
+    # listings have an ETag from the versions of the data they show, the settings and the session, so
+    # are not built again if the browser's copy is current (see httpcache.py).  Not the Company Linking
+    # Tool, which also shows the latest link suggestions
+    etag = None
+    if update_btn and dd['LISTOPT'] != '2':
+        etag = httpcache.make_etag('f500', sid, sorted(dd.items()), httpcache.listing_versions(qry))
+        reply = httpcache.check(environ, etag)
+        if reply is not None:
+            return reply
+    # heading section of page
+    html = HTMLBuffer(HTML_header(css="f500", extras=js, width=1000, menulink=(sid, scriptnm), module="f500"))
+    # HTML for form heading (sent by GET, so the listing can be checked against its ETag when reloaded)
     html += """
-        <FORM action="%(APP)s?m=f500&u=%(SID)s" method=POST>
+        <FORM action="%(APP)s" method=GET>
+        <INPUT type=hidden name=m value=f500><INPUT type=hidden name=u value=%(SID)s>
         <DIV id=colist></DIV>
         """ % {'APP': scriptnm, 'SID': sid}
     # year selector
@@ -1114,7 +1320,8 @@ def f500_main(sid, environ):
             comlist = qry.fetchall()
             commodities = makeKeylist(comlist, 'cid')            
             # create table headings
-            tbl = """<FORM action="%(APP)s?m=f500a&u=%(SID)s" method=POST>
+            tbl = HTMLBuffer("""<FORM action="%(APP)s" method=GET>
+                <INPUT type=hidden name=m value=f500a><INPUT type=hidden name=u value=%(SID)s>
                 <INPUT type="hidden" name="FileID" id="fileid" value=0>
                 <TABLE class=company-list><TR>
                 <TH style="width: 50px">Type</TH>
@@ -1122,7 +1329,7 @@ def f500_main(sid, environ):
                 <TH style="width: 250px">Company Name</TH>
                 <TH style="width: 50px">File ID</TH>
                 <TH style="width: 75px">Total</TH>
-                """ % {'APP': scriptnm, 'SID': sid}
+                """ % {'APP': scriptnm, 'SID': sid})
             # commodity headings    
             for (cid, data) in commodities.items():
                 tbl +=  "<TH style='width: 75px'>%s</TH>" % data['commodity']
@@ -1134,10 +1341,7 @@ def f500_main(sid, environ):
                 # click on row to get assessment page
                 tbl += "<TR onclick='getCoAss(%s)'>" % flid
                 # company type, year, name and file ID
-                tbl += "<TD>%s</TD>" % co['cotype']
-                tbl += "<TD>%s</TD>" % co['ayear']
-                tbl += "<TD>%s</TD>" % co['coname']
-                tbl += "<TD>%s</TD>" % flid
+                tbl.cells((co['cotype'], co['ayear'], co['coname'], flid))
                 # total score - applicable to all types
                 key = '%s+0' % flid
                 # check key value OK
@@ -1149,8 +1353,8 @@ def f500_main(sid, environ):
                             # get score for this company and commodity
                             key = '%s+%s' % (flid, cid)
                             assd = score_lookup[key]['assd']
-                            # check if it was assessed (YES or 1)
-                            if re.search('yes|1', str(assd), re.I):
+                            # check if it was assessed (YES or 1, or true as set by scoring.py)
+                            if re.search('yes|1|true', str(assd), re.I):
                                 tbl += HTML_score_td(score_lookup[key]['score'])
                             else:
                                 tbl += "<TD class=center>-</TD>"             # not assessed - hyphen/dash
@@ -1163,15 +1367,46 @@ def f500_main(sid, environ):
                 # end of row               
                 tbl += "</TR>"
         elif dd['LISTOPT'] == '2': 
+            # scorer for companies already linked to a unique company ID, to suggest links for the rest
+            scorer = universe_index_get(qry)['linked']
+            # stored suggestions from the last link suggestion job (see colink.py)
+            suggestions = colink.get_suggestions(qry)
             # query format for grouping tool  ----- to be amended --------
             query = """SELECT a.cotype, a.ayear, a.coname, c.main, a.flid, c.ucid  FROM f500.company_file AS a 
                 LEFT JOIN f500.coflids AS c USING (flid) %s ORDER BY 1, 3, 2  """ % where
             # get company details
             qry.execute(query)
+            rows = qry.fetchall()
+            # unlinked files without a stored suggestion are shown the linked company with the most similar
+            # name, if any, all scored together
+            unlinked = [row for row in rows if row['ucid'] is None and row['coname'] is not None 
+                and row['flid'] not in suggestions]
+            nearest = dict(zip([row['flid'] for row in unlinked], 
+                coscore.best_all(scorer, [row['coname'] for row in unlinked], 0.8)))
             # create table headings
-            tbl = """<FORM action="%(APP)s?m=f500a&u=%(SID)s" method=POST>
+            tbl = HTMLBuffer()
+            tbl += """<FORM action="%(APP)s" method=GET>
+                <INPUT type=hidden name=m value=f500a><INPUT type=hidden name=u value=%(SID)s>
                 <INPUT type="hidden" name="FileID" id="fileid" value=0>
-                <TABLE class=company-list style="width: 800px"><TR>
+                <P><INPUT type=button value="Suggest links" onclick="colinkSuggest()" 
+                    title="run a background job to propose company groupings from names">
+                <INPUT type=button value="Apply ticked suggestions" onclick="colinkApply()" 
+                    title="link all ticked files to their suggested company IDs">
+                <SPAN id=colink-msg></SPAN></P>
+                <SCRIPT>
+                function colinkSuggest() {
+                    $.post('%(APP)s', {action: 'f500.colinkSuggest', sessid: '%(SID)s'}, function(reply) {
+                        $('#colink-msg').html(reply.msg);
+                    }, 'json');
+                }
+                function colinkApply() {
+                    var sugids = $('.colink-sugg:checked').map(function() { return this.value; }).get();
+                    $.post('%(APP)s', {action: 'f500.colinkApply', sessid: '%(SID)s', sugids: sugids.join(',')}, function(reply) {
+                        $('#colink-msg').html(reply.msg);
+                    }, 'json');
+                }
+                </SCRIPT>
+                <TABLE class=company-list style="width: 950px"><TR>
                 <TH style="width: 50px">Type</TH>
                 <TH style="width: 50px">Year</TH>
                 <TH style="width: 350px">Company Name</TH>
@@ -1181,9 +1416,10 @@ def f500_main(sid, environ):
                 <TH style="width: 75px">Use</TH>
                 <TH style="width: 75px">Link</TH>
                 <TH style="width: 75px">Unlink</TH>
+                <TH style="width: 150px">Suggestion</TH>
                 </TR>""" % {'APP': scriptnm, 'SID': sid}
             # create table body
-            for row in qry:
+            for row in rows:
                 # unique company id set to empty string if undefined
                 ucid = str(row['ucid']) if row['ucid'] is not None else ''
                 flid = str(row['flid'])
@@ -1191,8 +1427,7 @@ def f500_main(sid, environ):
                 tbl += "<TR>"
                 # company type, year, company name
                 tbl += "<TD title='supply chain company(CO) or financial institution/investor(FI)'>%s</TD>" % row['cotype']
-                tbl += "<TD>%s</TD>" % row['ayear']
-                tbl += "<TD>%s</TD>" % row['coname']
+                tbl.cells((row['ayear'], row['coname']))
                 # checkbox for 'main' name, ticked if main is True, calls clickMain in f500.js when changed
                 chk = 'checked' if row['main'] else ''
                 tbl += """<TD title='tick if preferred name' style="text-align:center">
@@ -1212,6 +1447,18 @@ def f500_main(sid, environ):
                     title='click to link to main co.'></TD>""" % flid
                 tbl += """<TD style='text-align:center'><INPUT type=button class=tiny onclick='unlinkButton(%s)' 
                     title='click to unlink from main co.'></TD>""" % flid                 
+                # suggested link from the last suggestion job, with a checkbox to accept it, or else for  
+                # unlinked files, the linked company with the most similar name, if any
+                tbl += "<TD title='suggested company ID (confidence)' style='text-align:right'>"
+                if row['flid'] in suggestions:
+                    sugg = suggestions[row['flid']]
+                    target = sugg['ucid_proposed'] if sugg['ucid_proposed'] is not None else "new-%s" % sugg['cluster']
+                    tbl += "%s (%.2f) <INPUT type=checkbox class=colink-sugg value=%s %s>" \
+                        % (target, sugg['score'], sugg['sugid'], 'checked' if sugg['score'] >= 0.95 else '')
+                elif nearest.get(row['flid']) is not None:
+                    (score, co) = nearest[row['flid']]
+                    tbl += "<SPAN title='%s'>%s (%.2f)</SPAN>" % (HTML_clean(co['coname']), co['ucid'], score)
+                tbl += "</TD>"
                 tbl += "</TR>"
         elif dd['LISTOPT'] == '3': 
             # query format with file names
@@ -1221,7 +1468,8 @@ def f500_main(sid, environ):
             # get company details
             qry.execute(query)
             # create table headings
-            tbl = """<FORM action="%(APP)s?m=f500a&u=%(SID)s" method=POST>
+            tbl = HTMLBuffer("""<FORM action="%(APP)s" method=GET>
+                <INPUT type=hidden name=m value=f500a><INPUT type=hidden name=u value=%(SID)s>
                 <INPUT type="hidden" name="FileID" id="fileid" value=0>
                 <TABLE class=company-list><TR>
                 <TH style="width: 50px">Type</TH>
@@ -1230,13 +1478,14 @@ def f500_main(sid, environ):
                 <TH style="width: 50px">File ID</TH>
                 <TH style="width: 350px">Filename</TH>
                 <TH style="width: 100px">Last Update</TH>
-                </TR>""" % {'APP': scriptnm, 'SID': sid}        
+                </TR>""" % {'APP': scriptnm, 'SID': sid})
+            if dd['AYEAR'] > '0' and dd['AYEAR'].isdigit():
+                # the files listed for a year can be exported together
+                html += HTML_xlexport_button(sid, "Export %s workbooks" % dd['AYEAR'],
+                    "ayear: %s, cotype: '%s'" % (int(dd['AYEAR']), dd['COTYPE'] if dd['COTYPE'] in ('CO', 'FI') else ''))
             # create table body
             for row in qry:
-                tbl += "<TR onclick='getCoAss(%s)'>" % row['flid']
-                for col in row:
-                    tbl += "<TD>%s</TD>" % col
-                tbl += "</TR>"
+                tbl.row(row, "onclick='getCoAss(%s)'" % row['flid'])
         elif dd['LISTOPT'] == '4': 
             # 2019 assessments
             query = """SELECT d.cotype, d.ayear, x.coname, x.flid, s.status, DATE(s.lastupd), u.email FROM f500.xlcohdr AS x 
@@ -1249,7 +1498,7 @@ def f500_main(sid, environ):
             # get company details
             qry.execute(query)
             # create table headings
-            tbl = """<FORM action="%(APP)s?m=f500b&u=%(SID)s" method=POST>
+            tbl = HTMLBuffer("""<FORM action="%(APP)s?m=f500b&u=%(SID)s" method=POST>
                 <INPUT type="hidden" name="FileID" id="fileid" value=0>
                 <TABLE class=company-list><TR>
                 <TH style="width: 50px">Type</TH>
@@ -1259,13 +1508,10 @@ def f500_main(sid, environ):
                 <TH style="width: 150px">Status</TH>
                 <TH style="width: 100px">Last Updated</TH>
                 <TH style="width: 150px">By</TH>
-                </TR>""" % {'APP': scriptnm, 'SID': sid}        
+                </TR>""" % {'APP': scriptnm, 'SID': sid})
             # create table body
             for row in qry:
-                tbl += "<TR onclick='getCoAss(%s)'>" % row['flid']
-                for col in row:
-                    tbl += "<TD>%s</TD>" % col
-                tbl += "</TR>"
+                tbl.row(row, "onclick='getCoAss(%s)'" % row['flid'])
         elif dd['LISTOPT'] == '5': 
             # commodity checkboxes
             qry.execute("select cid, commodity from f500.commodities where cid>0 order by cid")
@@ -1276,7 +1522,8 @@ def f500_main(sid, environ):
             qry.execute(query)
             rows = qry.fetchall()
             # create table headings
-            tbl = """<FORM action="%(APP)s?m=f500b&u=%(SID)s" method=POST>
+            tbl = HTMLBuffer()
+            tbl += """<FORM action="%(APP)s?m=f500b&u=%(SID)s" method=POST>
                 <INPUT type=hidden id=sessionid name=sessionid value=%(SID)s>
                 <TABLE class=company-list><TR>
                 <TH style="width: 50px">Type</TH>
@@ -1285,15 +1532,34 @@ def f500_main(sid, environ):
                 <TH style="width: 50px">File ID</TH>
                 """ % {'APP': scriptnm, 'SID': sid}
             for cd in cdlist:
-                tbl += "<TH class=commodities>%s</TH>" % cd['commodity']
+                # heading with buttons to tick or clear the whole column in one request (see comColumn)
+                tbl += """<TH class=commodities>%(NAME)s<BR><SMALL>
+                    <A onclick='comColumn(%(CID)s, 1)' title='tick all listed'>all</A>
+                    <A onclick='comColumn(%(CID)s, 0)' title='clear all listed'>none</A></SMALL></TH>""" \
+                    % {'NAME': cd['commodity'], 'CID': cd['cid']}
             tbl += "</TR>"    
+            tbl += """<SCRIPT>
+            function comColumn(cid, tick) {
+                // sets the checkboxes for commodity 'cid' on all listed companies, with one bulk update 
+                var changes = [];
+                $("INPUT[id^=chk-][id$=-" + cid + "]").each(function() {
+                    if (this.checked != (tick==1)) changes.push([parseInt(this.id.split('-')[1]), cid, tick]);
+                });
+                if (changes.length == 0) return;
+                $.post('%(APP)s', {action: 'f500.comChkBoxBulk', sessid: $('#sessionid').val(), changes: JSON.stringify(changes)}, 
+                    function(reply) {
+                        if (reply.valid == 1) {
+                            for (var i=0; i<changes.length; i++) $('#chk-' + changes[i][0] + '-' + cid).prop('checked', tick==1);
+                        } else {
+                            alert(reply.msg);
+                        }
+                    }, 'json');
+            }
+            </SCRIPT>""" % {'APP': scriptnm}
             # create table body
             for row in rows:
                 tbl += "<TR>"
-                tbl += "<TD>%s</TD>" % row['cotype']
-                tbl += "<TD>%s</TD>" % row['ayear']
-                tbl += "<TD>%s</TD>" % row['coname']
-                tbl += "<TD>%s</TD>" % row['flid']
+                tbl.cells((row['cotype'], row['ayear'], row['coname'], row['flid']))
                 cd = row['commodities']
                 for c in range(len(cdlist)):
                     if c+1 in row['commodities']:
@@ -1313,6 +1579,8 @@ def f500_main(sid, environ):
     # ---- debugging information 
     html += list_debug_info(postFields, debug, show=True)
     html += HTML_footer(environ)
+    if etag is not None:
+        return httpcache.PageReply(html, headers=httpcache.reply_headers(etag))
     return html
 
 def makeKeylist(alist, akey, akey2=''):
@@ -1345,53 +1613,118 @@ def HTML_score_td(score, css_class='center'):
         td = "<TD class=%s>%s</TD>" % (css_class, score)
     return td
         
-def HTML_xlco_search(coname):
-    # search for a name from the 'Companies' list and returns matching files from the 'xlcohdr' table
-    # in an HTML format as part of a form, together with assessment years
-    # (1) tokenise 'coname' into a sequence of name fragments
+# In-memory index of name fragments for the company files in 'xlcohdr', used by HTML_xlco_search().
+# 'frags' holds the precomputed fragments by flid, 'tokens' is an inverted index of fragment -> set of flids,
+# 'blank' lists flids whose names reduce to empty fragments, and 'scorer' is a coscore.py scorer for ranked
+# similarity searches.  The index persists for the life of the WSGI process and is rebuilt whenever the
+# version of its data ('sig', scope 'xlco' of f500.data_versions) changes.
+xlco_index = {'sig': None, 'rows': {}, 'frags': {}, 'tokens': {}, 'blank': []}
+xlco_index_lock = threading.Lock()
+
+def xlco_index_get(qry):
+    # returns the current name index for xlcohdr, rebuilding it first if the data has changed.
+    # qry is an open cursor.  The version of scope 'xlco' is counted by triggers on xlcohdr, filelist
+    # and dirtree (see schema_updates.sql), so any change to a name, file, year or company type
+    # rebuilds the index, and a normal search costs one small query plus dictionary probes
+    global xlco_index
+    qry.execute("SELECT version FROM f500.data_versions WHERE scope='xlco'")
+    row = qry.fetchone()
+    # 0 until the data is first changed, so the index is still built once
+    sig = 0 if row is None else row[0]
+    with xlco_index_lock:
+        if xlco_index['sig'] != sig:
+            qry.execute("""SELECT x.flid, x.coname, f.flname, d.cotype, d.ayear FROM f500.xlcohdr AS x 
+                INNER JOIN f500.filelist AS f ON x.flid=f.flid
+                INNER JOIN f500.dirtree AS d ON d.dtid=f.dtid ORDER BY 1""")
+            index = {'sig': sig, 'rows': {}, 'frags': {}, 'tokens': {}, 'blank': []}
+            for co in qry.fetchall():
+                flid = co['flid']
+                xfrags = name_frags(co['coname'])
+                index['rows'][flid] = co
+                index['frags'][flid] = xfrags
+                # index non-empty fragments only.  Empty ones (from leading/trailing spaces) would 
+                # otherwise point at nearly every file
+                keys = [t for t in set(xfrags) if t > '']
+                for t in keys:
+                    index['tokens'].setdefault(t, set()).add(flid)
+                if len(keys) == 0:
+                    index['blank'].append(flid)
+            # vectorised scorer over the same files, in flid order (see coscore.py)
+            index['scorer'] = coscore.build_scorer([index['rows'][flid] for flid in sorted(index['rows'])])
+            # swap in the new index in one step, so other threads never see a partial one
+            xlco_index = index
+        return xlco_index
+
+# Universe of company files for local name matching (see localMatch): 'items' are the rows from
+# namematch.load_universe() and 'index' the namematch.py index of them, and 'linked' is a coscore.py
+# scorer of the files linked to a unique company ID, for the link suggestions of the Company Linking
+# listing.  Kept for the life of the WSGI process like xlco_index, and rebuilt when the versions of the
+# names and files ('xlco') or of the company IDs they are linked to ('links') change
+universe_index = {'sig': None, 'items': [], 'index': None, 'linked': None}
+universe_index_lock = threading.Lock()
+
+def universe_index_get(qry):
+    # returns the current universe for local name matching, rebuilding it first if the data has changed.
+    # qry is an open DictCursor
+    global universe_index
+    qry.execute("SELECT scope, version FROM f500.data_versions WHERE scope IN ('links', 'xlco') ORDER BY 1")
+    sig = tuple((row['scope'], row['version']) for row in qry.fetchall())
+    with universe_index_lock:
+        if universe_index['sig'] != sig:
+            items = namematch.load_universe(qry)
+            universe_index = {'sig': sig, 'items': items, 'index': namematch.build_index(items),
+                'linked': coscore.build_scorer([co for co in items if co['ucid'] is not None])}
+        return universe_index
+
+def xlco_index_lookup(coname, index=None):
+    # returns a list of xlcohdr rows (flid, coname, flname, cotype, ayear) whose names are equivalent
+    # to 'coname' according to name_frags_equiv(), in flid order.
+    # Equivalence requires all fragments of the shorter name to occur in the longer, so any match
+    # must share a non-empty fragment with 'coname' or have none at all (the 'blank' list).
+    # Candidates are therefore the union of the inverted index entries for the search fragments. 
+    # 'index' is the result of xlco_index_get(), fetched here if not given
     cofrags = name_frags(coname)
-    # (2) retrieve xlcohdr table
-    qry = getCursor()
-    qry.execute("""SELECT x.flid, x.coname, f.flname, d.cotype, d.ayear FROM f500.xlcohdr AS x 
-        INNER JOIN f500.filelist AS f ON x.flid=f.flid
-        INNER JOIN f500.dirtree AS d ON d.dtid=f.dtid ORDER BY 1""")
-    # convert query results into a list
-    colist = qry.fetchall()
-    # initialise the list of matches
+    if index is None:
+        index = xlco_index_get(getCursor())
+    keys = [t for t in set(cofrags) if t > '']
+    if len(keys) > 0:
+        cands = set(index['blank'])
+        for t in keys:
+            cands.update(index['tokens'].get(t, ()))
+    else:
+        # nothing to narrow the search with - check every file
+        cands = index['frags'].keys()
     comatch = []
-    # scan the list of names looking for matches
-    for co in colist:
-        # convert company name in list into fragments
-        xfrags = name_frags(co['coname'])
-        # if the names are 'equivalent', add the details to the list of matches
-        if name_frags_equiv(cofrags, xfrags):
-            comatch.append(co)
+    for flid in sorted(cands):
+        if name_frags_equiv(cofrags, index['frags'][flid]):
+            comatch.append(index['rows'][flid])
+    return comatch
+
+def HTML_xlco_search(coname, threshold=0.6):
+    # search for a name from the 'Companies' list and returns matching files from the 'xlcohdr' table
+    # in an HTML format as part of a form, together with assessment years
+    # Files with 'equivalent' names are found via the in-memory fragment index (see xlco_index_lookup),
+    # followed by other files whose names have a TF-IDF similarity score of at least 'threshold'
+    index = xlco_index_get(getCursor())
+    comatch = xlco_index_lookup(coname, index)
+    scorer = index['scorer']
+    scores = coscore.score_all(scorer, coname)
+    # item number of each file in the scorer, to look up scores of the equivalent names
+    flids = [co['flid'] for co in scorer['items']]
+    position = dict((flid, n) for (n, flid) in enumerate(flids))
+    found = [(float(scores[position[co['flid']]]), co) for co in comatch]
+    found.sort(key=lambda f: -f[0])
+    equiv = set(co['flid'] for co in comatch)
+    found += [(score, co) for (score, co) in coscore.ranked(scorer, coname, threshold, limit=50) if co['flid'] not in equiv]
     # create an HTML table with the data
-    # --- this will be enhanced later ---
-    html = "<TABLE class=cohdr><TR><TH>Year</TH><TH>Company Name</TH><TH>File ID</TH><TH>File</TH></TR>"
-    for co in comatch:
-        html += "<TR><TD>%s</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD></TR>" \
-            % (co['ayear'], co['coname'], co['flid'], co['flname'])
+    html = "<TABLE class=cohdr><TR><TH>Year</TH><TH>Company Name</TH><TH>File ID</TH><TH>File</TH><TH>Score</TH></TR>"
+    for (score, co) in found:
+        html += "<TR><TD>%s</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD><TD>%.2f</TD></TR>" \
+            % (co['ayear'], co['coname'], co['flid'], co['flname'], score)
     # finish off table
     html += "</TABLE>"
     return html        
 
-def name_frags(name):
-    # splits a name into standardised fragments and returns them as a sequence
-    nm = name.lower()                           # convert to lower case
-    nm = re.sub('\.xls[x|m]\s*$','', nm)        # remove .xlsx or .xlsm at end of string
-    nm = unidecode.unidecode(nm)                # clean up accented characters
-    nm = re.sub('[^\sa-z]', ' ', nm)             # remove anything else that is not a letter, whitespace or hyphen  
-    nm = re.sub(r'(?<![a-z])([a-z])\s(?![a-z]{2})', r'\1', nm)     # merge any single letters together
-    #list of words that are to be removed
-    stopwords = ['ltd', 'co', 'group', 'sa', 'inc', '&', 'holdings', 'and', 'corp', 'pt', 'international', 'de', \
-                'the', 'corporation', 'y', 'plc', 'of', 'limited', 'grupo', 'ag', 'as', 'j', 'ooo', 'company', 'holding', 'i', 'gmbh']
-    for sw in stopwords:
-        rgx = "(^|[ ])%s($|[ ])" % sw           
-        nm = re.sub(rgx,' ', nm)                # filter out unwanted words 
-    nm = re.split('\s+', nm)                    # split at word boundaries
-    return nm
-
 def name_frags_equiv(frags1, frags2):
     # returns True if the two lists share tokens in the same order
     # if there is more than 1 token, than 1 less than the total can match
@@ -1484,20 +1817,86 @@ def f500_colink_ajax(mode, flid, ucid=0):
     #raise RuntimeError(qry.query)
     qry.connection.commit()
 
+def f500_colink_bulk(sessid, changes):
+    # bulk version of f500_colink_ajax() for the Company Linking Tool.  'changes' is a list of
+    # (mode, flid, ucid) with the same modes as f500_colink_ajax.  The session permission is checked
+    # once, and all changes are made with two set-based UPDATEs in one transaction.  Where a file
+    # has several changes to the same field, the last one applies.  Returns the reply dictionary
+    reply = f500_edit_check(sessid)
+    if reply['valid'] != 1:
+        return reply
+    # final 'main' flag and ucid for each file
+    main = {}
+    ucids = {}
+    for (mode, flid, ucid) in changes:
+        if mode==1 or mode==4:
+            main[flid] = (mode==1)
+        elif mode==2 or mode==3:
+            ucids[flid] = ucid if mode==2 else None
+        else:
+            raise RuntimeError("Invalid link mode (%s)" % mode)
+    qry = getCursor()
+    db = qry.connection
+    db.autocommit = False
+    try:
+        if len(main) > 0:
+            qry.execute("""UPDATE f500.coflids AS c SET main=v.main FROM unnest(%s::INT[], %s::BOOLEAN[]) AS v(flid, main)
+                WHERE c.flid=v.flid""", (list(main.keys()), list(main.values())))
+        if len(ucids) > 0:
+            qry.execute("""UPDATE f500.coflids AS c SET ucid=v.ucid FROM unnest(%s::INT[], %s::INT[]) AS v(flid, ucid)
+                WHERE c.flid=v.flid""", (list(ucids.keys()), list(ucids.values())))
+        db.commit()
+        reply['count'] = len(changes)
+    except Exception as e:
+        db.rollback()
+        # give traceback and diagnostics
+        reply['msg'] = str(e)
+        reply['debug'] = "<PRE>\n" + traceback.format_exc() + "\n</PRE>"
+        reply['valid'] = 0
+    return reply
+
 def f500_comChkBox_ajax(sessid, flid, cid, tick):
+    # single commodity checkbox update - see f500_comChkBox_bulk()
+    return f500_comChkBox_bulk(sessid, [(flid, cid, tick)])
+
+def f500_comChkBox_bulk(sessid, changes):
+    # updates the commodity checkboxes (table comtraders) for a list of changes (flid, cid, tick).
+    # If tick is 1, the commodity is added for the company file, if 0 it is deleted.  Where a checkbox
+    # has several changes, the last one applies, as in f500_colink_bulk().  The session permission is
+    # checked once, and all changes are made with one INSERT and one DELETE in a single transaction.
+    # Returns the reply dictionary, with 'count' the number of changes made if valid
     reply = f500_edit_check(sessid)
     if reply['valid'] == 1:
         qry = getCursor()
+        db = qry.connection
+        db.autocommit = False
         try:
-            # if tick is 1, add commodity to table comtraders, if 0 delete it
-            if tick==1:
-                qry.execute("INSERT INTO f500.comtraders (flid, cid) VALUES(%s, %s) ON CONFLICT DO NOTHING", (flid, cid))
-            elif tick==0:    
-                qry.execute("DELETE FROM f500.comtraders WHERE flid=%s AND cid=%s", (flid, cid))
-            else:
-                raise RuntimeError("Invalid tick value (%s)" % tick) 
-            qry.connection.commit()      
+            # final tick for each checkbox
+            ticks = {}
+            for (flid, cid, tick) in changes:
+                if tick!=1 and tick!=0:
+                    raise RuntimeError("Invalid tick value (%s)" % tick) 
+                ticks[(flid, cid)] = tick
+            adds = ([], [])
+            drops = ([], [])
+            for ((flid, cid), tick) in ticks.items():
+                # if tick is 1, add commodity to table comtraders, if 0 delete it
+                if tick==1:
+                    adds[0].append(flid)
+                    adds[1].append(cid)
+                else:    
+                    drops[0].append(flid)
+                    drops[1].append(cid)
+            if len(drops[0]) > 0:
+                qry.execute("""DELETE FROM f500.comtraders AS t USING unnest(%s::INT[], %s::INT[]) AS d(flid, cid) 
+                    WHERE t.flid=d.flid AND t.cid=d.cid""", drops)
+            if len(adds[0]) > 0:
+                qry.execute("""INSERT INTO f500.comtraders (flid, cid) SELECT DISTINCT * FROM unnest(%s::INT[], %s::INT[]) 
+                    ON CONFLICT DO NOTHING""", adds)
+            db.commit()
+            reply['count'] = len(changes)
         except Exception as e:
+            db.rollback()
             # give traceback and diagnostics
             reply['msg'] = str(e)
             reply['debug'] = "<PRE>\n" + traceback.format_exc() + "\n</PRE>"
@@ -1531,17 +1930,25 @@ def cmatch_tool(module, sid, environ):
         dd['CLIST'] = postFields.get('clist',[''])[0]
         dd['TRASE_CHK'] = 'checked' if postFields['search_opt'][0] == 'trase' else ''
         dd['INFO_CHK'] = 'checked' if postFields['search_opt'][0] == 'info' else ''
+        dd['LOCAL_CHK'] = 'checked' if postFields['search_opt'][0] == 'local' else ''
         qry.execute("""INSERT INTO gcdz.def_data (sessionid, ddtag, ddinfo) VALUES (%(SID)s, 'cmatch', %(DD)s)   
             ON CONFLICT ON CONSTRAINT defdata_pk DO UPDATE SET ddinfo= %(DD)s 
             """, {'SID': sid, 'DD': json.dumps(dd)}) 
         # get list of names to check, method, and output format
         nmlist =  re.split(r'\r\n', dd['CLIST'])
         chktype =  postFields['search_opt'][0]
-        # results of name check are returned as HTML
-        html_out = nameCheck(nmlist, chktype)
+        # the name check is run as a background job (see cmatch_job), and the page polls for results
+        jobid = jobs.submit_job(qry, sid, 'cmatch', {'nmlist': nmlist, 'chktype': chktype})
+        html_out = HTML_job_panel(jobid, sid, scriptnm)
     else: 
-        # no output yet
-        html_out = ""            
+        params = cgi.parse_qs(environ['QUERY_STRING']) 
+        jobid = int(params.get('job', ['0'])[0])
+        if jobid > 0:
+            # show progress or results of an earlier job
+            html_out = HTML_job_panel(jobid, sid, scriptnm)
+        else:
+            # no output yet, just list recent jobs
+            html_out = HTML_job_list(qry, sid, scriptnm, 'cmatch')
         # retrieve default values if GO was not clicked (as on first entry to this tool)
         qry.execute("SELECT sessionid AS sid, ddtag, ddinfo FROM gcdz.def_data WHERE sessionid=%s AND ddtag='cmatch'", (sid,))
         # defaults found, retrieve them to local variables
@@ -1560,14 +1967,16 @@ def cmatch_tool(module, sid, environ):
             <BR>&nbsp;<BR>
             <U>Method</U><BR>
             <INPUT type="radio" value="trase" name="search_opt" %(TRASE_CHK)s>&nbsp;&nbsp;Match to names in trase<BR>
-            <INPUT type="radio" value="info" name="search_opt" %(INFO_CHK)s>&nbsp;&nbsp;Get company info and links
+            <INPUT type="radio" value="info" name="search_opt" %(INFO_CHK)s>&nbsp;&nbsp;Get company info and links<BR>
+            <INPUT type="radio" value="local" name="search_opt" %(LOCAL_CHK)s>&nbsp;&nbsp;Match to Forest 500 companies (local)
             <BR>&nbsp;<BR>
             <INPUT type="submit" name="Search" value="Go" onclick="$('#wait_msg').css('display','block')">
         </TD><TD>
     </TR></TABLE>
     <P id=wait_msg>Please wait : Fetching data...</P>
     </FORM>        
-    """ % {'SCRIPT': scriptnm, 'SID': sid, 'CLIST': dd['CLIST'], 'TRASE_CHK': dd['TRASE_CHK'], 'INFO_CHK': dd['INFO_CHK']}
+    """ % {'SCRIPT': scriptnm, 'SID': sid, 'CLIST': dd['CLIST'], 'TRASE_CHK': dd['TRASE_CHK'], 'INFO_CHK': dd['INFO_CHK'],
+        'LOCAL_CHK': dd.get('LOCAL_CHK', '')}
     # add output results to page
     html += html_out
     # ---- debugging information 
@@ -1575,6 +1984,90 @@ def cmatch_tool(module, sid, environ):
     html += HTML_footer(environ)
     return html
 
+def cmatch_job(params, progress):
+    # background job handler for cmatch_tool(), run by a worker process (see jobs.py).
+    # params has the list of names 'nmlist' and the check type 'chktype'.  Names are checked in
+    # batches, with the count of names checked saved after each, and the result saved once at the end
+    # (saving the results so far after each batch wrote them all to the jobs table again every time)
+    nmlist = [nm for nm in params['nmlist'] if re.search('\w+', nm) is not None]
+    chktype = params['chktype']
+    # local matching is fast, so use bigger batches
+    batch = 1000 if chktype == 'local' else 50
+    html = HTMLBuffer()
+    progress(0, len(nmlist))
+    for i in range(0, len(nmlist), batch):
+        names = nmlist[i:i+batch]
+        if chktype == 'local':
+            html += localMatch(names)
+        else:    
+            html += nameCheck(names, chktype)
+        progress(i + len(names), len(nmlist))
+    return html.text()
+
+def HTML_job_panel(jobid, sid, scriptnm):
+    # returns HTML for the progress and results of a background job (see jobs.py).  The page
+    # polls the Ajax action 'jobs.status' every 2 seconds, shows the progress, and the results when
+    # the job has saved them
+    html = """
+    <P id=job-status>Job %(JOB)s submitted...</P>
+    <DIV id=job-result></DIV>
+    <SCRIPT>
+    function pollJob() {
+        $.post('%(SCRIPT)s', {action: 'jobs.status', jobid: %(JOB)s, sessid: '%(SID)s'}, function(reply) {
+            if (!('status' in reply)) {
+                // error report from the Ajax handler
+                $('#job-status').html(reply.html);
+                return;
+            }
+            var msg = 'Job ' + reply.jobid + ' ' + reply.status;
+            if (reply.total > 0) msg += ' : ' + reply.progress + ' of ' + reply.total + ' names';
+            $('#job-status').text(msg);
+            if (reply.result) $('#job-result').html(reply.result);
+            if (reply.status == 'failed') $('#job-result').html('<PRE>' + reply.error + '</PRE>');
+            if (reply.status == 'queued' || reply.status == 'running') setTimeout(pollJob, 2000);
+        }, 'json');
+    }
+    $(document).ready(function() { $('#wait_msg').css('display','none'); pollJob(); });
+    </SCRIPT>
+    """ % {'JOB': jobid, 'SID': sid, 'SCRIPT': scriptnm}
+    return html
+
+def HTML_job_list(qry, sid, scriptnm, kind):
+    # returns HTML listing recent background jobs of type 'kind' for this user, with links to the results
+    joblist = jobs.list_jobs(qry, sid, kind)
+    if len(joblist) == 0:
+        return ""
+    html = "<P><SMALL>Recent jobs:</SMALL></P><TABLE class=company-list><TR><TH>Job</TH><TH>Submitted</TH><TH>Status</TH></TR>"
+    for job in joblist:
+        html += "<TR><TD><A href='%s?m=%s&u=%s&job=%s'>%s</A></TD><TD>%s</TD><TD>%s (%s/%s)</TD></TR>" \
+            % (scriptnm, kind, sid, job['jobid'], job['jobid'], job['created'][:16], job['status'], job['progress'], job['total'])
+    html += "</TABLE>"
+    return html
+
+# top of the f500 data input page, below the standard header, parsed once when the module is loaded
+# (see htmltpl.py).  The hidden fields are for the f500.js routine input_save() to pick up, CONAME is the
+# HTML for the company name control (not escaped), and the blank heading row of the indicators table
+# controls fixed column widths (set in CSS, see TR.ind-tbl-H)
+f500_input_header = Template(
+    "<INPUT type=hidden id=fileid name=fileid value=%(FILEID)s>"
+    "<INPUT type=hidden id=sessionid name=sessionid value=%(SID)s>"
+    "<INPUT type=hidden id=scriptnm name=scriptnm value=%(APP)s>"
+    "<SMALL>All edits are tracked and saved as they are made.  </SMALL><BR clear=all>"
+    "%(CONAME)s"
+    """<P style="float: left; padding-left: 300px; padding-right: 20px; font-size: xx-small; 
+        text-align: right">File ID<BR>%(FILEID)s</P>"""
+    """&nbsp;<INPUT type=button value='Close' onclick='window.close()' 
+            style='margin-left: 300 px; margin-top: 10px'><BR clear=all>"""
+    "<TABLE class=ind-tbl>"
+    """<THEAD><TR class=ind-tbl-H>
+        <TH>&nbsp;</TH>
+        <TH>&nbsp;</TH>
+        <TH>&nbsp;</TH>
+        <TH>&nbsp;</TH>
+        <TH>&nbsp;</TH>
+        </TR></THEAD>"""
+    "<TBODY>", raw=('CONAME',))
+
 def f500_input(sid, environ):
     # handles direct input of Forest 500 assessment to database
     # --- note: this originally copied and modifed from f500_assess() procedure ---
@@ -1602,7 +2095,7 @@ def f500_input(sid, environ):
     # get company details and construct page heading    
     co = qry.fetchone()
     title = "Forest 500 Data Input %s : %s" % (co['ayear'], co['coname'])
-    html =  HTML_header(title, width=1000, css="f500", extras=js, menulink = (sid, scriptnm))
+    html =  HTMLBuffer(HTML_header(title, width=1000, css="f500", extras=js, menulink = (sid, scriptnm)))
     # current year as integer
     cyear = int(co['ayear'])
     # cells used for company headers, years 2014-2019 (0-5), company type CO, FI (0-1) 
@@ -1612,44 +2105,21 @@ def f500_input(sid, environ):
     y = cyear - 2014
     # standard javascript events to go on all INPUT fields, needs cell address for %s
     jslink = "onkeydown='input_key(event, this)' onchange='input_save(this, \"%s\")'" 
-    # these hidden fields are for the f500.js routine input_save() to pick up
-    html += "<INPUT type=hidden id=fileid name=fileid value=%s>" % fileid
-    html += "<INPUT type=hidden id=sessionid name=sessionid value=%s>" % sid
-    html += "<INPUT type=hidden id=scriptnm name=scriptnm value=%s>" % scriptnm
     # if company has not been edited before, update 'viewed' status
     qry.execute("UPDATE f500.survey_status SET statid=1, sessionid=%s, lastupd=now() WHERE flid=%s AND statid in (0, 1)", \
         (sid, fileid))
-    # advisory text at top of page (below header section)
-    html += """<SMALL>All edits are tracked and saved as they are made.  </SMALL>"""  
-    html += "<BR clear=all>"
-    # company name display/edit control
-    html += HTML_input("Company Name", 50, "coname", co['coname'], (jslink % cell_cn[y][t]))
+    # hidden fields, company name display/edit control, file ID, Close button and the heading of the
+    # indicators table (see f500_input_header above)
+    html += f500_input_header.render({'FILEID': fileid, 'SID': sid, 'APP': scriptnm,
+        'CONAME': HTML_input("Company Name", 50, "coname", co['coname'], (jslink % cell_cn[y][t]))})
     # view used to display indicator info 
     # get range of indicator IDs from year and company type indices 
     # (eg 2019 CO, y=5, t=0, (5+1)*10000+(0+1)*1000 = 61000)
     ind_from = (y+1)*10000 + (t+1)*1000
     ind_to =ind_from + 999
-    # display file ID   
-    html += """<P style="float: left; padding-left: 300px; padding-right: 20px; font-size: xx-small; 
-        text-align: right">File ID<BR>%s</P>""" % fileid
-    # action buttons - Close  
-    html += """&nbsp;<INPUT type=button value='Close' onclick='window.close()' 
-            style='margin-left: 300 px; margin-top: 10px'>"""      
-    html += "<BR clear=all>"
     # first indicator group, not commodity specicific
     qry.execute("""SELECT igid, heading FROM f500.ind_groups WHERE ayear=%s AND cotype=%s AND indgrp=1
         """, (co['ayear'], co['cotype']))
-    html += "<TABLE class=ind-tbl>"
-    # this blank row controls fixed column widths (set in CSS, see TR.ind-tbl-H)
-    # bar symbols can be changed to spaces onnce everything is OK
-    html += """<THEAD><TR class=ind-tbl-H>
-        <TH>&nbsp;</TH>
-        <TH>&nbsp;</TH>
-        <TH>&nbsp;</TH>
-        <TH>&nbsp;</TH>
-        <TH>&nbsp;</TH>
-        </TR></THEAD>""" 
-    html += "<TBODY>" 
     # group 1 indicators with heading button
     gp = qry.fetchone()
     name= "IG%s" % gp['igid']
@@ -1833,9 +2303,15 @@ def f500_input_table_ajax(inid, flid, refid=0, cid=0):
 	        FROM f500.assmnt_parts INNER JOIN f500.ind_detail USING (atype) 
             WHERE inid=%(INID)s %(CID)s %(SID)s
             """ % {'INID': inid, 'CID': wh_cid, 'SID': wh_sid}
-        sql = """SELECT atype, ptid, ptlabel, ptype, alist, layout, a.xlcell, xltext 
-            FROM (%s) AS a LEFT JOIN f500.xldata AS x ON a.xlcell=x.xlcell AND x.flid=%s ORDER BY ptid
-        """  % (sql_a, flid)   
+        if xldocs.read_docs:
+            # values from the file's document, one row (see xldocs.py)
+            sql = """SELECT atype, ptid, ptlabel, ptype, alist, layout, a.xlcell, d.cells ->> a.xlcell AS xltext 
+                FROM (%s) AS a LEFT JOIN f500.xldocs AS d ON d.flid=%s ORDER BY ptid
+            """  % (sql_a, int(flid))
+        else:
+            sql = """SELECT atype, ptid, ptlabel, ptype, alist, layout, a.xlcell, xltext 
+                FROM (%s) AS a LEFT JOIN f500.xldata AS x ON a.xlcell=x.xlcell AND x.flid=%s ORDER BY ptid
+            """  % (sql_a, flid)   
         qry.execute(sql)
         rows = qry.fetchall()
         # save query text for debug output if an exception occurs
@@ -1843,7 +2319,7 @@ def f500_input_table_ajax(inid, flid, refid=0, cid=0):
         if qry.rowcount==0:
             raise RuntimeError("Input spec. not defined for this indicator!" )
         # start HTML for input form table
-        tbl = "<TABLE class=ind-sub-tbl>"
+        tbl = HTMLBuffer("<TABLE class=ind-sub-tbl>")
         (rnum, cnum, rspan) = (0, 0, 0)       # row and column counters, end column
         # work through specification rows
         for row in rows:
@@ -1938,6 +2414,7 @@ def f500_input_table_ajax(inid, flid, refid=0, cid=0):
                 tbl += "</TR>"
         # finish HTML table
         tbl += "</TABLE>"
+        tbl = tbl.text()
     except RuntimeError as errMsg:
         debug += "<BR>***%s***" % str(errMsg)
         tbl = debug
@@ -1990,7 +2467,7 @@ def f500_input_ajax(sessid, flid, cell, new_data):
     # check session is open and get permission flag for this user
     reply = f500_edit_check(sessid)
     if reply['valid'] == 1:
-        f500_audit_save(sessid, flid, cell, new_data)
+        f500_rescore_save(reply, sessid, flid, [(cell, new_data)])
         #params = "<P>sessid = %s<BR>flid = %s<BR>cell = %s<BR>new_data = %s</P>" % (sessid, flid, cell, new_data)
         #if 'debug' in reply:
         #    reply['debug'] += params
@@ -2002,6 +2479,11 @@ def f500_input_ajax(sessid, flid, cell, new_data):
 def f500_edit_check(sessid):
     # checks that a session has valid permission to edit the f500 input form
     # returns dictionary (JSON object) with 'valid'=1 if OK, 0 if not.  'msg' gives a message text if not OK.
+    return session_check(sessid, 'f500b')
+
+def session_check(sessid, module):
+    # checks that a session is open and its user is permitted to use 'module' (see gcdz.menus)
+    # returns dictionary (JSON object) with 'valid'=1 if OK, 0 if not.  'msg' gives a message text if not OK.
     qry = getCursor()
     sqlcmd = qry.mogrify("""SELECT permit, email FROM gcdz.logins INNER JOIN gcdz.users USING (userid) 
         WHERE sessionid=%s AND timeout IS NULL""", (sessid,))
@@ -2010,9 +2492,9 @@ def f500_edit_check(sessid):
         msg = "Session ID '%s' is expired or not found" % sessid
         reply = {'valid': 0, 'msg': msg, 'debug': str(sqlcmd)}
     else:
-        # check permit for this user/session is OK for this module (f500b)
+        # check permit for this user/session is OK for this module
         record = qry.fetchone()
-        qry.execute("""SELECT id FROM gcdz.menus WHERE MODULE='f500b' AND (permitflag & %s)>0""", (record['permit'],))
+        qry.execute("""SELECT id FROM gcdz.menus WHERE MODULE=%s AND (permitflag & %s)>0""", (module, record['permit']))
         if qry.rowcount==0:
             reply = {'valid': 0, 'msg': "User '%s' not authorized for this module" % record['email']}
         else:
@@ -2020,11 +2502,12 @@ def f500_edit_check(sessid):
             reply = {'valid': 1}
     return reply
 
-def f500_audit_save(sid, flid, cell, new_data):
+def f500_audit_save(sid, flid, cell, new_data, qry=None):
     # used by data entry routines for forest 500 input form.  Saves data for a cell in xldata
-    # for company identified by fileID
+    # for company identified by fileID.  'qry' is the cursor of the caller's transaction, if any
     # search for cell/flid in xldata
-    qry = getCursor()
+    if qry is None:
+        qry = getCursor()
     qry.execute("""SELECT xlid, xltext FROM f500.xldata WHERE flid=%s AND xlcell=%s""", (flid, cell))
     if qry.rowcount==0:
         # cell-file ID combination not yet in system - add them
@@ -2058,44 +2541,72 @@ def f500_select_ajax(sessid, flid, cell_t, cell_s, optval, opttxt):
     # check session is open and get permission flag for this user
     reply = f500_edit_check(sessid)
     if reply['valid'] == 1:
-        f500_audit_save(sessid, flid, cell_t, opttxt)
-        f500_audit_save(sessid, flid, cell_s, optval)
-        reply['score'] = optval
+        if f500_rescore_save(reply, sessid, flid, [(cell_t, opttxt), (cell_s, optval)]):
+            reply['score'] = optval
     return reply   
 
+def f500_rescore_save(reply, sessid, flid, cells):
+    # saves a list of (cell, new data) for company file 'flid' with f500_audit_save, and recomputes the
+    # indicator, commodity and total scores they count towards (see scoring.py), in one transaction.
+    # Returns True if saved, otherwise sets the message and debug fields of 'reply' and returns False
+    qry = getCursor()
+    db = qry.connection
+    db.autocommit = False
+    try:
+        for (cell, new_data) in cells:
+            f500_audit_save(sessid, flid, cell, new_data, qry)
+        scoring.rescore_cells(qry, flid, [cell for (cell, new_data) in cells])
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        # give traceback and diagnostics
+        reply['msg'] = str(e)
+        reply['debug'] = "<PRE>\n" + traceback.format_exc() + "\n</PRE>"
+        reply['valid'] = 0
+        return False
+
 def f500_savelink_ajax(sessid, flid, cell, inid, refid, cid, link_text):
     # strips any HTML from 'link_text' and sees if text is a valid link
-    # if the link is valid and references a PDF file, it will be added to the references table
+    # if the link is valid it is added to the references table at once with status 'pending', and
+    # checked in the background (see linkcheck.py) unless it has been checked recently
     # check session is valis
     reply = f500_edit_check(sessid)
     if not reply['valid'] :
         reply['ok'] = 0
         return reply    # also includes msg and debug fields from f500_edit_check
     # session is valid and authorised - first strip any HTML from link_text
-    link = re.sub('<(.|\n)+?>', '', link_text)    
-    # test the link to see if it connects
-    try:
-        fh = urlopen(link)
-    except Exception as errMsg:
-        # an error occurred opening the link
+    link = re.sub('<(.|\n)+?>', '', link_text).strip()
+    # only the form of the link is checked here - connecting to it is left to linkcheck
+    if not linkcheck.valid_url(link):
         reply['ok']=0
-        reply['msg'] = str(errMsg)
-        reply['debug'] = "<PRE>\n\n" +  traceback.format_exc() + "\n</PRE>"
+        reply['msg'] = "Not a valid link: %s" % link
         return reply
-    # add the link to the table of references if it is new 
     qry = getCursor()
+    check = linkcheck.cached_status(qry, link) or linkcheck.pending_result(link)
+    # add the link to the table of references if it is new 
     qry.execute("SELECT docid FROM f500.documents WHERE flid=%s AND inid=%s AND sid=%s AND cid=%s AND url=%s", \
         (flid, inid, refid, cid, link))
     if qry.rowcount==0:    
-        qry.execute("""INSERT INTO f500.documents(flid, inid, sid, cid, cell, url, sessid, ts) 
-            VALUES(%s, %s, %s, %s, %s, %s, %s, NOW()) RETURNING docid""", (flid, inid, refid, cid, cell, link, sessid))
+        qry.execute("""INSERT INTO f500.documents(flid, inid, sid, cid, cell, url, sessid, ts, status) 
+            VALUES(%s, %s, %s, %s, %s, %s, %s, NOW(), %s) RETURNING docid""", \
+            (flid, inid, refid, cid, cell, link, sessid, check['status']))
         # add link as data in xldata table
         f500_audit_save(sessid, flid, cell, link)
     if qry.rowcount>=1:  
         docid =  qry.fetchone()[0]
         reply['ok'] = 1    
         reply['msg'] = "Saved : Document ID %s" % docid
+        if check['status'] == 'pending':
+            reply['msg'] += " (link check pending)"
+        elif check['status'] == 'dead':
+            reply['msg'] += " - WARNING: link did not open (%s)" % check['msg']
         reply['link'] = link
+        reply['docid'] = docid
+        reply['linkstatus'] = check['status']
+        # checked once the document is saved, so the result is copied to it
+        if check['status'] == 'pending':
+            linkcheck.submit_check(link)
     else:
         reply['ok']=0
         reply['msg'] = "Query to save data failed !! See debug data..."
@@ -2105,15 +2616,21 @@ def f500_savelink_ajax(sessid, flid, cell, inid, refid, cid, link_text):
 def f500_assess(sid, environ):
     # handles display and editing of Forest 500 assessments
     # show only top level here as a simple DIV.  All the detail is done via ajax (f500_ajax)
-    postFields = getPostFields(environ)
+    postFields = getFormFields(environ)
     # name of calling script (exec or dev)
     scriptnm =  environ['SCRIPT_NAME']  
     # HTML for debugging info - left blank if none
     debug = ""
     fileid = postFields.get('FileID',[0])[0]
     js = '<SCRIPT src="https://www.gc-dz.com/js/f500.js"></SCRIPT>'
-    # get company name
     qry = getCursor()
+    # the page has an ETag from the versions of the company's data, so is not built again if the
+    # browser's copy is current (see httpcache.py)
+    etag = httpcache.make_etag('f500a', sid, fileid, httpcache.file_versions(qry, fileid))
+    reply = httpcache.check(environ, etag)
+    if reply is not None:
+        return reply
+    # get company name
     qry.execute("""SELECT d.cotype, d.ayear, x.coname, x.flid, f.flname, DATE(f.fltime) FROM f500.xlcohdr AS x 
                 INNER JOIN f500.filelist AS f ON x.flid=f.flid INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid
                 WHERE f.flid=%s """, (fileid,))
@@ -2127,7 +2644,7 @@ def f500_assess(sid, environ):
     # get company details and construct normal heading    
     co = qry.fetchone()
     title = "Forest 500 Assessment %s : %s" % (co['ayear'], co['coname'])
-    html =  HTML_header(title, width=1000, css="f500", extras=js, menulink = (sid, scriptnm))
+    html =  HTMLBuffer(HTML_header(title, width=1000, css="f500", extras=js, menulink = (sid, scriptnm)))
     # FORM action and hidden fields used if page is submitted
     #html += "<INPUT type=hidden name=FileID id=FileID value=%s>" % fileid
     # get names of same company in different years for the dropdown slector
@@ -2138,26 +2655,37 @@ def f500_assess(sid, environ):
     	WHERE ucid IN (SELECT ucid FROM f500.coflids WHERE flid=%s)
     	ORDER BY 2 """, (fileid,))    
     # company-year selector
-    html += "<FORM action='%(APP)s?m=f500a&u=%(SID)s' id=form1 method=POST>" % {'APP': scriptnm, 'SID': sid}
+    html += """<FORM action='%(APP)s' id=form1 method=GET>
+        <INPUT type=hidden name=m value=f500a><INPUT type=hidden name=u value=%(SID)s>""" % {'APP': scriptnm, 'SID': sid}
     html += HTML_select("Company and Year", 50, "FileID", qry, fileid, "onchange=\"$('#form1').submit()\"")
     if qry.rowcount==0:
         html += "<P><SMALL>Company not listed in COFLIDS table!</SMALL></P>"
     html += "<BR clear=all>"
+    html += HTML_xlexport_button(sid, "Export workbook", "flid: %s" % int(fileid))
     #debug += "<P>Query:<BR>%s</P>" % qry.query    
     #debug += "<P>Query returned %s rows</P>" % qry.rowcount
     # match in companies table  
     # ---- to do ----
     # get commodities assessed as a list
-    qry.execute("""SELECT c.cid, xltext AS asmt FROM f500.xldata AS x 
-    	INNER JOIN f500.filelist AS f ON x.flid=f.flid 
-    	INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid 
-    	INNER JOIN f500.cscore_cells AS c ON c.cass=x.xlcell AND c.ayear=d.ayear 
-    	WHERE d.cotype='CO' AND x.flid=%s ORDER BY 1
-        """, (fileid,))
+    if xldocs.read_docs:
+        # all the values of the sheet in one row (see xldocs.py), for the commodities and each indicator
+        cells = xldocs.load(qry, fileid)
+        qry.execute("SELECT cid, cass FROM f500.cscore_cells WHERE ayear=%s AND %s='CO' ORDER BY 1",
+            (co['ayear'], co['cotype']))
+        cdrows = [cd for cd in xldocs.attach(qry.fetchall(), cells, 'asmt', 'cass') if cd['asmt'] is not None]
+    else:
+        cells = None
+        qry.execute("""SELECT c.cid, xltext AS asmt FROM f500.xldata AS x 
+        	INNER JOIN f500.filelist AS f ON x.flid=f.flid 
+        	INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid 
+        	INNER JOIN f500.cscore_cells AS c ON c.cass=x.xlcell AND c.ayear=d.ayear 
+        	WHERE d.cotype='CO' AND x.flid=%s ORDER BY 1
+            """, (fileid,))
+        cdrows = qry.fetchall()
     # covert retrieved records into a list of assessed commodities, by index number 
-    if qry.rowcount>0:
+    if len(cdrows)>0:
         cdlist = []
-        for cd in qry:
+        for cd in cdrows:
             if re.search('^([Yy]|1)',cd['asmt']):
                 cdlist.append(cd['cid'])
     else:
@@ -2185,7 +2713,7 @@ def f500_assess(sid, environ):
         indlist = qry.fetchall()
         for ind in indlist:
             # generate HTML for main indicator description
-            (htm, dbg) =  HTML_indMain(ind, fileid, cdlist)
+            (htm, dbg) =  HTML_indMain(ind, fileid, cdlist, cells)
             html += htm
             debug += dbg
     # finish off table layout
@@ -2198,13 +2726,14 @@ def f500_assess(sid, environ):
     # ---- debugging information 
     html += list_debug_info(postFields, debug, show=False)
     html += "</BODY></HTML>"    
-    return html
+    return httpcache.PageReply(html, headers=httpcache.reply_headers(etag))
 
-def HTML_indMain(ind, fileid, cdlist):
+def HTML_indMain(ind, fileid, cdlist, cells=None):
     # creates the HTML for a main indicator
     # 'ind' has fields inid, indgrp, indnum, indtext, guide, scoring, maxpts
     # fileid is file being processed.  cdlist is a list of applicable commodity indices, or None 
     # if commodities not applicable to this file, ie a financial institution
+    # cells is the dictionary of the file's values (see xldocs.py), or None to read them from xldata
     #
     debug=""
     inid = ind['inid']      # shorthand as field for Indicator ID is referenced repeatedly
@@ -2223,24 +2752,37 @@ def HTML_indMain(ind, fileid, cdlist):
         cdtext=""
     else:
         cdtext= " AND (i.cid = ANY (ARRAY%s) OR i.cid IS NULL) " % str(cdlist)
-    query = """SELECT i.sid, i.cid, c.commodity, xltext AS score
-    	FROM f500.ind_detail AS i 
-    	LEFT JOIN f500.commodities AS c ON i.cid=c.cid 
-    	LEFT JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
-    	LEFT JOIN f500.xldata AS x ON i.xlrow=x.xlrow AND p.xlcol=x.xlcol 
-    	WHERE i.inid=%s AND x.flid=%s AND (p.ptype = 'S' OR p.ptype IS NULL) %s
-    	ORDER BY 1, 2, 4""" % (inid, fileid, cdtext)	
-    qry.execute(query)	
+    if cells is None:
+        query = """SELECT i.sid, i.cid, c.commodity, xltext AS score
+        	FROM f500.ind_detail AS i 
+        	LEFT JOIN f500.commodities AS c ON i.cid=c.cid 
+        	LEFT JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
+        	LEFT JOIN f500.xldata AS x ON i.xlrow=x.xlrow AND p.xlcol=x.xlcol 
+        	WHERE i.inid=%s AND x.flid=%s AND (p.ptype = 'S' OR p.ptype IS NULL) %s
+        	ORDER BY 1, 2, 4""" % (inid, fileid, cdtext)	
+        qry.execute(query)	
+        rows = qry.fetchall()
+    else:
+        # total cells of the indicator, with the scores the file has in its values
+        query = """SELECT i.sid, i.cid, c.commodity, concat(p.xlcol, i.xlrow::TEXT) AS xlcell
+        	FROM f500.ind_detail AS i 
+        	LEFT JOIN f500.commodities AS c ON i.cid=c.cid 
+        	INNER JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
+        	WHERE i.inid=%s AND p.ptype = 'S' %s""" % (inid, cdtext)
+        qry.execute(query)
+        rows = [row for row in xldocs.attach(qry.fetchall(), cells, 'score') if row['xlcell'] in cells]
+        # in the order of the query on xldata (nulls last)
+        rows.sort(key=lambda row: (row['sid'] is None, row['sid'] or 0, row['cid'] is None, row['cid'] or 0,
+            row['score'] is None, row['score'] or ''))
     #debug += "<P>Query:<BR>%s</P>" % query    
     #debug += "<P>Query returned %s rows</P>" % qry.rowcount
-    if qry.rowcount==0:
+    if len(rows)==0:
         # query returned no rows - clean up html for this table row and return it
         html += "<TD>&nbsp;</TD></TR>"
         return (html, debug)
     # create first level sub-table to go in cell 3 of indicator row.  
-    tbl1 =""
+    tbl1 = HTMLBuffer()
     # generate one row for each sid/commodity combination
-    rows = qry.fetchall()
     br = ""         #line break tag, empty for first row
     id=0
     for row in rows:
@@ -2272,7 +2814,7 @@ def HTML_indMain(ind, fileid, cdlist):
                     'ID': id, 'INID': inid, 'CID': cid, 'SID': sid, 'FLID': fileid}  
         br = "<BR>&nbsp;"     # line break to preced next row (if any)   
     # add indicator details to last cell of row    
-    html += "<TD style='text-align: right;'>" + tbl1 + "</TD></TR>"    
+    html += "<TD style='text-align: right;'>" + tbl1.text() + "</TD></TR>"    
     # populate second row with additional text        
     html += """
         <TR class=ind-row-B id=ind-B-%(INID)s>            
@@ -2283,23 +2825,34 @@ def HTML_indMain(ind, fileid, cdlist):
     #debug += "<P>Final HTML:<BR> %s</P>" % HTML_clean(html)   
     return (html, debug)    
 
-def f500_indNotes(inid, cid, sid, flid, imgid):
+def f500_indNotes(inid, cid, sid, flid, imgid, sessid=''):
     # returns HTML to populate indicator notes popup 
     # see also javascript showIndDetails() in f500.js
     # and HTML_indMain where call to this function declared as onclick event
     # parameters are indicator id (inid), commodity index (cid), 'scope of' indicator (sid), 
     # file id (flid), and imgid, which is ID of the IMG button that called this routine
+    # sessid is the session ID, if given, for links to cached copies of documents
     #
     # construct WHERE sub-clauses if sid or cid are set
     wh_sid = " AND i.sid=%s " % sid if sid>'0' else ""
     wh_cid = " AND i.cid=%s " % cid if cid>'0' else ""
     # run query to collect notes for this indicator
-    query = """SELECT p.ptid, p.ptlabel, p.ptype, x.xlcell, xltext 
-    	FROM f500.ind_detail AS i 
-    	INNER JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
-    	LEFT JOIN f500.xldata AS x ON i.xlrow=x.xlrow AND p.xlcol=x.xlcol 
-    	WHERE i.inid=%(INID)s AND x.flid=%(FLID)s %(CID)s %(SID)s
-    	ORDER BY 1, 2, 4""" % {'INID': inid, 'FLID': flid, 'CID': wh_cid, 'SID': wh_sid}
+    if xldocs.read_docs:
+        # values from the file's document, one row (see xldocs.py), for the cells it has
+        query = """SELECT p.ptid, p.ptlabel, p.ptype, a.xlcell, d.cells ->> a.xlcell AS xltext
+        	FROM f500.ind_detail AS i 
+        	INNER JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
+        	CROSS JOIN LATERAL (SELECT concat(p.xlcol, i.xlrow::TEXT) AS xlcell) AS a
+        	INNER JOIN f500.xldocs AS d ON d.flid=%(FLID)s AND d.cells ? a.xlcell
+        	WHERE i.inid=%(INID)s %(CID)s %(SID)s
+        	ORDER BY 1, 2, 4""" % {'INID': inid, 'FLID': int(flid), 'CID': wh_cid, 'SID': wh_sid}
+    else:
+        query = """SELECT p.ptid, p.ptlabel, p.ptype, x.xlcell, xltext 
+        	FROM f500.ind_detail AS i 
+        	INNER JOIN f500.assmnt_parts AS p ON i.atype=p.atype 
+        	LEFT JOIN f500.xldata AS x ON i.xlrow=x.xlrow AND p.xlcol=x.xlcol 
+        	WHERE i.inid=%(INID)s AND x.flid=%(FLID)s %(CID)s %(SID)s
+        	ORDER BY 1, 2, 4""" % {'INID': inid, 'FLID': flid, 'CID': wh_cid, 'SID': wh_sid}
     qry = getCursor()
     qry.execute(query)	
     # close button at top right of DIV		
@@ -2321,44 +2874,151 @@ def f500_indNotes(inid, cid, sid, flid, imgid):
         html += "</TABLE>"        
     else:
         html += "<P>No notes found!</P>" % query
+    # documents linked for this indicator, from the local cache (see doccache.py)
+    docs = doccache.get_documents(qry, flid, inid)
+    if len(docs) > 0:
+        html += "<TABLE><TR><TH>Document</TH><TH>Status</TH><TH>Opening text</TH></TR>"
+        for doc in docs:
+            html += "<TR><TD>%s</TD><TD>%s</TD><TD>%s</TD></TR>" % (HTML_doclink(doc, sessid),
+                HTML_docstatus(doc), HTML_clean(doc['snippet'] or ''))
+        html += "</TABLE>"
+    return html
+
+def HTML_doclink(doc, sessid):
+    # link to a document's URL, followed by a link to the cached copy if there is one and a session ID is given
+    html = "<A href='%(URL)s' target=_blank class=note-link>%(URL)s</A>" % {'URL': HTML_clean(doc['url'])}
+    if doc['sha256'] is not None and sessid > '':
+        html += " <A href='%s?m=doc&u=%s&docid=%s' target=_blank class=note-link>[cached copy]</A>" % \
+            (scriptnm, sessid, doc['docid'])
     return html
 
+def HTML_docstatus(doc):
+    # status, type and size of a linked document, as shown in the notes popup
+    if doc['status'] != 'ok' or doc['size'] is None:
+        return HTML_clean(doc['status'])
+    return "%s<BR>%s<BR>%s KB<BR>%s" % (doc['status'], HTML_clean(doc['ctype']), (doc['size'] + 1023) // 1024,
+        doc['fetched'])
+
+def f500_docSearch(terms, sessid=''):
+    # returns HTML listing cached documents matching the words in 'terms', with snippets of matching text
+    docs = doccache.search_documents(getCursor(), terms)
+    if len(docs) == 0:
+        return "<P>No documents found for '%s'</P>" % HTML_clean(terms)
+    html = "<TABLE><TR><TH>Document</TH><TH>File ID</TH><TH>Text</TH></TR>"
+    for doc in docs:
+        # snippet has <B> tags around the matching words, so escape the text and restore these
+        snippet = HTML_clean(doc['snippet']).replace('&lt;b&gt;', '<B>').replace('&lt;/b&gt;', '</B>')
+        html += "<TR><TD>%s</TD><TD>%s</TD><TD>%s</TD></TR>" % (HTML_doclink(doc, sessid), doc['flid'], snippet)
+    html += "</TABLE>"
+    return html
+
+def f500_export(sid, environ):
+    # returns an exported workbook or archive as (content type, contents, headers), or an error page if
+    # it was not made for this user or has been deleted
+    params = cgi.parse_qs(environ['QUERY_STRING'])
+    name = params.get('file', [''])[0]
+    found = xlexport.export_path(getCursor(), name, sid)
+    if found is None:
+        return error_page("Exported file '%s' is not available" % name)
+    (path, ctype, download) = found
+    with open(path, 'rb') as fh:
+        contents = fh.read()
+    return (ctype, contents, [('Content-Disposition', 'attachment; filename="%s"' % download)])
+
+def HTML_xlexport_button(sid, label, fields):
+    # returns HTML for a button exporting workbooks in the background (see xlexport.py), with a message
+    # showing the job's progress and then a link to the file.  'fields' are the Ajax fields given as
+    # JavaScript, eg "flid: 123"
+    return """
+    <INPUT type=button value="%(LABEL)s" onclick="xlExport()"> <SPAN id=xlexport-msg></SPAN>
+    <SCRIPT>
+    function xlExport() {
+        $.post('%(APP)s', {action: 'f500.xlexport', sessid: '%(SID)s', %(FIELDS)s}, function(reply) {
+            $('#xlexport-msg').text(reply.msg);
+            if (reply.valid == 1) xlExportPoll(reply.jobid, reply.file);
+        }, 'json');
+    }
+    function xlExportPoll(jobid, file) {
+        $.post('%(APP)s', {action: 'jobs.status', jobid: jobid, sessid: '%(SID)s'}, function(reply) {
+            if (reply.status == 'done') {
+                $('#xlexport-msg').html(reply.result + " <A href='%(APP)s?m=xlx&u=%(SID)s&file=" + file + "'>Download</A>");
+            } else if (reply.status == 'failed') {
+                $('#xlexport-msg').text('Export failed');
+            } else {
+                if (reply.total > 0) $('#xlexport-msg').text('Exporting: ' + reply.progress + ' of ' + reply.total + ' files');
+                setTimeout(function() { xlExportPoll(jobid, file); }, 2000);
+            }
+        }, 'json');
+    }
+    </SCRIPT>
+    """ % {'LABEL': label, 'APP': scriptnm, 'SID': sid, 'FIELDS': fields}
+
+def f500_document(sid, environ):
+    # returns the cached copy of a document as (content type, contents, headers), or an error page if not
+    # cached
+    params = cgi.parse_qs(environ['QUERY_STRING'])
+    docid = int(params.get('docid', ['0'])[0])
+    doc = doccache.read_document(getCursor(), docid)
+    if doc is None:
+        return error_page("Document %s is not in the cache" % docid)
+    return doc
+
+# URL pattern for HTML_link (regex from JG Soft Library to match URLs, plus case-insensitive option),
+# the anchor it puts round each URL, and line breaks replaced by HTML_clean
+url_pattern = re.compile(r'(?:(?:https?|ftp|file)://|www\.|ftp\.)[-A-Z0-9+&@#/%=~_|$?!:,.]*[A-Z0-9+&@#/%=~_|$]', re.I)
+url_anchor = "<A href='%(URL)s' target=_blank class=note-link>%(URL)s</A>"
+crlf_pattern = re.compile('\r\n*')
+
+# number of texts whose HTML is kept by HTML_clean, HTML_lines and HTML_link.  Indicator texts, guides
+# and scoring notes are the same for every company, so are mostly found in the cache
+text_cache_size = 4096
+
+# text wrappers for HTML_lines, by width
+text_wrappers = {}
+
+@functools.lru_cache(maxsize=text_cache_size)
 def HTML_link(text):
     # search for apparent hypertext links in text and wrap them in <A> tags pointing at the URL given
-    # regex from JG Soft Library to match URLs, plus case-insensitive option
-    urlrgx = re.compile('(?:(?:https?|ftp|file)://|www\.|ftp\.)[-A-Z0-9+&@#/%=~_|$?!:,.]*[A-Z0-9+&@#/%=~_|$]',re.I)
-    # working copy of text 
+    matches = list(url_pattern.finditer(text))
+    urls = [murl.group() for murl in matches]
+    if not any(i != j and urls[i] in urls[j] for i in range(len(urls)) for j in range(len(urls))):
+        # no URL is repeated or part of another, so each can be replaced where it was found
+        (parts, pos) = ([], 0)
+        for murl in matches:
+            parts.append(text[pos:murl.start()])
+            parts.append(url_anchor % {'URL': murl.group()})
+            pos = murl.end()
+        parts.append(text[pos:])
+        return ''.join(parts)
+    # otherwise replace each URL throughout the text in turn, as earlier versions did
     html = text
-    # find all matching URL-like texts in target
-    for murl in urlrgx.finditer(text):
-        # create anchor link
-        anchor = "<A href='%(URL)s' target=_blank class=note-link>%(URL)s</A>" % {'URL': murl.group()}
-        html = html.replace(murl.group(), anchor)
-    return html     
-        
+    for url in urls:
+        html = html.replace(url, url_anchor % {'URL': url})
+    return html
+
 def HTML_clean(text, br=False):
     # replaces the characters &<>"' with HTML equivalents to avoid problems when injecting text into HTML    
-    badch = '&<>"\''
-    htmch = ['&amp;', '&lt;', '&gt;', '&quot;', '&#39;']
-    txt = str(text)
-    for i, ch in enumerate(badch):
-        txt = re.sub(ch, htmch[i], txt)
+    return clean_text(str(text), br)
+
+@functools.lru_cache(maxsize=text_cache_size)
+def clean_text(txt, br):
+    # HTML_clean for a string, cached
+    txt = escape(txt)
     if br:
         # replace cr/lf with <BR>
-        txt = re.sub('\r\n*', "<BR>", txt)           
+        txt = crlf_pattern.sub("<BR>", txt)
     return txt
 
+@functools.lru_cache(maxsize=text_cache_size)
 def HTML_lines(text, width=50):
     # converts a block of text or a long text line into a block of lines at most
     # 'width' chars long separated by <BR> tags.  Note this also cleans HTML of <>'" etc
-    lines = textwrap.TextWrapper(width=width)
+    lines = text_wrappers.get(width)
+    if lines is None:
+        lines = text_wrappers[width] = textwrap.TextWrapper(width=width)
     text_lines = lines.wrap(text)
-    # initialise HTML with first line of text
-    html = text_lines[0]
-    # add following lines preceded by line break.        
-    for aline in text_lines[1:]:
-        html += "<BR>" + aline
-    return html    
+    # first line of text (IndexError if there is none), and following lines preceded by line break
+    return text_lines[0] + ''.join(["<BR>" + aline for aline in text_lines[1:]])
         
 def HTML_button(name, label, value, css="", onclick=""):
     # returns HTML for a button with text 'label', CSS 'class', javascript 'onclick'
@@ -2372,6 +3032,8 @@ def list_debug_info(postFields=None, debug="", show=False):
     html = "<DIV id='debug'>"   # always create empty DIV.  Javascript may put messages here
     if show:
         html += "<BR><HR class=debug><BR>%s" % debug
+        # request timings and slowest SQL statements so far
+        html += dbtrace.summary_html()
         if postFields is not None:
             html += "POST fields:<BR>"
             # trap sensibly any errors looping through list of lists
@@ -2450,16 +3112,84 @@ def HTML_checkbox(hdr, sz, name, value='', chk=False, event=''):
     return html
 
     
-def nameCheck(nmlist, chktype):
+# trase/NA API client shared by all requests in this process (see getTraseAPI)
+trase_api = None
+trase_api_lock = threading.Lock()
+
+def getTraseAPI():
+    # returns the trase/NA API client, creating it on first use
+    global trase_api
+    with trase_api_lock:
+        if trase_api is None:
+            trase_api = TraseCompaniesDB("iiYrZqe3eX4fP5KD7RXIC5YlLehjaV7a5mj7dbfj")
+        return trase_api
+
+def traseMatch(nmlist, api=None, threshold=0.9, balance=0.5, workers=8, ttl='30 days'):
+# looks up a list of names with the trase/NA api.match() and returns a dictionary of name -> matches.
+# Results are cached in table gcdz.match_cache, keyed by normalised name and match parameters, for
+# period 'ttl', so repeat lookups of the same suppliers cost nothing.  The remaining names are looked
+# up in parallel on a pool of at most 'workers' threads.  If a lookup fails, the results of the others
+# are still cached before its error is raised, so a retry only repeats the names that failed.
+# 'api' may be given to use a different client (eg a local stub for testing), otherwise the shared
+# client from getTraseAPI() is used.
+    if api is None:
+        api = getTraseAPI()
+    # cache key for each name - normalised name fragments, or the plain name if they are empty
+    keys = {}
+    for nm in nmlist:
+        nn = ' '.join(t for t in name_frags(nm) if t > '')
+        if nn == '':
+            nn = nm.strip().lower()
+        keys[nm] = "%s|%s|%s" % (nn, threshold, balance)
+    # get unexpired results from cache
+    qry = getCursor()
+    qry.execute("SELECT mkey, matches FROM gcdz.match_cache WHERE mkey = ANY(%s) AND ts > NOW() - %s::INTERVAL", 
+        (list(set(keys.values())), ttl))
+    cached = {}
+    for row in qry:
+        cached[row['mkey']] = json.loads(row['matches'])
+    # look up the rest in parallel, one request per distinct key
+    todo = {}
+    for nm in nmlist:
+        if keys[nm] not in cached and keys[nm] not in todo:
+            todo[keys[nm]] = nm
+    if len(todo) > 0:
+        with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            found = [(mkey, pool.submit(api.match, nm, threshold=threshold, balance=balance)) 
+                for (mkey, nm) in todo.items()]
+        # save new results to cache, keeping the first error
+        values = []
+        error = None
+        for (mkey, future) in found:
+            try:
+                matches = future.result()
+            except Exception as e:
+                error = e if error is None else error
+                continue
+            cached[mkey] = matches
+            values.append((mkey, json.dumps(matches, default=str)))
+        if len(values) > 0:
+            psycopg2.extras.execute_values(qry, """INSERT INTO gcdz.match_cache (mkey, matches, ts) VALUES %s
+                ON CONFLICT (mkey) DO UPDATE SET matches=EXCLUDED.matches, ts=EXCLUDED.ts""", values, 
+                template="(%s, %s, NOW())")
+        if error is not None:
+            raise error
+    return dict((nm, cached[keys[nm]]) for nm in nmlist)
+
+def nameCheck(nmlist, chktype, api=None):
 # undertakes a name search and returns information on any matches in HTML format
 # nmlist - a list of names to be checked
 # chktype - 'trase' for trase/nural alpha engine, 'f500' for my own recipe
 # outfmt - output format, eith 'simple' (one line per company) or 'full'
+# api - trase/NA client to use, if not the shared one (see traseMatch)
 # -- first draft of routine simply explores what the trase/NA SDK gives back
-    # trase/NA API
-    api = TraseCompaniesDB("iiYrZqe3eX4fP5KD7RXIC5YlLehjaV7a5mj7dbfj")
+    # skip any names that are not words 
+    nmlist = [nm for nm in nmlist if re.search('\w+', nm) is not None]
+    # trase/NA API lookups, done together (see traseMatch)
+    lookups = traseMatch(nmlist, api)
     # set table heading HTML for output
-    html = """<TABLE class=trase-full-list>
+    html = HTMLBuffer()
+    html += """<TABLE class=trase-full-list>
                 <TR><TH rowspan=2>Search term</TH>
                 <TH rowspan=2>Trase name</TH>
                 <TH rowspan=2>Juris.</TH>                
@@ -2468,18 +3198,15 @@ def nameCheck(nmlist, chktype):
                 <TR><TD class=tflh>Type</TD><TD class=tflh>ID</TD></TR>
                 """ 
     for nm in nmlist:
-        #skip any names that are not words 
-        if re.search('\w+', nm) is None:
-            continue
-        matches = api.match(nm, threshold=0.9, balance=0.5)
+        matches = lookups[nm]
         if len(matches) == 0:
             # no match found
-            html += "<TR><TD>%s</TD><TD colspan=5>No matches found</TD></TR>" % nm
+            html += "<TR><TD>%s</TD><TD colspan=5>No matches found</TD></TR>" % escape(nm)
         else:
             # one or more matches
             nr = len(matches)
             # html for left hand column
-            html += "<TR><TD rowspan=%s>%s</TD>" % (nr, nm)
+            html += "<TR><TD rowspan=%s>%s</TD>" % (nr, escape(nm))
             n=0
             for item in matches:
                 # new row if more than first match
@@ -2489,22 +3216,17 @@ def nameCheck(nmlist, chktype):
                 if n>0:
                     html += "<TR>"
                 # trase name
-                html += "<TD>%s</TD>" % co['name']
+                html.cell(co['name'])
                 # jurisdiction - either country field if present or 
                 if 'country' in co:
-                    html += "<TD>%s</TD>" % co['country']
+                    html.cell(co['country'])
                 elif 'open-corporates' in co:
                     html += "<TD>%s</TD>" % str(re.findall('http[s]*://opencorporates\.com/companies/([A-Za-z_]+)/',co['open-corporates'])[0]).upper()  
                 else:    
                     html += "<TD>-</TD>"    
                 # alternate names
                 altnames = co['label']
-                html += "<TD>"
-                sep=""
-                for altnm in altnames:
-                    html += sep + altnm
-                    sep = "<BR>"
-                html += "</TD>" 
+                html += "<TD>%s</TD>" % "<BR>".join([escape(altnm) for altnm in altnames])
                 # identifiers for trase, LEI, Permid, Open-Corporates
                 td = ["", ""]     # td[0] has ID types, td[1] as ID values
                 nl = ""          # newline at start (none for 1st line, then <BR>)
@@ -2530,7 +3252,61 @@ def nameCheck(nmlist, chktype):
                 html += "</TR>" 
                 n += 1
     html += "</TABLE>"            
-    return html            
+    return html.text()
+
+def localMatch(nmlist, threshold=0.5):
+# matches a list of names against the Forest 500 company files (xlcohdr/coflids) and returns
+# the best matches for each in HTML format.  No external service is used, so this is suitable
+# for long lists.  See namematch.py for the matching method.
+    index = universe_index_get(getCursor())['index']
+    # skip any names that are not words
+    names = [nm for nm in nmlist if re.search('\w+', nm) is not None]
+    (results, stats) = namematch.match_names(names, index, threshold, limit=5)
+    html = """<P><SMALL>%(N)s names (%(D)s distinct) matched against %(U)s company files in %(T).2f sec 
+        (%(R).0f names/sec)</SMALL></P>
+        <TABLE class=trase-full-list>
+        <TR><TH>Search term</TH><TH>Score</TH><TH>Company name</TH><TH>Type</TH><TH>Year</TH>
+        <TH>File ID</TH><TH>Co ID</TH></TR>
+        """ % {'N': stats['names'], 'D': stats['distinct'], 'U': len(index['items']), 
+            'T': stats['secs'], 'R': stats['rate']}
+    for nm in names:
+        matches = results[nm]
+        if len(matches) == 0:
+            html += "<TR><TD>%s</TD><TD colspan=6>No matches found</TD></TR>" % HTML_clean(nm)
+            continue
+        # search term spans the rows of its matches
+        html += "<TR><TD rowspan=%s>%s</TD>" % (len(matches), HTML_clean(nm))
+        n = 0
+        for (score, co) in matches:
+            if n > 0:
+                html += "<TR>"
+            html += "<TD>%.2f</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD><TD>%s</TD></TR>" \
+                % (score, HTML_clean(co['coname']), co['cotype'], co['ayear'], co['flid'], 
+                    co['ucid'] if co['ucid'] is not None else '')
+            n += 1
+    html += "</TABLE>"
+    return html
+
+# standard page skeleton for HTML_header, parsed once when the module is loaded (see htmltpl.py).
+# EXTRAS and PARAMS are HTML, the title (which may hold a company name) and the other values are escaped
+page_header = Template("""
+    <!DOCTYPE html>
+    <HTML>
+    <HEAD>
+    <TITLE>Trasepad - %(TITLE)s</TITLE>
+    <LINK href="https://www.gc-dz.com/css/%(CSS)s.css" rel="stylesheet"  type="text/css">
+    <SCRIPT src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></SCRIPT>
+    <SCRIPT src="https://code.jquery.com/ui/1.12.1/jquery-ui.min.js"></SCRIPT>
+    <META charset="UTF-8">
+    %(EXTRAS)s
+    </HEAD>
+    <BODY %(PARAMS)s>
+    <a name="Top" id="Top"></a>
+    <DIV class=logo><a href="%(MENU_URL)s"><img src="https://www.gc-dz.com/img/gc.jpg"></a></DIV>
+    <DIV class=title><H1>%(TITLE)s</H1></DIV>
+    <P class=clear>&nbsp;</P>
+    <HR class=menu style="width: %(WIDTH)spx">
+    """, raw=('EXTRAS', 'PARAMS'))
 
 def HTML_header(title = "Data Manager Development Site", css="main", extras="", params ="", 
     width=600, menulink=None, module=""):
@@ -2554,27 +3330,9 @@ def HTML_header(title = "Data Manager Development Site", css="main", extras="",
         qry.execute("SELECT menutext FROM gcdz.menus WHERE module=%s", (module,))
         mnu = qry.fetchone()
         title = mnu['menutext']             
-    template = """
-    <!DOCTYPE html>
-    <HTML>
-    <HEAD>
-    <TITLE>Trasepad - %(TITLE)s</TITLE>
-    <LINK href="https://www.gc-dz.com/css/%(CSS)s.css" rel="stylesheet"  type="text/css">
-    <SCRIPT src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></SCRIPT>
-    <SCRIPT src="https://code.jquery.com/ui/1.12.1/jquery-ui.min.js"></SCRIPT>
-    <META charset="UTF-8">
-    %(EXTRAS)s
-    </HEAD>
-    <BODY %(PARAMS)s>
-    <a name="Top" id="Top"></a>
-    <DIV class=logo><a href="%(MENU_URL)s"><img src="https://www.gc-dz.com/img/gc.jpg"></a></DIV>
-    <DIV class=title><H1>%(TITLE)s</H1></DIV>
-    <P class=clear>&nbsp;</P>
-    <HR class=menu style="width: %(WIDTH)spx">
-    """
-    # substitute parameters in template
-    html = template % {'TITLE': title, 'EXTRAS': extras,  'PARAMS': params, 'WIDTH': width, 'CSS': css, 'MENU_URL': menu_url}
-    return html
+    # fill in the page skeleton (see page_header above)
+    return page_header.render({'TITLE': title, 'EXTRAS': extras, 'PARAMS': params, 'WIDTH': width, 'CSS': css,
+        'MENU_URL': menu_url})
 
 def HTML_footer(environ=None):
     # standard HTML footer with back|menu link adn debugging material
@@ -2609,12 +3367,25 @@ def makeHTMLtable(qry, n=0, m=10, lines='LightBlue', altrows='LightCyan'):
     """
     if qry.rowcount==0:
         return ""       # does nothing if no rows in cursor
-    html = '<hr size=2 width=600 color="#BABF57" align="left" ><BR>'
-    # add local styles if given.  This must be syntactically correct css stylesheet
     # get column headings from description
     colhdr = list()
     for k in range(0, len(qry.description)):  # loop though column descriptions
         colhdr.append(qry.description[k][0])    # save column names (item 0)
+    # check rows to be output
+    pass   #not coded yet, defaults assumed
+    # position cursor at first row (check does not exceed record count)
+    if n>=qry.rowcount: 
+        n=qry.rowcount-1
+    qry.scroll(n, mode='absolute')      # start from row n (default 1)
+    # fetch next m records
+    rows = qry.fetchmany(m)     
+    return makeHTMLrows(colhdr, rows, lines, altrows)
+
+def makeHTMLrows(colhdr, rows, lines='LightBlue', altrows='LightCyan'):
+    # creates the HTML table for makeHTMLtable from a list of column names and the rows already fetched
+    # (eg a page from a server-side cursor, see processQuery)
+    html = HTMLBuffer('<hr size=2 width=600 color="#BABF57" align="left" ><BR>')
+    # add local styles if given.  This must be syntactically correct css stylesheet
     # style sheet for tables
     # for named colour codes see https://www.w3schools.com/cssref/css_colors.asp
     css_table ="""
@@ -2641,23 +3412,12 @@ def makeHTMLtable(qry, n=0, m=10, lines='LightBlue', altrows='LightCyan'):
     for col in colhdr:
         html += "<TH class='t2'>%s</TH>" % col
     html += "</TR>"    
-    # check rows to be output
-    pass   #not coded yet, defaults assumed
-    # position cursor at first row (check does not exceed record count)
-    if n>=qry.rowcount: 
-        n=qry.rowcount-1
-    qry.scroll(n, mode='absolute')      # start from row n (default 1)
-    # fetch next m records
-    rows = qry.fetchmany(m)     
     # create rest of table
     for row in rows:               
-        html += "<TR class='t2'>" 
-        for col in row:
-            html += "<TD class='t2'>%s</TD>" % col
-        html += "</TR>"    
+        html.row(row, "class='t2'", "class='t2'")
     # return HTML for completed table
     html += "</TABLE>"
-    return html           
+    return html.text()
 
 # when run from the command line for testing, does a simple compile check
 if __name__ == '__main__':
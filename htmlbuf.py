@@ -0,0 +1,103 @@
+"""
+ ------------- htmlbuf.py  ------------
+ Buffer for building HTML pages.  The page builders in gc_dz.py add to their
+ output a fragment at a time (html += ...) inside row loops.  HTMLBuffer keeps
+ the fragments in a list and joins them once, when the page is finished.  It
+ supports +=, so a builder only changes where the buffer is created, and has
+ writer methods for table rows and cells which escape the values given (see
+ escape).
+
+ This is not faster: CPython extends a string that nothing else refers to in
+ place, so html += ... on a str was already linear, and a 20,000 row f500
+ listing took the same time either way.  The buffer gives the escaping writers,
+ and does not depend on that detail of the interpreter.  A buffer returned by a
+ page module is encoded by application() in chunks (see HTMLBuffer.encoded),
+ without first joining the page into one string.  The chunks are all made
+ before the response is sent, since its size is needed, so this saves the copy
+ of the joined page, not the memory of the page.
+"""
+
+# size of the chunks sent by HTMLBuffer.encoded (characters)
+chunk_size = 65536
+
+def escape(value):
+    # text of 'value' with the characters &<>"' replaced by HTML entities, as in HTML_clean in gc_dz.py.
+    # A chain of replace() calls is several times faster than str.translate for short values
+    return str(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace(
+        '"', '&quot;').replace("'", '&#39;')
+
+def attr_text(attrs):
+    # attributes for a tag, with a leading space if any are given
+    return ' ' + attrs if attrs > '' else ''
+
+class HTMLBuffer:
+    # append-only list of HTML fragments, joined once when the page is complete.  Fragments added with
+    # += or add() are HTML and are not escaped; values given to cell(), cells() and row() are text
+    def __init__(self, *parts):
+        self.parts = []
+        self.add(*parts)
+
+    def __iadd__(self, fragment):
+        # buf += fragment, where fragment is HTML text or another buffer
+        if type(fragment) is str:
+            self.parts.append(fragment)
+        else:
+            self.add(fragment)
+        return self
+
+    def add(self, *parts):
+        # appends HTML fragments (text or buffers)
+        for part in parts:
+            if isinstance(part, HTMLBuffer):
+                self.parts.extend(part.parts)
+            else:
+                self.parts.append(part)
+        return self
+
+    def write(self, template, values):
+        # appends template % values, eg buf.write("<TD>%s</TD>", (n,)).  Values are not escaped
+        self.parts.append(template % values)
+        return self
+
+    def cell(self, value, attrs='', tag='TD'):
+        # appends a table cell containing the text of 'value'
+        self.parts.append('<%s%s>%s</%s>' % (tag, attr_text(attrs), escape(value), tag))
+        return self
+
+    def cells(self, values, attrs='', tag='TD'):
+        # appends a table cell for each of 'values', all with the same attributes
+        start = '<%s%s>' % (tag, attr_text(attrs))
+        end = '</%s>' % tag
+        self.parts.append(''.join([start + escape(value) + end for value in values]))
+        return self
+
+    def row(self, values, attrs='', cell_attrs='', tag='TD'):
+        # appends a complete table row with a cell for each of 'values'
+        self.parts.append('<TR%s>' % attr_text(attrs))
+        self.cells(values, cell_attrs, tag)
+        self.parts.append('</TR>')
+        return self
+
+    def text(self):
+        # returns the page so far as a single string.  The fragments are replaced by the joined text, so
+        # further additions and calls stay cheap
+        text = ''.join(self.parts)
+        self.parts = [text]
+        return text
+
+    def __str__(self):
+        return self.text()
+
+    def encoded(self, encoding='utf-8', size=chunk_size):
+        # generates the page as byte strings of roughly 'size' characters, for sending without joining it
+        block = []
+        count = 0
+        for part in self.parts:
+            block.append(part)
+            count += len(part)
+            if count >= size:
+                yield ''.join(block).encode(encoding)
+                block = []
+                count = 0
+        if len(block) > 0:
+            yield ''.join(block).encode(encoding)
@@ -0,0 +1,49 @@
+"""
+ ------------- htmltpl.py  ------------
+ Precompiled templates for the large page skeletons in gc_dz.py (the standard
+ page header, the SCTN directory header and the top of the f500 input page).
+ These were rebuilt for every request by %-formatting kilobytes of triple-quoted
+ text.  A Template is written in the same %(NAME)s format, but is parsed once,
+ when the module is loaded, into a positional format and the list of its slots.
+ Slot values are escaped (see htmlbuf.escape), except for the slots named as
+ raw, which hold HTML such as script tags.
+
+ The skeletons are filled with the same few values again and again (the same
+ title, style sheet and scripts for a page, and the same session for a user),
+ so the text made for each set of values is kept (see cache_size), and a
+ repeated render is a dictionary lookup rather than escaping the values and
+ formatting the skeleton.
+"""
+import re, functools
+from htmlbuf import escape
+
+# slots in a template: %(NAME)s, or %% for a literal %
+slot_pattern = re.compile(r'%\((\w+)\)s|%%')
+
+# rendered texts kept by each template
+cache_size = 1024
+
+class Template:
+    # page skeleton in %(NAME)s format.  'raw' names the slots whose values are HTML, and are not escaped
+    def __init__(self, text, raw=()):
+        # the skeleton with its slots as positional %s, and the names of the slots in page order (a name
+        # used twice is listed twice)
+        self.names = [name for name in slot_pattern.findall(text) if name > '']
+        self.format = slot_pattern.sub(lambda match: '%%' if match.group(1) is None else '%s', text)
+        self.escaped = [name not in raw for name in self.names]
+        self.cached = functools.lru_cache(maxsize=cache_size)(self.fill)
+
+    def fill(self, values):
+        # the skeleton with the slots filled from tuple 'values', in page order
+        return self.format % tuple([escape(value) if escaped else value
+            for (value, escaped) in zip(values, self.escaped)])
+
+    def render(self, values):
+        # returns the skeleton as text, with the slots filled from 'values' (a dictionary).  A missing value
+        # raises KeyError, as with %
+        key = tuple([values[name] for name in self.names])
+        try:
+            return self.cached(key)
+        except TypeError:
+            # a value that cannot be a dictionary key, eg a list
+            return self.fill(key)
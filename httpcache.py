@@ -0,0 +1,80 @@
+"""
+ ------------- httpcache.py  ------------
+ Conditional GET for the F500 assessment page (f500_assess) and company listings
+ (f500_main) in gc_dz.py.  These are rebuilt from many queries on every reload,
+ although the data behind them changes much less often.  Table f500.data_versions
+ (see schema_updates.sql) counts the changes to each company file ('flid:N'), to
+ the data shown in the listings ('list'), to the users' e-mail addresses
+ ('users') and to the indicator and commodity definitions ('ref'); it is kept by
+ triggers, so every program that changes the data updates it.  A page looks up the versions it depends on (one query) and
+ makes a strong ETag from them, the session, the page parameters and the
+ application build.  If the browser already has that version (If-None-Match),
+ the page replies '304 Not Modified' without being built; otherwise the page is
+ sent with the ETag, and 'Cache-Control: private, no-cache' so the browser keeps
+ it but checks it each time it is shown.
+
+ Page modules reply with a PageReply to give a status and headers as well as the
+ page.  Compressed responses have the content coding added to the ETag (see
+ httpzip.py), as the bytes sent are different.
+"""
+import os, hashlib
+
+# build of the application included in each ETag, so pages are sent again after it is updated
+build = '%x' % int(os.path.getmtime(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gc_dz.py')))
+
+# content codings that may have been added to an ETag (see httpzip.py)
+codings = ('gzip', 'deflate')
+
+class PageReply:
+    # reply from a page module with an HTTP status and headers, as well as the page (HTML text or buffer)
+    def __init__(self, html, status='200 OK', headers=()):
+        self.html = html
+        self.status = status
+        self.headers = list(headers)
+
+def make_etag(*parts):
+    # returns a strong ETag for a page from the values it depends on
+    return '"%s"' % hashlib.sha1(repr((build,) + parts).encode('utf-8')).hexdigest()[:32]
+
+def coded_etag(etag, coding):
+    # ETag of the page sent with a content coding, eg "abc-gzip"
+    return '%s-%s"' % (etag[:-1], coding)
+
+def not_modified(environ, etag):
+    # returns the tag matching 'etag' in the If-None-Match header (as the browser sent it, perhaps with a
+    # content coding), or None if the browser does not have this version of the page
+    for tag in environ.get('HTTP_IF_NONE_MATCH', '').split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return etag
+        # If-None-Match uses the weak comparison
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag in [coded_etag(etag, coding) for coding in codings]:
+            return tag
+    return None
+
+def reply_headers(etag):
+    # headers sent with a page that has an ETag
+    return [('ETag', etag), ('Cache-Control', 'private, no-cache')]
+
+def check(environ, etag):
+    # returns a '304 Not Modified' PageReply if the browser has this version of the page, otherwise None
+    tag = not_modified(environ, etag)
+    if tag is None:
+        return None
+    return PageReply('', '304 Not Modified', reply_headers(tag))
+
+def file_versions(qry, flid):
+    # versions of the data shown by the assessment page of company file 'flid': the definitions, the
+    # file and the other files of the same company (listed in its company and year selector)
+    qry.execute("""SELECT scope, version FROM f500.data_versions WHERE scope IN ('ref', 'flid:' || %(FLID)s)
+        OR scope IN (SELECT 'flid:' || flid FROM f500.coflids
+            WHERE ucid IN (SELECT ucid FROM f500.coflids WHERE flid=%(FLID)s))
+        ORDER BY 1""", {'FLID': flid})
+    return tuple((row[0], row[1]) for row in qry.fetchall())
+
+def listing_versions(qry):
+    # versions of the data shown by the company listings (with the editors' e-mail addresses of option 4)
+    qry.execute("SELECT scope, version FROM f500.data_versions WHERE scope IN ('list', 'ref', 'users') ORDER BY 1")
+    return tuple((row[0], row[1]) for row in qry.fetchall())
@@ -0,0 +1,127 @@
+"""
+ ------------- httpzip.py  ------------
+ Response compression for application() in gc_dz.py.  Pages such as the f500
+ input form, the assessment pages and the SCTN data tool are large and very
+ repetitive (inline styles, repeated INPUT and IMG markup), and compress to a
+ small fraction of their size.  A response is compressed with gzip or deflate
+ when the browser accepts it (the Accept-Encoding header, with its q-values),
+ its content type is text-like and it is at least min_size bytes.  Pages built
+ in an HTMLBuffer, which are encoded in several chunks, are compressed chunk by
+ chunk as the server sends them, without a Content-Length (mod_wsgi then uses
+ chunked transfer encoding).  Responses of a compressible type carry 'Vary: Accept-Encoding', so
+ proxies keep the compressed and plain copies apart, and an ETag given by the
+ page has the content coding added (see httpcache.py).
+
+ Documents served from the document cache (doccache.py) are the same each time
+ they are requested, so their compressed copies can be kept in memory, keyed by
+ a hash of the contents, and sent again without compressing them again.  This
+ is off unless GCDZ_COMPRESS_CACHE gives the number of copies to keep.
+
+ Settings are read from the WSGI environment (SetEnv in the Apache
+ configuration) or the process environment:
+   GCDZ_COMPRESS_LEVEL   zlib level, 1 (fastest) to 9 (smallest), or 0 for no
+                         compression, eg if Apache's mod_deflate is used instead
+   GCDZ_COMPRESS_CACHE   compressed documents kept in memory (default 0)
+"""
+import os, zlib, hashlib, threading
+from collections import OrderedDict
+from httpcache import coded_etag
+
+# defaults: zlib level, smallest response compressed (bytes), and compressed documents kept
+default_level = 6
+min_size = 1024
+default_cache = 0
+
+# content types compressed (images, PDFs and archives are already compressed)
+compressible_types = {'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'application/json',
+    'application/javascript', 'application/xml', 'application/xhtml+xml'}
+
+# zlib window bits for each content coding: gzip has a gzip header, HTTP 'deflate' is the zlib format
+window_bits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# compressed documents, as (hash, coding, level) -> bytes, least recently used first
+cache = OrderedDict()
+cache_lock = threading.Lock()
+
+def setting(environ, name, default):
+    # integer setting from the WSGI environment or the process environment
+    value = environ.get(name) or os.environ.get(name, '')
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+def accepted_encoding(environ):
+    # returns the content coding to use, 'gzip' or 'deflate', from the Accept-Encoding header, or None.
+    # The coding with the highest q-value is used, with gzip preferred if equal
+    qvalues = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        (name, sep, params) = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            (key, sep, value) = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        name = name.strip().lower()
+        if name > '':
+            qvalues['gzip' if name == 'x-gzip' else name] = q
+    (best, best_q) = (None, 0.0)
+    for coding in ('gzip', 'deflate'):
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > best_q:
+            (best, best_q) = (coding, q)
+    return best
+
+def compress_chunks(chunks, coding, level):
+    # generates the compressed form of a response given as byte strings, as each is compressed
+    zobj = zlib.compressobj(level, zlib.DEFLATED, window_bits[coding])
+    for chunk in chunks:
+        data = zobj.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield zobj.flush()
+
+def compress_cached(body, coding, level, entries):
+    # returns the compressed form of 'body', from the cache if it has been compressed before
+    key = (hashlib.sha1(body).digest(), coding, level)
+    with cache_lock:
+        data = cache.get(key)
+        if data is not None:
+            cache.move_to_end(key)
+            return data
+    data = b''.join(compress_chunks([body], coding, level))
+    with cache_lock:
+        cache[key] = data
+        while len(cache) > entries:
+            cache.popitem(last=False)
+    return data
+
+def compress_response(environ, content_type, output, cached=False, headers=()):
+    # returns (headers, output) for a response whose body is 'output', a list of byte strings: the body,
+    # compressed if the browser accepts it, and 'headers' (other headers for the response) with the
+    # Content-Length, Content-Encoding and Vary headers.  'cached' marks a response that is the same each
+    # time it is requested (see compress_cached)
+    size = sum(len(chunk) for chunk in output)
+    headers = list(headers)
+    if content_type.split(';')[0].strip().lower() not in compressible_types:
+        return (headers + [('Content-Length', str(size))], output)
+    headers.append(('Vary', 'Accept-Encoding'))
+    coding = accepted_encoding(environ)
+    level = min(setting(environ, 'GCDZ_COMPRESS_LEVEL', default_level), 9)
+    if coding is None or level <= 0 or size < min_size:
+        return (headers + [('Content-Length', str(size))], output)
+    # the compressed page is a different representation, so has its own ETag
+    headers = [(name, coded_etag(value, coding) if name == 'ETag' else value) for (name, value) in headers]
+    headers.append(('Content-Encoding', coding))
+    if len(output) > 1:
+        # sent in chunks: compressed as it is sent, so the length is not known
+        return (headers, compress_chunks(output, coding, level))
+    entries = setting(environ, 'GCDZ_COMPRESS_CACHE', default_cache)
+    if cached and entries > 0:
+        body = compress_cached(output[0], coding, level, entries)
+    else:
+        body = b''.join(compress_chunks(output, coding, level))
+    return (headers + [('Content-Length', str(len(body)))], [body])
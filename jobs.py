@@ -0,0 +1,221 @@
+"""
+ ------------- jobs.py  ------------
+ Background job queue for long-running work started from the website, such as
+ matching long name lists in the cmatch tool.  The web request only adds a row to
+ table gcdz.jobs and returns the job ID.  The work is done by separate worker
+ processes, started from the command line:
+
+     python3 jobs.py [number of workers]
+
+ Each worker claims queued jobs one at a time and runs the handler registered for
+ the job's 'kind' (see job_handlers).  Handlers report progress and partial results
+ as they go, which are saved in the jobs table, so the browser can poll for them
+ (Ajax action 'jobs.status') and the results remain available after the worker has
+ finished.  Workers wait on a PostgreSQL NOTIFY, so new jobs start at once.
+
+ A running job records the server process ID of its worker's connection.  If the
+ worker dies, its connection closes with it, and the job is put back in the queue
+ when the workers are next checked (every check_secs), or failed if it has already
+ been started max_tries times, as it may be the job that stops its worker.
+
+ When the command is stopped (SIGTERM, eg by the service manager), it stops its
+ workers, and each worker stops the processes of the job it is running (such as
+ the xlexport pool) and puts the job back in the queue, so nothing is left
+ running to do the job a second time when the workers are started again.
+"""
+import os, sys, time, json, select, signal, importlib, traceback
+import multiprocessing
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# local modules
+import dbauth
+
+# job kinds, with the module and function that does the work.  A handler is called
+# as handler(params, progress), where params is the dictionary given to submit_job(),
+# and progress(done, total, partial_result) may be called to report progress.
+# The handler returns the final result text.
+job_handlers = {
+    'cmatch': ('gc_dz', 'cmatch_job'),
+    'colink': ('colink', 'colink_job'),
+    'docfetch': ('doccache', 'docfetch_job'),
+    'xlexport': ('xlexport', 'xlexport_job'),
+}
+
+# channel used to notify workers that a job has been queued
+notify_channel = 'gcdz_jobs'
+
+# settings: seconds between checks for workers that have died, times a job is started before it fails,
+# and seconds a process waits for each of its children to stop before killing it
+check_secs = 10
+max_tries = 3
+stop_secs = 30
+
+# process that installed stop_children as its SIGTERM handler.  Processes forked from it, such as those of a
+# job's process pool, inherit the handler, but should simply end
+handler_pid = None
+
+def submit_job(qry, sid, kind, params):
+    # adds a job of type 'kind' to the queue for session 'sid' and returns the new job ID.
+    # qry is an open cursor (autocommit), params a dictionary that can be converted to JSON
+    if kind not in job_handlers:
+        raise RuntimeError("Unknown job type '%s'" % kind)
+    qry.execute("""INSERT INTO gcdz.jobs (sessionid, kind, params, status, progress, total, created)
+        VALUES (%s, %s, %s, 'queued', 0, 0, NOW()) RETURNING jobid""", (sid, kind, json.dumps(params)))
+    jobid = qry.fetchone()[0]
+    qry.execute("NOTIFY %s" % notify_channel)
+    return jobid
+
+def job_status(qry, jobid, sid, result=True):
+    # returns a dictionary with the status of a job, which must belong to the same user as session 'sid'.
+    # Fields are jobid, kind, status (queued, running, done or failed), progress, total, error, and
+    # result (the partial or final result text) if 'result' is True.  Returns None if no such job.
+    qry.execute("""SELECT j.jobid, j.kind, j.status, j.progress, j.total, j.error, %s AS result,
+        j.created::TEXT, j.finished::TEXT FROM gcdz.jobs AS j
+        INNER JOIN gcdz.logins AS a ON j.sessionid=a.sessionid
+        INNER JOIN gcdz.logins AS b ON a.userid=b.userid
+        WHERE j.jobid=%%s AND b.sessionid=%%s""" % ('j.result' if result else "''"), (jobid, sid))
+    if qry.rowcount <= 0:
+        return None
+    return dict(qry.fetchone())
+
+def list_jobs(qry, sid, kind, limit=10):
+    # returns a list of the most recent jobs of type 'kind' for the user of session 'sid' (without results)
+    qry.execute("""SELECT j.jobid, j.status, j.progress, j.total, j.created::TEXT FROM gcdz.jobs AS j
+        INNER JOIN gcdz.logins AS a ON j.sessionid=a.sessionid
+        INNER JOIN gcdz.logins AS b ON a.userid=b.userid
+        WHERE j.kind=%s AND b.sessionid=%s ORDER BY j.jobid DESC LIMIT %s""", (kind, sid, limit))
+    return [dict(row) for row in qry.fetchall()]
+
+def claim_job(qry):
+    # marks the oldest queued job as running and returns it as a dictionary, or None if there are none.
+    # SKIP LOCKED means several workers can claim jobs at the same time without getting the same one.
+    # The job records the server process of this connection, which ends when the worker does
+    qry.execute("""UPDATE gcdz.jobs SET status='running', started=NOW(), worker=pg_backend_pid(),
+            tries=tries + 1 WHERE jobid =
+        (SELECT jobid FROM gcdz.jobs WHERE status='queued' ORDER BY jobid FOR UPDATE SKIP LOCKED LIMIT 1)
+        RETURNING jobid, kind, params""")
+    if qry.rowcount <= 0:
+        return None
+    return dict(qry.fetchone())
+
+def run_job(qry, job):
+    # runs a claimed job, saving progress, partial results and the final status in gcdz.jobs
+    jobid = job['jobid']
+    def progress(done, total, partial=None):
+        qry.execute("UPDATE gcdz.jobs SET progress=%s, total=%s, result=COALESCE(%s, result) WHERE jobid=%s",
+            (done, total, partial, jobid))
+    try:
+        (mdl, fn) = job_handlers[job['kind']]
+        handler = getattr(importlib.import_module(mdl), fn)
+        result = handler(json.loads(job['params']), progress)
+        qry.execute("""UPDATE gcdz.jobs SET status='done', progress=total, result=%s, finished=NOW()
+            WHERE jobid=%s""", (result, jobid))
+    except Exception:
+        qry.execute("UPDATE gcdz.jobs SET status='failed', error=%s, finished=NOW() WHERE jobid=%s",
+            (traceback.format_exc(), jobid))
+
+def worker(wait=30):
+    # worker process main loop: run any queued jobs, then wait up to 'wait' seconds for a notification
+    set_handler()
+    db = dbauth.dbconn()
+    db.autocommit = True
+    qry = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    qry.execute("LISTEN %s" % notify_channel)
+    while True:
+        job = claim_job(qry)
+        if job is not None:
+            try:
+                run_job(qry, job)
+            except SystemExit:
+                # the worker was stopped: the job goes back in the queue, without counting this start
+                qry.execute("""UPDATE gcdz.jobs SET status='queued', progress=0, worker=NULL, tries=tries - 1
+                    WHERE jobid=%s AND status='running'""", (job['jobid'],))
+                raise
+            continue
+        # nothing to do - sleep until notified (or timeout, in case a notification was missed)
+        if select.select([db], [], [], wait) != ([], [], []):
+            db.poll()
+            del db.notifies[:]
+
+def set_handler():
+    # installs stop_children as the SIGTERM handler of this process
+    global handler_pid
+    handler_pid = os.getpid()
+    signal.signal(signal.SIGTERM, stop_children)
+
+def stop_children(signum, frame):
+    # SIGTERM handler of the command and of the workers: stops the child processes (the workers, or the
+    # processes started by a job), waits for them, and exits by raising SystemExit
+    if os.getpid() != handler_pid:
+        # inherited by a child of the process - end as if there were no handler
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        return
+    children = multiprocessing.active_children()
+    for child in children:
+        child.terminate()
+    for child in children:
+        child.join(stop_secs)
+        if child.is_alive():
+            child.kill()
+            child.join()
+    sys.exit(0)
+
+def requeue_jobs(qry):
+    # jobs left 'running' by a worker whose connection has closed (the worker died or was stopped) are put
+    # back in the queue, or failed if they have been started max_tries times.  Returns the number of jobs
+    # put back.  The progress shown starts again from 0, as the job is run again from the start
+    qry.execute("""UPDATE gcdz.jobs AS j SET status=CASE WHEN j.tries < %s THEN 'queued' ELSE 'failed' END,
+            error=CASE WHEN j.tries < %s THEN j.error ELSE 'The job stopped its worker ' || j.tries || ' times' END,
+            finished=CASE WHEN j.tries < %s THEN NULL ELSE NOW() END, progress=0, worker=NULL
+        WHERE j.status='running' AND NOT EXISTS (SELECT 1 FROM pg_stat_activity AS a WHERE a.pid=j.worker)
+        RETURNING j.status""", (max_tries, max_tries, max_tries))
+    queued = len([row for row in qry.fetchall() if row[0] == 'queued'])
+    if queued > 0:
+        qry.execute("NOTIFY %s" % notify_channel)
+    return queued
+
+def check_jobs():
+    # requeue_jobs on a connection of its own, so a check still runs after the database has restarted
+    db = dbauth.dbconn()
+    db.autocommit = True
+    try:
+        return requeue_jobs(db.cursor())
+    finally:
+        db.close()
+
+def run_workers(nworkers):
+    # runs 'nworkers' worker processes until this process is stopped.  The workers are not daemon processes,
+    # so a job can start processes of its own (eg the xlexport pool); on SIGTERM they are stopped in turn
+    # (see stop_children), and on any other exit they are sent SIGTERM
+    set_handler()
+    check_jobs()
+    procs = [multiprocessing.Process(target=worker) for i in range(nworkers)]
+    for p in procs:
+        p.start()
+    print('-- %s job workers started --' % nworkers, flush=True)
+    try:
+        # restart any worker that dies, and put its job back in the queue
+        while True:
+            time.sleep(check_secs)
+            for (i, p) in enumerate(procs):
+                if not p.is_alive():
+                    procs[i] = multiprocessing.Process(target=worker)
+                    procs[i].start()
+            try:
+                check_jobs()
+            except psycopg2.Error:
+                # the database is not available - try again at the next check
+                traceback.print_exc()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+                p.join(stop_secs)
+
+# when run from the command line, starts the worker processes
+if __name__ == '__main__':
+    run_workers(int(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,174 @@
+"""
+ ------------- linkcheck.py  ------------
+ Background validation of document links saved from the F500 input form (see
+ f500_savelink_ajax in gc_dz.py).  Links are saved at once with status 'pending'
+ and then checked on a small pool of worker threads, so a slow or dead host never holds
+ up a web request.  Each check tries a HEAD request first, falling back to a GET
+ of the first byte if the server does not support HEAD, with a strict timeout.
+ Results are cached per URL in table f500.link_checks, so a document referenced
+ by many companies is only checked once, and copied to the status column of
+ every f500.documents row with that URL.
+
+ Links still pending (saved before the checks were added, or whose check was lost
+ when the web server restarted) are checked from the command line, eg by cron:
+
+     python3 linkcheck.py [--limit N]
+"""
+import time, argparse, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import Request, HTTPRedirectHandler, build_opener
+from urllib.error import HTTPError
+
+# local modules
+import dbauth
+
+# settings: request timeout (seconds), worker threads, and how long a result is valid
+timeout = 10
+max_workers = 4
+cache_ttl = '7 days'
+user_agent = 'Mozilla/5.0 (compatible; gc-dz.com link checker)'
+
+# thread pool and the URLs being checked on it, created on first use
+pool = None
+pending = {}
+pool_lock = threading.Lock()
+
+class RedirectHandler(HTTPRedirectHandler):
+    # follows redirects with the same method: urllib otherwise follows a HEAD request's redirect with a GET,
+    # which starts sending the whole document
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+        if new is not None:
+            new.method = req.get_method()
+        return new
+
+# opener used for the checks
+opener = build_opener(RedirectHandler)
+
+def valid_url(url):
+    # returns True if 'url' looks like a complete http, https or ftp URL
+    try:
+        parts = urlparse(url)
+    except ValueError:
+        return False
+    return parts.scheme in ('http', 'https', 'ftp') and parts.netloc > ''
+
+def check_url(url):
+    # checks that 'url' can be opened, without downloading it.  Returns a dictionary with status
+    # ('ok' or 'dead'), HTTP code, content type and length where known, and a message
+    result = {'url': url, 'status': 'dead', 'code': None, 'ctype': None, 'clen': None, 'msg': ''}
+    for method in ('HEAD', 'GET'):
+        req = Request(url, method=method, headers={'User-Agent': user_agent})
+        if method == 'GET':
+            # only the first byte is needed to show the document is there
+            req.add_header('Range', 'bytes=0-0')
+        try:
+            resp = opener.open(req, timeout=timeout)
+            try:
+                result['code'] = resp.getcode()
+                result['ctype'] = resp.headers.get('Content-Type')
+                clen = resp.headers.get('Content-Length')
+                result['clen'] = int(clen) if clen is not None and clen.isdigit() and method == 'HEAD' else None
+                result['status'] = 'ok'
+                result['msg'] = 'OK'
+            finally:
+                resp.close()
+            break
+        except HTTPError as err:
+            result['code'] = err.code
+            result['msg'] = str(err)
+            err.close()
+            # some servers refuse or do not implement HEAD, so try again with GET
+            if method == 'HEAD' and err.code in (400, 403, 405, 501):
+                continue
+            break
+        except Exception as err:
+            # timeouts, DNS and connection errors
+            result['msg'] = str(err)
+            break
+    return result
+
+def cached_status(qry, url):
+    # returns the cached check result for 'url' as a dictionary, or None if not checked recently
+    qry.execute("""SELECT url, status, code, ctype, clen, msg FROM f500.link_checks
+        WHERE url=%s AND checked > NOW() - %s::INTERVAL""", (url, cache_ttl))
+    if qry.rowcount <= 0:
+        return None
+    return dict(qry.fetchone())
+
+def save_result(result, qry=None):
+    # saves a check result in the cache table and in the status of all documents with the URL.  'qry' is an
+    # open cursor (autocommit), or a connection is opened for the save
+    if qry is None:
+        db = dbauth.dbconn()
+        db.autocommit = True
+        try:
+            return save_result(result, db.cursor())
+        finally:
+            db.close()
+    qry.execute("""INSERT INTO f500.link_checks (url, status, code, ctype, clen, msg, checked)
+        VALUES (%(url)s, %(status)s, %(code)s, %(ctype)s, %(clen)s, %(msg)s, NOW())
+        ON CONFLICT (url) DO UPDATE SET status=EXCLUDED.status, code=EXCLUDED.code, ctype=EXCLUDED.ctype,
+        clen=EXCLUDED.clen, msg=EXCLUDED.msg, checked=EXCLUDED.checked""", result)
+    qry.execute("UPDATE f500.documents SET status=%s WHERE url=%s", (result['status'], result['url']))
+
+def run_check(url):
+    # worker thread task: check a URL and save the result
+    try:
+        result = check_url(url)
+        save_result(result)
+    except Exception:
+        # nothing to report back to - leave the document pending, so it can be checked again
+        traceback.print_exc()
+    finally:
+        with pool_lock:
+            pending.pop(url, None)
+
+def submit_check(url):
+    # queues 'url' for checking in the background, unless it is already queued
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+        if url not in pending:
+            pending[url] = pool.submit(run_check, url)
+
+def pending_result(url):
+    # returns a check result for a link not yet checked, in the same form as check_url()
+    return {'url': url, 'status': 'pending', 'code': None, 'ctype': None, 'clen': None, 'msg': 'Link check pending'}
+
+def pending_urls(qry, limit=None):
+    # returns the URLs of documents with status 'pending' (up to 'limit', oldest first).  Those with a cached
+    # result are given it at once, so are not returned
+    qry.execute("""UPDATE f500.documents AS d SET status=l.status FROM f500.link_checks AS l
+        WHERE d.status='pending' AND l.url=d.url AND l.checked > NOW() - %s::INTERVAL""", (cache_ttl,))
+    qry.execute("""SELECT url FROM f500.documents WHERE status='pending' GROUP BY url ORDER BY min(ts) NULLS FIRST, url
+        LIMIT %s""", (limit,))
+    return [row[0] for row in qry.fetchall()]
+
+def check_pending(limit=None):
+    # checks the pending links on a pool of max_workers threads and waits for them.  Returns the number of
+    # URLs checked and the number found dead
+    db = dbauth.dbconn()
+    db.autocommit = True
+    qry = db.cursor()
+    urls = pending_urls(qry, limit)
+    # results are saved as they come in, in the order the URLs were given
+    (checked, dead) = (0, 0)
+    with ThreadPoolExecutor(max_workers=max_workers) as checks:
+        for result in checks.map(check_url, urls):
+            save_result(result, qry)
+            checked += 1
+            if result['status'] == 'dead':
+                dead += 1
+    db.close()
+    return (checked, dead)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the document links still pending')
+    parser.add_argument('--limit', type=int, help='most URLs to check (default all)')
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    (checked, dead) = check_pending(args.limit)
+    print('-- %s links checked, %s dead, in %.1f secs --' % (checked, dead, time.perf_counter() - t0))
@@ -0,0 +1,183 @@
+"""
+ ------------- mailq.py  ------------
+ Outbound mail queue.  Web requests (eg user_login in gc_dz.py) only add messages
+ to table gcdz.mail_queue, which takes a few milliseconds, and never wait for the
+ mail server.  A separate sender process, started from the command line:
+
+     python3 mailq.py
+
+ sends queued messages in batches over one SMTP connection, which is kept open
+ while there is work and closed when the queue is idle.  A message that cannot
+ be sent is retried with increasing delays (retry_delay, doubled for each
+ attempt) up to max_attempts, then marked 'failed'.  Messages refused outright by
+ the server (5xx replies) fail at once.  The status, attempts and last error of
+ every message are kept in the table.
+"""
+import time, select, traceback
+import smtplib
+from email.utils import formatdate
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# local modules
+import dbauth
+
+# settings: mail server, messages sent per batch, retries, and first retry delay (seconds)
+smtp_host = 'localhost'
+smtp_port = 25
+smtp_timeout = 30
+batch_size = 50
+max_attempts = 6
+retry_delay = 60
+
+# channel used to notify the sender that a message has been queued
+notify_channel = 'gcdz_mail'
+
+def queue_mail(qry, fro, to, subject, text):
+    # adds a message to the queue and returns its ID.  qry is an open cursor (autocommit)
+    qry.execute("""INSERT INTO gcdz.mail_queue (mail_from, mail_to, subject, body, status, attempts, next_try, created)
+        VALUES (%s, %s, %s, %s, 'queued', 0, NOW(), NOW()) RETURNING mailid""", (fro, to, subject, text))
+    mailid = qry.fetchone()[0]
+    qry.execute("NOTIFY %s" % notify_channel)
+    return mailid
+
+def mail_status(qry, mailid):
+    # returns a dictionary with the status (queued, sending, sent or failed), attempts, last error and
+    # time sent of a message, or None if there is no such message
+    qry.execute("""SELECT mailid, status, attempts, error, sent::TEXT FROM gcdz.mail_queue WHERE mailid=%s""",
+        (mailid,))
+    if qry.rowcount <= 0:
+        return None
+    return dict(qry.fetchone())
+
+def format_message(row):
+    # returns the text of a queued message with its headers, dated when it was queued
+    return "From: %s\r\nTo: %s\r\nDate: %s\r\nSubject: %s\r\n\r\n%s" % (row['mail_from'], row['mail_to'],
+        formatdate(row['created'].timestamp(), localtime=True), row['subject'], row['body'])
+
+def claim_batch(qry, limit=batch_size):
+    # marks up to 'limit' messages due for sending as 'sending' and returns them as a list of dictionaries
+    qry.execute("""UPDATE gcdz.mail_queue SET status='sending' WHERE mailid IN
+        (SELECT mailid FROM gcdz.mail_queue WHERE status='queued' AND next_try <= NOW()
+        ORDER BY mailid FOR UPDATE SKIP LOCKED LIMIT %s)
+        RETURNING mailid, mail_from, mail_to, subject, body, attempts, created""", (limit,))
+    return sorted([dict(row) for row in qry.fetchall()], key=lambda row: row['mailid'])
+
+def mark_sent(qry, row):
+    # records that a message has been sent
+    qry.execute("""UPDATE gcdz.mail_queue SET status='sent', attempts=attempts+1, error=NULL, sent=NOW()
+        WHERE mailid=%s""", (row['mailid'],))
+
+def mark_failed(qry, row, error, permanent=False):
+    # records a failed attempt, putting the message back in the queue after a delay unless the error
+    # was permanent or it has had max_attempts
+    attempts = row['attempts'] + 1
+    if permanent or attempts >= max_attempts:
+        qry.execute("UPDATE gcdz.mail_queue SET status='failed', attempts=%s, error=%s WHERE mailid=%s",
+            (attempts, error, row['mailid']))
+    else:
+        delay = retry_delay * 2 ** (attempts - 1)
+        qry.execute("""UPDATE gcdz.mail_queue SET status='queued', attempts=%s, error=%s,
+            next_try=NOW() + %s * INTERVAL '1 second' WHERE mailid=%s""", (attempts, error, delay, row['mailid']))
+
+def smtp_connect():
+    # returns an open connection to the mail server
+    return smtplib.SMTP(smtp_host, smtp_port, timeout=smtp_timeout)
+
+def reply_text(code, msg):
+    # returns an SMTP error reply as text, eg '451 local error' (smtplib gives the message as bytes)
+    if isinstance(msg, bytes):
+        msg = msg.decode('utf-8', 'replace')
+    return "%s %s" % (code, msg)
+
+def send_batch(qry, smtp, rows):
+    # sends a batch of claimed messages over the open connection 'smtp', recording the result of each.
+    # Returns the connection, or None if it was lost, in which case the remaining messages are retried later
+    for (n, row) in enumerate(rows):
+        try:
+            refused = smtp.sendmail(row['mail_from'], row['mail_to'], format_message(row))
+            if refused:
+                mark_failed(qry, row, str(refused), permanent=True)
+            else:
+                mark_sent(qry, row)
+        except smtplib.SMTPResponseException as err:
+            # the server replied with an error: 5xx is permanent, 4xx worth trying again
+            mark_failed(qry, row, reply_text(err.smtp_code, err.smtp_error), permanent=err.smtp_code >= 500)
+            if err.smtp_code == 421:
+                # server is closing the connection
+                smtp = None
+        except smtplib.SMTPRecipientsRefused as err:
+            # refused at RCPT: only permanent for a 5xx reply, as 4xx is eg greylisting or a full mailbox
+            codes = [code for (code, msg) in err.recipients.values()]
+            mark_failed(qry, row, '; '.join(reply_text(code, msg) for (code, msg) in err.recipients.values()),
+                permanent=min(codes) >= 500)
+            if 421 in codes:
+                # server has closed the connection
+                smtp = None
+        except (smtplib.SMTPException, OSError) as err:
+            # connection lost or timed out
+            smtp = None
+            mark_failed(qry, row, str(err))
+        if smtp is None:
+            # messages not yet tried go back in the queue without counting an attempt
+            qry.execute("UPDATE gcdz.mail_queue SET status='queued' WHERE mailid = ANY(%s)",
+                ([other['mailid'] for other in rows[n+1:]],))
+            break
+    return smtp
+
+def sender(wait=30, stop=None):
+    # sender process main loop: send queued messages in batches, then wait up to 'wait' seconds for a
+    # notification.  The SMTP connection is opened when there is mail, and closed when the queue is empty.
+    # Runs until threading.Event 'stop' is set, if given, once the queue is empty
+    db = dbauth.dbconn()
+    db.autocommit = True
+    qry = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    qry.execute("LISTEN %s" % notify_channel)
+    smtp = None
+    while True:
+        rows = claim_batch(qry)
+        if len(rows) > 0:
+            try:
+                if smtp is None:
+                    smtp = smtp_connect()
+            except (smtplib.SMTPException, OSError) as err:
+                for row in rows:
+                    mark_failed(qry, row, "Cannot connect to mail server: %s" % err)
+                time.sleep(wait)
+                continue
+            smtp = send_batch(qry, smtp, rows)
+            continue
+        # queue empty - close the connection, and sleep until notified or a retry is due
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            smtp = None
+        if stop is not None and stop.is_set():
+            break
+        if select.select([db], [], [], wait) != ([], [], []):
+            db.poll()
+            del db.notifies[:]
+    db.close()
+
+def reset_queue():
+    # messages left 'sending' when the sender stopped are put back in the queue
+    db = dbauth.dbconn()
+    db.autocommit = True
+    db.cursor().execute("UPDATE gcdz.mail_queue SET status='queued' WHERE status='sending'")
+    db.close()
+
+# when run from the command line, runs the sender, restarting it after any unexpected error
+if __name__ == '__main__':
+    reset_queue()
+    print('-- mail sender started --')
+    while True:
+        try:
+            sender()
+        except Exception:
+            traceback.print_exc()
+            time.sleep(60)
+            reset_queue()
@@ -0,0 +1,143 @@
+"""
+ ------------- metrics.py  ------------
+ In-process metrics for the web application, in the Prometheus text format.
+ application() in gc_dz.py records every request with record_request(), using the
+ timings collected by dbtrace.py, as counters and histograms labelled by module
+ (the m= parameter, or 'ajax' for Ajax requests) and Ajax action:
+
+   gcdz_requests_total             requests, also labelled by HTTP status
+   gcdz_request_errors_total       requests that ended in a program error
+   gcdz_request_seconds            request time (histogram)
+   gcdz_request_db_seconds         time in SQL statements per request (histogram)
+   gcdz_db_queries_total           SQL statements executed
+   gcdz_db_connections_total       database connections opened
+
+ The metrics are shown by module 'metrics' (exec?m=metrics), which needs the token
+ in variable GCDZ_METRICS_TOKEN (set by SetEnv in the Apache configuration, or in
+ the process environment), given as an 'Authorization: Bearer' header or key=
+ parameter (Apache only passes the Authorization header to mod_wsgi with
+ WSGIPassAuthorization On).  Updates are made under a lock, so are safe with
+ several mod_wsgi threads.  Each mod_wsgi process has its own metrics, shown with
+ the process ID in gcdz_process_start_time_seconds.  Latency percentiles are
+ calculated from the histograms by Prometheus (histogram_quantile).
+"""
+import os, time, hmac, threading
+import cgi
+
+# default histogram buckets (seconds)
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# metric name -> (type, help text)
+metric_info = {
+    'gcdz_requests_total': ('counter', 'Requests handled, by module, action and HTTP status'),
+    'gcdz_request_errors_total': ('counter', 'Requests ending in a program error'),
+    'gcdz_request_seconds': ('histogram', 'Request time in seconds'),
+    'gcdz_request_db_seconds': ('histogram', 'Time in SQL statements per request, in seconds'),
+    'gcdz_db_queries_total': ('counter', 'SQL statements executed'),
+    'gcdz_db_connections_total': ('counter', 'Database connections opened'),
+}
+
+# metric values: counters as (name, labels) -> value, histograms as (name, labels) -> [bucket counts, sum, count],
+# where labels is a tuple of (label, value) pairs
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+start_time = time.time()
+
+def inc(name, labels=(), value=1):
+    # adds 'value' to a counter
+    with metrics_lock:
+        counters[(name, labels)] = counters.get((name, labels), 0) + value
+
+def observe(name, value, labels=()):
+    # records a value in a histogram
+    with metrics_lock:
+        hist = histograms.get((name, labels))
+        if hist is None:
+            hist = histograms[(name, labels)] = [[0] * len(time_buckets), 0.0, 0]
+        for (n, bound) in enumerate(time_buckets):
+            if value <= bound:
+                hist[0][n] += 1
+                break
+        hist[1] += value
+        hist[2] += 1
+
+def request_labels(name):
+    # module and action labels for a request named by dbtrace.request_name ('m=module' or 'action=actid').
+    # Requests for unknown modules are grouped as 'other', so labels are limited to registered names
+    if name.startswith('m='):
+        return (('module', name[2:]), ('action', ''))
+    elif name.startswith('action='):
+        return (('module', 'ajax'), ('action', name[7:]))
+    else:
+        return (('module', 'other'), ('action', ''))
+
+def record_request(summary, status):
+    # records a finished request, from its dbtrace summary (see dbtrace.request_end)
+    if summary is None:
+        return
+    labels = request_labels(summary['request'])
+    inc('gcdz_requests_total', labels + (('status', status.split(' ')[0]),))
+    if summary['error']:
+        inc('gcdz_request_errors_total', labels)
+    observe('gcdz_request_seconds', summary['total'], labels)
+    observe('gcdz_request_db_seconds', summary['db'], labels)
+    inc('gcdz_db_queries_total', labels, summary['queries'])
+    inc('gcdz_db_connections_total', labels, summary['connections'])
+
+def label_text(labels, extra=''):
+    # labels in the exposition format, eg {module="f500",action=""}
+    parts = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (k, v) in labels]
+    if extra > '':
+        parts.append(extra)
+    return '{%s}' % ','.join(parts) if len(parts) > 0 else ''
+
+def render():
+    # returns all metrics as text in the Prometheus exposition format (version 0.0.4)
+    with metrics_lock:
+        cvalues = sorted(counters.items())
+        hvalues = sorted((key, (list(h[0]), h[1], h[2])) for (key, h) in histograms.items())
+    lines = ['# HELP gcdz_process_start_time_seconds Start time of this process',
+        '# TYPE gcdz_process_start_time_seconds gauge',
+        'gcdz_process_start_time_seconds{pid="%s"} %s' % (os.getpid(), start_time)]
+    for name in sorted(metric_info):
+        (mtype, helptext) = metric_info[name]
+        lines.append('# HELP %s %s' % (name, helptext))
+        lines.append('# TYPE %s %s' % (name, mtype))
+        if mtype == 'counter':
+            for ((cname, labels), value) in cvalues:
+                if cname == name:
+                    lines.append('%s%s %s' % (name, label_text(labels), value))
+        else:
+            for ((hname, labels), (counts, total, count)) in hvalues:
+                if hname != name:
+                    continue
+                # buckets are cumulative in the exposition format
+                cumulative = 0
+                for (bound, n) in zip(time_buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %s' % (name, label_text(labels, 'le="%s"' % bound), cumulative))
+                lines.append('%s_bucket%s %s' % (name, label_text(labels, 'le="+Inf"'), count))
+                lines.append('%s_sum%s %s' % (name, label_text(labels), total))
+                lines.append('%s_count%s %s' % (name, label_text(labels), count))
+    return '\n'.join(lines) + '\n'
+
+def authorised(environ):
+    # returns True if the request gives the metrics token, as a bearer token or key= parameter.
+    # If no token is set, the metrics are not available
+    token = environ.get('GCDZ_METRICS_TOKEN') or os.environ.get('GCDZ_METRICS_TOKEN', '')
+    if token == '':
+        return False
+    given = environ.get('HTTP_AUTHORIZATION', '')
+    if given.startswith('Bearer '):
+        given = given[7:]
+    else:
+        given = cgi.parse_qs(environ.get('QUERY_STRING', '')).get('key', [''])[0]
+    return hmac.compare_digest(given.encode(), token.encode())
+
+def metrics_page(environ):
+    # handles module 'metrics'.  Returns a tuple (status, content type, text)
+    if not authorised(environ):
+        return ('403 Forbidden', 'text/plain', 'Access denied\n')
+    return ('200 OK', 'text/plain; version=0.0.4', render())
@@ -0,0 +1,159 @@
+"""
+ ------------- namematch.py  ------------
+ Batch company name matching for the cmatch tool in gc_dz.py.  A list of names
+ (possibly thousands, pasted from a supplier list) is matched against a 'universe'
+ of known companies in one pass:
+ - every distinct input name is normalised once with namenorm.name_frags()
+ - the universe is indexed by blocking keys (first word, sorted words, and a
+   phonetic key for the first word), so each name is only compared with the
+   few companies sharing a key, not with the whole universe
+ - names are scored against all of their candidates together, with array
+   operations: the token IDs (and phonetic key IDs) of the universe are held in
+   flat NumPy arrays, one entry per company-token pair, so the overlap of a name
+   with every candidate in its block is a single isin and bincount
+ The universe is a list of dictionaries with at least a 'coname' field.
+ load_universe() provides the local universe of Forest 500 companies from the
+ xlcohdr and coflids tables, so no external service is needed.  The index does
+ not depend on the names matched, so callers keep it between requests (see
+ universe_index_get in gc_dz.py).
+"""
+import time
+import numpy as np
+from namenorm import name_frags
+
+# Soundex letter codes for phonetic_key().  Vowels and h, w, y are not coded
+soundex_codes = {}
+for (letters, code) in [('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')]:
+    for ch in letters:
+        soundex_codes[ch] = code
+
+def phonetic_key(word):
+    # returns the 4-character Soundex code for a word (lower case letters a-z), eg 'robert' -> 'r163'
+    if word == '':
+        return ''
+    key = word[0]
+    last = soundex_codes.get(word[0], '')
+    for ch in word[1:]:
+        code = soundex_codes.get(ch, '')
+        if code > '' and code != last:
+            key += code
+            if len(key) == 4:
+                break
+        # h and w do not separate letters with the same code, vowels do
+        if ch not in 'hw':
+            last = code
+    return (key + '000')[:4]
+
+def name_tokens(name):
+    # normalised, non-empty fragments of a name as a list
+    return [t for t in name_frags(name) if t > '']
+
+def block_keys(tokens):
+    # blocking keys for a list of name tokens: first word, sorted words and phonetic key of first word
+    if len(tokens) == 0:
+        return []
+    return ['F:' + tokens[0], 'S:' + ' '.join(sorted(tokens)), 'P:' + phonetic_key(tokens[0])]
+
+def token_ids(keys, vocab):
+    # IDs of the distinct keys in a list that are in 'vocab' (key -> ID), as an array, and the number
+    # of distinct keys, known or not
+    keys = set(keys)
+    return (np.array([vocab[k] for k in keys if k in vocab], dtype=np.int32), len(keys))
+
+def add_ids(keys, vocab, ids):
+    # appends the IDs of the distinct keys in a list to list 'ids', adding new keys to 'vocab'.
+    # Returns the number of IDs added
+    keys = set(keys)
+    for k in keys:
+        ids.append(vocab.setdefault(k, len(vocab)))
+    return len(keys)
+
+def build_index(universe):
+    # builds a matching index for a universe of companies (list of dictionaries with a 'coname' field).
+    # Returns a dictionary with:
+    #   'items'  - the universe list
+    #   'vocab'  - token -> token ID, with 'tok' the token IDs of all items in item order, and 'ptr' the
+    #              start of each item's IDs in 'tok' (and the end of the last)
+    #   'pvocab' - phonetic key -> ID, with 'ptok' and 'pptr' the phonetic key IDs of the items
+    #   'blocks' - blocking key -> array of item positions
+    index = {'items': universe, 'vocab': {}, 'pvocab': {}, 'blocks': {}}
+    (tok, ptok, sizes, psizes) = ([], [], [], [])
+    for (pos, item) in enumerate(universe):
+        tokens = name_tokens(item['coname'])
+        sizes.append(add_ids(tokens, index['vocab'], tok))
+        psizes.append(add_ids([phonetic_key(t) for t in tokens], index['pvocab'], ptok))
+        for key in block_keys(tokens):
+            index['blocks'].setdefault(key, []).append(pos)
+    index['tok'] = np.array(tok, dtype=np.int32)
+    index['ptr'] = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+    index['ptok'] = np.array(ptok, dtype=np.int32)
+    index['pptr'] = np.concatenate(([0], np.cumsum(psizes, dtype=np.int64)))
+    for key in index['blocks']:
+        index['blocks'][key] = np.array(index['blocks'][key], dtype=np.int64)
+    return index
+
+def overlap(ids, ptr, query, cands):
+    # for each candidate position in array 'cands', the number of its IDs (held in 'ids' from ptr[pos]
+    # to ptr[pos + 1]) that are in array 'query', and the number of its IDs.  Returns two arrays
+    starts = ptr[cands]
+    sizes = ptr[cands + 1] - starts
+    # entry numbers in 'ids' of all the candidates' IDs, with the candidate each belongs to
+    owner = np.repeat(np.arange(len(cands)), sizes)
+    entries = starts[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    both = np.bincount(owner[np.isin(ids[entries], query)], minlength=len(cands))
+    return (both, sizes)
+
+def score_candidates(tokens, cands, index):
+    # scores one name (list of tokens) against an array of candidate positions in the index.
+    # The score is the Jaccard similarity of the two sets of tokens, |A and B| / |A or B|, or
+    # 0.9 times the Jaccard similarity of their phonetic keys if that is higher, so that small
+    # spelling differences still score well.  Unknown tokens only count towards the union.
+    # Returns an array of scores, one per candidate
+    (query, nquery) = token_ids(tokens, index['vocab'])
+    (both, sizes) = overlap(index['tok'], index['ptr'], query, cands)
+    either = sizes + nquery - both
+    scores = np.divide(both, either, out=np.zeros(len(cands)), where=either > 0)
+    (query, nquery) = token_ids([phonetic_key(t) for t in tokens], index['pvocab'])
+    (both, sizes) = overlap(index['ptok'], index['pptr'], query, cands)
+    either = sizes + nquery - both
+    return np.maximum(scores, 0.9 * np.divide(both, either, out=np.zeros(len(cands)), where=either > 0))
+
+def match_names(names, index, threshold=0.5, limit=3):
+    # matches a list of names against an index from build_index().
+    # Returns a tuple (results, stats).  'results' is a dictionary of name -> list of up to 'limit'
+    # matches as (score, item) tuples, best first, with scores >= 'threshold'.  Names with no
+    # match get an empty list.  'stats' is a dictionary with counts of names, distinct names,
+    # comparisons made, elapsed seconds and the throughput in names/sec.
+    t0 = time.perf_counter()
+    results = {}
+    comparisons = 0
+    # normalise each distinct name once
+    distinct = list(dict.fromkeys(names))
+    for nm in distinct:
+        tokens = name_tokens(nm)
+        # candidate items are those sharing any blocking key
+        blocks = [index['blocks'][key] for key in block_keys(tokens) if key in index['blocks']]
+        if len(blocks) == 0:
+            results[nm] = []
+            continue
+        cands = np.unique(np.concatenate(blocks))
+        comparisons += len(cands)
+        scores = score_candidates(tokens, cands, index)
+        keep = np.flatnonzero(scores >= threshold)
+        # best first, ties by position in the universe
+        keep = keep[np.lexsort((cands[keep], -scores[keep]))][:limit]
+        results[nm] = [(float(scores[n]), index['items'][cands[n]]) for n in keep]
+    secs = time.perf_counter() - t0
+    stats = {'names': len(names), 'distinct': len(distinct), 'comparisons': comparisons,
+        'secs': secs, 'rate': len(names) / secs if secs > 0 else 0.0}
+    return (results, stats)
+
+def load_universe(qry):
+    # loads the local universe of Forest 500 company files, with unique company IDs where linked.
+    # qry is an open DictCursor.  Returns a list of dictionaries (flid, coname, cotype, ayear, ucid)
+    qry.execute("""SELECT x.flid, x.coname, d.cotype, d.ayear, c.ucid FROM f500.xlcohdr AS x
+        INNER JOIN f500.filelist AS f ON x.flid=f.flid
+        INNER JOIN f500.dirtree AS d ON d.dtid=f.dtid
+        LEFT JOIN f500.coflids AS c ON c.flid=x.flid
+        WHERE x.coname IS NOT NULL ORDER BY x.flid""")
+    return [dict(row) for row in qry.fetchall()]
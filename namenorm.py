@@ -0,0 +1,106 @@
+"""
+ ------------- namenorm.py  ------------
+ Company name normaliser for the name matching tools in gc_dz.py.  name_frags()
+ splits a company name into standardised fragments (lower case, accents removed,
+ punctuation and common stopwords such as 'ltd', 'group', 'sa' dropped).  All the
+ regular expressions are compiled once at import, transliteration is skipped for
+ plain ASCII names and cached otherwise, and results are memoised in an LRU cache,
+ as the same names are normalised over and over by the search and matching tools.
+
+ The output is identical to the original name_frags() in gc_dz.py, which is kept
+ here as name_frags_legacy(): tests/test_namenorm.py checks the two on a fixed
+ corpus of names.  Run from the command line to check them against all names in
+ f500.xlcohdr as well, and to compare throughput of the two versions.
+"""
+import re, time, functools
+import unidecode
+
+# list of words that are to be removed, in the order they are applied
+stopwords = ['ltd', 'co', 'group', 'sa', 'inc', '&', 'holdings', 'and', 'corp', 'pt', 'international', 'de', \
+            'the', 'corporation', 'y', 'plc', 'of', 'limited', 'grupo', 'ag', 'as', 'j', 'ooo', 'company', 'holding', 'i', 'gmbh']
+# compiled patterns for name_frags()
+xlext_rgx = re.compile(r'\.xls[x|m]\s*$')                       # .xlsx or .xlsm at end of string
+nonalpha_rgx = re.compile(r'[^\sa-z]')                          # anything that is not a letter or whitespace
+letters_rgx = re.compile(r'(?<![a-z])([a-z])\s(?![a-z]{2})')    # single letters to be merged together
+split_rgx = re.compile(r'\s+')                                  # word boundaries
+nonascii_rgx = re.compile(r'[^\x00-\x7f]')                      # any character that needs transliterating
+# one pattern per stopword.  These must still be applied one after the other, as a removal consumes
+# the spaces either side of the word, so that eg 'ltd co' leaves ' co' after 'ltd' is removed and
+# then ' ' after 'co'.  A single alternation would not match the second word, and give a different result.
+stopword_rgx = [(sw, re.compile("(^|[ ])%s($|[ ])" % re.escape(sw))) for sw in stopwords]
+
+@functools.lru_cache(maxsize=4096)
+def translit(text):
+    # cached conversion of accented and non-latin characters to plain ASCII
+    return unidecode.unidecode(text)
+
+@functools.lru_cache(maxsize=65536)
+def name_key(name):
+    # returns the fragments of 'name' as a tuple (so it can be cached and used as a dictionary key)
+    nm = name.lower()                           # convert to lower case
+    nm = xlext_rgx.sub('', nm)                  # remove .xlsx or .xlsm at end of string
+    if nonascii_rgx.search(nm):
+        nm = translit(nm)                       # clean up accented characters
+    nm = nonalpha_rgx.sub(' ', nm)              # remove anything else that is not a letter or whitespace
+    nm = letters_rgx.sub(r'\1', nm)             # merge any single letters together
+    # a stopword pattern can only match a whole whitespace-delimited word, and removing words never
+    # creates new ones, so only the patterns for words actually present in the name need to be run
+    words = set(nm.split())
+    if not words.isdisjoint(stopwords):
+        for (sw, rgx) in stopword_rgx:
+            if sw in words:
+                nm = rgx.sub(' ', nm)           # filter out unwanted words
+    return tuple(split_rgx.split(nm))           # split at word boundaries
+
+def name_frags(name):
+    # splits a name into standardised fragments and returns them as a list
+    # (a new list each time, so callers are free to modify it)
+    return list(name_key(name))
+
+def name_frags_legacy(name):
+    # original version of name_frags() from gc_dz.py, retained as the reference for checking
+    nm = name.lower()                           # convert to lower case
+    nm = re.sub('\\.xls[x|m]\\s*$','', nm)        # remove .xlsx or .xlsm at end of string
+    nm = unidecode.unidecode(nm)                # clean up accented characters
+    nm = re.sub('[^\\sa-z]', ' ', nm)             # remove anything else that is not a letter, whitespace or hyphen
+    nm = re.sub(r'(?<![a-z])([a-z])\s(?![a-z]{2})', r'\1', nm)     # merge any single letters together
+    for sw in stopwords:
+        rgx = "(^|[ ])%s($|[ ])" % sw
+        nm = re.sub(rgx,' ', nm)                # filter out unwanted words
+    nm = re.split('\\s+', nm)                    # split at word boundaries
+    return nm
+
+def check_names(names):
+    # golden check and benchmark.  Compares name_frags() with name_frags_legacy() for each name in the
+    # list 'names', and times both.  Returns a tuple (mismatches, legacy names/sec, new names/sec),
+    # where mismatches is a list of names giving different results
+    mismatches = [nm for nm in names if name_frags(nm) != name_frags_legacy(nm)]
+    t0 = time.perf_counter()
+    for nm in names:
+        name_frags_legacy(nm)
+    t1 = time.perf_counter()
+    # new version timed from cold, then again with the memo populated
+    name_key.cache_clear()
+    for nm in names:
+        name_frags(nm)
+    t2 = time.perf_counter()
+    for nm in names:
+        name_frags(nm)
+    t3 = time.perf_counter()
+    rate = lambda t: len(names) / t if t > 0 else 0.0
+    return (mismatches, rate(t1 - t0), rate(t2 - t1), rate(t3 - t2))
+
+# when run from the command line, checks all company names in the xlcohdr table
+if __name__ == '__main__':
+    import dbauth
+    db = dbauth.dbconn()
+    qry = db.cursor()
+    qry.execute("SELECT coname FROM f500.xlcohdr WHERE coname IS NOT NULL ORDER BY flid")
+    names = [row[0] for row in qry.fetchall()]
+    (mismatches, legacy_rate, cold_rate, warm_rate) = check_names(names)
+    for nm in mismatches:
+        print('MISMATCH: %r  %s  %s' % (nm, name_frags_legacy(nm), name_frags(nm)))
+    print('%s names checked, %s mismatches' % (len(names), len(mismatches)))
+    print('legacy name_frags : %10.0f names/sec' % legacy_rate)
+    print('name_frags (cold) : %10.0f names/sec' % cold_rate)
+    print('name_frags (memo) : %10.0f names/sec' % warm_rate)
@@ -0,0 +1,280 @@
+-- Database changes required by gc_dz.py, in the order they were introduced.
+-- Apply to the trasepad database with psql before deploying the matching code.
+
+-- match cache for trase/NA name lookups (see traseMatch in gc_dz.py)
+-- mkey is the normalised name plus match parameters, matches the JSON text of the api.match() result
+CREATE TABLE IF NOT EXISTS gcdz.match_cache (
+    mkey     TEXT PRIMARY KEY,
+    matches  TEXT NOT NULL,
+    ts       TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- background job queue (see jobs.py)
+CREATE TABLE IF NOT EXISTS gcdz.jobs (
+    jobid     SERIAL PRIMARY KEY,
+    sessionid TEXT NOT NULL,
+    kind      TEXT NOT NULL,
+    params    TEXT NOT NULL,
+    status    TEXT NOT NULL DEFAULT 'queued',
+    progress  INTEGER NOT NULL DEFAULT 0,
+    total     INTEGER NOT NULL DEFAULT 0,
+    result    TEXT,
+    error     TEXT,
+    created   TIMESTAMP NOT NULL DEFAULT NOW(),
+    started   TIMESTAMP,
+    finished  TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS jobs_status_idx ON gcdz.jobs (status, jobid);
+-- server process ID of the connection of the worker running a job, and the number of times the job has
+-- been started, so the jobs of workers that died can be put back in the queue (see jobs.requeue_jobs)
+ALTER TABLE gcdz.jobs ADD COLUMN IF NOT EXISTS worker INTEGER;
+ALTER TABLE gcdz.jobs ADD COLUMN IF NOT EXISTS tries INTEGER NOT NULL DEFAULT 0;
+
+-- company link suggestions for the Company Linking Tool (see colink.py)
+-- cluster groups files proposed for the same company; ucid_proposed is NULL where a new ucid is needed
+CREATE TABLE IF NOT EXISTS f500.colink_suggest (
+    sugid          SERIAL PRIMARY KEY,
+    flid           INTEGER NOT NULL,
+    ucid_current   INTEGER,
+    ucid_proposed  INTEGER,
+    cluster        INTEGER NOT NULL,
+    score          REAL NOT NULL,
+    status         TEXT NOT NULL DEFAULT 'open',
+    ts             TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS colink_suggest_status_idx ON f500.colink_suggest (status, flid);
+
+-- background checks of document links (see linkcheck.py)
+-- status of each saved link: 'pending' until checked, then 'ok' or 'dead'.  Links saved before the checks
+-- were added, and never checked, are pending (see check_pending in linkcheck.py)
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending';
+ALTER TABLE f500.documents ALTER COLUMN status SET DEFAULT 'pending';
+CREATE INDEX IF NOT EXISTS documents_url_idx ON f500.documents (url);
+CREATE TABLE IF NOT EXISTS f500.link_checks (
+    url      TEXT PRIMARY KEY,
+    status   TEXT NOT NULL,
+    code     INTEGER,
+    ctype    TEXT,
+    clen     BIGINT,
+    msg      TEXT,
+    checked  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+UPDATE f500.documents AS d SET status='pending' WHERE d.status='ok'
+    AND NOT EXISTS (SELECT 1 FROM f500.link_checks AS l WHERE l.url=d.url);
+
+-- local cache of linked documents (see doccache.py)
+-- files are stored under their SHA-256 hash; doc_store holds one row per distinct file
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS sha256 TEXT;
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS size BIGINT;
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS ctype TEXT;
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS fetched TIMESTAMP;
+ALTER TABLE f500.documents ADD COLUMN IF NOT EXISTS fetchmsg TEXT;
+CREATE INDEX IF NOT EXISTS documents_flid_inid_idx ON f500.documents (flid, inid);
+CREATE TABLE IF NOT EXISTS f500.doc_store (
+    sha256   TEXT PRIMARY KEY,
+    size     BIGINT NOT NULL,
+    ctype    TEXT,
+    doctext  TEXT NOT NULL DEFAULT '',
+    fetched  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS doc_store_text_idx ON f500.doc_store USING GIN (to_tsvector('english', doctext));
+
+-- outbound mail queue (see mailq.py)
+CREATE TABLE IF NOT EXISTS gcdz.mail_queue (
+    mailid     SERIAL PRIMARY KEY,
+    mail_from  TEXT NOT NULL,
+    mail_to    TEXT NOT NULL,
+    subject    TEXT NOT NULL,
+    body       TEXT NOT NULL,
+    status     TEXT NOT NULL DEFAULT 'queued',
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    error      TEXT,
+    next_try   TIMESTAMP NOT NULL DEFAULT NOW(),
+    created    TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent       TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS mail_queue_status_idx ON gcdz.mail_queue (status, next_try);
+
+-- data versions for the ETags of the F500 assessment and listing pages (see httpcache.py)
+-- each scope counts the statements that changed the data shown by a page: 'flid:N' for a company file
+-- (assessment data, name, file and links), 'list' for the company listings and 'ref' for the indicator
+-- and commodity definitions, and 'xlco' for the company names, files and years held by the in-memory name
+-- index of gc_dz.py (see xlco_index_get), with 'links' for the company IDs of the files (for the universe of
+-- local name matching, see universe_index_get), and 'users' for the users' e-mail addresses (shown as the
+-- editor of each file by listing option 4).  Kept by statement triggers, so every program changing the data
+-- is covered
+CREATE TABLE IF NOT EXISTS f500.data_versions (
+    scope    TEXT PRIMARY KEY,
+    version  BIGINT NOT NULL DEFAULT 1,
+    changed  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE OR REPLACE FUNCTION f500.bump_versions() RETURNS trigger LANGUAGE plpgsql AS $$
+-- if the statement changed any rows (transition tables new_rows/old_rows), adds 1 to the version of each
+-- scope given as an argument.  The argument 'flid' stands for the scope of each company file changed
+DECLARE
+    scopes TEXT[] := '{}';
+BEGIN
+    IF 'flid' = ANY(TG_ARGV) THEN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            scopes := scopes || ARRAY(SELECT DISTINCT 'flid:' || flid FROM new_rows);
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            scopes := scopes || ARRAY(SELECT DISTINCT 'flid:' || flid FROM old_rows);
+        END IF;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        PERFORM 1 FROM old_rows LIMIT 1;
+    ELSE
+        PERFORM 1 FROM new_rows LIMIT 1;
+    END IF;
+    IF FOUND THEN
+        scopes := scopes || array_remove(TG_ARGV::TEXT[], 'flid');
+    END IF;
+    -- in scope order, so concurrent statements lock the rows in the same order
+    INSERT INTO f500.data_versions (scope) SELECT DISTINCT scope FROM unnest(scopes) AS scope ORDER BY scope
+        ON CONFLICT (scope) DO UPDATE SET version = f500.data_versions.version + 1, changed = NOW();
+    RETURN NULL;
+END $$;
+DO $$
+DECLARE
+    trg RECORD;
+    op TEXT;
+    name TEXT;
+BEGIN
+    FOR trg IN SELECT * FROM (VALUES ('xldata', 'flid'), ('coflids', 'flid,links'), ('xlcohdr', 'flid,list,xlco'),
+            ('filelist', 'flid,list,xlco'), ('commodity_scores', 'list'), ('survey_status', 'list'),
+            ('comtraders', 'list'), ('commodities', 'list,ref'), ('dirtree', 'list,ref,xlco'), ('ind_groups', 'ref'),
+            ('ind_main', 'ref'), ('ind_detail', 'ref'), ('cscore_cells', 'ref'), ('assmnt_parts', 'ref'))
+            AS t (tbl, scopes) LOOP
+        FOREACH op IN ARRAY ARRAY['INSERT', 'UPDATE', 'DELETE'] LOOP
+            name := format('%s_versions_%s', trg.tbl, lower(op));
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON f500.%I', name, trg.tbl);
+            EXECUTE format('CREATE TRIGGER %I AFTER %s ON f500.%I REFERENCING %s FOR EACH STATEMENT
+                EXECUTE PROCEDURE f500.bump_versions(%s)', name, op, trg.tbl,
+                CASE op WHEN 'INSERT' THEN 'NEW TABLE AS new_rows' WHEN 'DELETE' THEN 'OLD TABLE AS old_rows'
+                    ELSE 'OLD TABLE AS old_rows NEW TABLE AS new_rows' END,
+                (SELECT string_agg(quote_literal(a), ', ') FROM unnest(string_to_array(trg.scopes, ',')) AS a));
+        END LOOP;
+    END LOOP;
+    FOREACH op IN ARRAY ARRAY['INSERT', 'UPDATE', 'DELETE'] LOOP
+        name := format('users_versions_%s', lower(op));
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON gcdz.users', name);
+        EXECUTE format('CREATE TRIGGER %I AFTER %s ON gcdz.users REFERENCING %s FOR EACH STATEMENT
+            EXECUTE PROCEDURE f500.bump_versions(%L)', name, op,
+            CASE op WHEN 'INSERT' THEN 'NEW TABLE AS new_rows' WHEN 'DELETE' THEN 'OLD TABLE AS old_rows'
+                ELSE 'OLD TABLE AS old_rows NEW TABLE AS new_rows' END, 'users');
+    END LOOP;
+END $$;
+
+-- permission for the SQL query tool (Ajax actions sql.query and sql.cancel, see sqltool.py).  Not shown on
+-- the menu (prtorder 0); give it to administrators by setting this bit in gcdz.users.permit
+INSERT INTO gcdz.menus (module, menutext, permitflag, prtorder)
+    SELECT 'sqlq', 'SQL query tool', 1024, 0 WHERE NOT EXISTS (SELECT 1 FROM gcdz.menus WHERE module='sqlq');
+
+-- hash of the contents of each workbook when it was imported, so files touched but not changed are not
+-- read again (see xlimport.py)
+ALTER TABLE f500.filelist ADD COLUMN IF NOT EXISTS flhash TEXT;
+
+-- module for the cached copies of linked documents (see doccache.py), linked from the indicator notes of
+-- the assessments and the input form, so permitted to users of either (modules f500a and f500b).  Not
+-- shown on the menu
+INSERT INTO gcdz.menus (module, menutext, permitflag, prtorder)
+    SELECT 'doc', 'Cached document', bit_or(permitflag), 0 FROM gcdz.menus WHERE module IN ('f500a', 'f500b')
+    HAVING count(*) > 0 AND NOT EXISTS (SELECT 1 FROM gcdz.menus WHERE module='doc');
+
+-- module for downloading workbooks exported from the assessments (see xlexport.py), with the same
+-- permission as the assessments (module f500a).  Not shown on the menu
+INSERT INTO gcdz.menus (module, menutext, permitflag, prtorder)
+    SELECT 'xlx', 'Forest 500 workbook export', permitflag, 0 FROM gcdz.menus
+    WHERE module='f500a' AND NOT EXISTS (SELECT 1 FROM gcdz.menus WHERE module='xlx');
+
+-- scores of the assessments (see scoring.py): the score cells of each indicator detail row, for each year
+-- and company type (cid 0 if not commodity-specific), and the points of each indicator of a file
+CREATE OR REPLACE VIEW f500.score_cells AS
+    SELECT g.ayear, g.cotype, d.inid, COALESCE(d.cid, 0) AS cid, p.xlcol || d.xlrow AS xlcell, m.maxpts
+    FROM f500.ind_detail AS d
+    INNER JOIN f500.ind_groups AS g ON g.igid = d.inid / 100
+    INNER JOIN (SELECT inid, max(maxpts) AS maxpts FROM f500.ind_main GROUP BY inid) AS m ON m.inid=d.inid
+    INNER JOIN f500.assmnt_parts AS p ON p.atype=d.atype AND p.ptype IN ('B', 'C');
+CREATE TABLE IF NOT EXISTS f500.indicator_scores (
+    flid     INTEGER NOT NULL,
+    inid     INTEGER NOT NULL,
+    cid      INTEGER NOT NULL,
+    points   REAL NOT NULL,
+    maxpts   REAL NOT NULL,
+    PRIMARY KEY (flid, inid, cid)
+);
+-- commodity scores are updated in place, so each file and commodity must have one row
+DELETE FROM f500.commodity_scores AS a USING f500.commodity_scores AS b
+    WHERE a.flid=b.flid AND a.cid=b.cid AND a.ctid < b.ctid;
+CREATE UNIQUE INDEX IF NOT EXISTS commodity_scores_flid_cid_idx ON f500.commodity_scores (flid, cid);
+
+-- values of the assessment sheet of each company file as one document, keyed by cell reference (see
+-- xldocs.py).  Kept in step with f500.xldata by statement triggers: each cell changed is read again from
+-- xldata (the last xlid if a cell is held twice), and set in or removed from its file's document.  A file
+-- without a document gets one made from all its cells
+CREATE TABLE IF NOT EXISTS f500.xldocs (
+    flid     INTEGER PRIMARY KEY,
+    cells    JSONB NOT NULL DEFAULT '{}',
+    updated  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE OR REPLACE FUNCTION f500.sync_xldocs() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    flids INTEGER[] := '{}';
+    cells TEXT[] := '{}';
+    created INTEGER[];
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT flids || array_agg(flid), cells || array_agg(xlcell) INTO flids, cells FROM new_rows;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT flids || array_agg(flid), cells || array_agg(xlcell) INTO flids, cells FROM old_rows;
+    END IF;
+    IF flids IS NULL OR cardinality(flids) = 0 THEN
+        RETURN NULL;
+    END IF;
+    -- documents of files that have none, from all their cells
+    WITH made AS (INSERT INTO f500.xldocs (flid, cells)
+        SELECT x.flid, jsonb_object_agg(x.xlcell, x.xltext ORDER BY x.xlid) FROM f500.xldata AS x
+        WHERE x.flid IN (SELECT DISTINCT c.flid FROM unnest(flids) AS c(flid)
+            WHERE NOT EXISTS (SELECT 1 FROM f500.xldocs AS d WHERE d.flid=c.flid))
+            AND x.xlcell IS NOT NULL
+        GROUP BY x.flid ORDER BY x.flid
+        ON CONFLICT (flid) DO NOTHING RETURNING flid)
+    SELECT COALESCE(array_agg(flid), '{}') INTO created FROM made;
+    -- then the cells changed in the other documents
+    UPDATE f500.xldocs AS d SET cells = (d.cells - c.keys) || c.vals, updated = NOW()
+        FROM (SELECT c.flid, array_agg(c.xlcell) AS keys,
+                COALESCE(jsonb_object_agg(c.xlcell, c.xltext) FILTER (WHERE c.found), '{}') AS vals
+            FROM (SELECT DISTINCT ON (c.flid, c.xlcell) c.flid, c.xlcell, x.xltext, x.xlid IS NOT NULL AS found
+                FROM unnest(flids, cells) AS c(flid, xlcell)
+                LEFT JOIN f500.xldata AS x ON x.flid=c.flid AND x.xlcell=c.xlcell
+                WHERE c.flid IS NOT NULL AND c.xlcell IS NOT NULL AND c.flid NOT IN (SELECT unnest(created))
+                ORDER BY c.flid, c.xlcell, x.xlid DESC NULLS LAST) AS c
+            GROUP BY c.flid) AS c
+        WHERE d.flid=c.flid;
+    RETURN NULL;
+END $$;
+DO $$
+DECLARE
+    op TEXT;
+BEGIN
+    FOREACH op IN ARRAY ARRAY['INSERT', 'UPDATE', 'DELETE'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON f500.xldata', 'xldata_docs_' || lower(op));
+        EXECUTE format('CREATE TRIGGER %I AFTER %s ON f500.xldata REFERENCING %s FOR EACH STATEMENT
+            EXECUTE PROCEDURE f500.sync_xldocs()', 'xldata_docs_' || lower(op), op,
+            CASE op WHEN 'INSERT' THEN 'NEW TABLE AS new_rows' WHEN 'DELETE' THEN 'OLD TABLE AS old_rows'
+                ELSE 'OLD TABLE AS old_rows NEW TABLE AS new_rows' END);
+    END LOOP;
+END $$;
+-- documents of the files already in xldata that have none (as 'python3 xldocs.py' does), so the forms,
+-- which read the documents, show every file's values once this has run.  No cells change meanwhile
+DO $$
+BEGIN
+    LOCK TABLE f500.xldata IN SHARE MODE;
+    INSERT INTO f500.xldocs (flid, cells)
+        SELECT x.flid, jsonb_object_agg(x.xlcell, x.xltext ORDER BY x.xlid) FROM f500.xldata AS x
+        WHERE x.xlcell IS NOT NULL AND NOT EXISTS (SELECT 1 FROM f500.xldocs AS d WHERE d.flid=x.flid)
+        GROUP BY x.flid
+        ON CONFLICT (flid) DO NOTHING;
+END $$;
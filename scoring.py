@@ -0,0 +1,173 @@
+"""
+ ------------- scoring.py  ------------
+ Scores of the Forest 500 assessments, as shown by the Summary scores listing
+ (f500_main, list option 1).  Each indicator detail row (f500.ind_detail) has a
+ score cell in the assessment sheet: the part of its assessment type with ptype
+ 'B' or 'C' (f500.assmnt_parts), in the row of the detail.  View f500.score_cells
+ (see schema_updates.sql) maps each of these cells, for a year and company type,
+ to the indicator and commodity it counts towards, so the scores affected by a
+ change to a cell are known without reading the rest of the sheet.
+
+ Scores are kept at two levels:
+   f500.indicator_scores  points of an indicator for a file and commodity (cid 0
+                          if not commodity-specific): the sum of its score cells,
+                          up to the indicator's maxpts
+   f500.commodity_scores  score of a file for a commodity: the points of the
+                          general indicators and those of the commodity, as a
+                          fraction of their maxpts.  The total score (cid 0)
+                          counts the general indicators and those of the
+                          commodities assessed (cscore_cells holding Y or 1)
+
+ When a cell is saved on the data input form (f500_select_ajax, f500_input_ajax
+ in gc_dz.py), rescore_cells recomputes only the indicators whose score cells
+ changed, then the commodity scores they count towards and the total, for that
+ file, in the same transaction as the save.  A change to an assessed commodity
+ flag recomputes the file's commodity scores.  rebuild recomputes everything for
+ a list of files or for all of them, eg after an import (see xlimport.py) or a
+ change to the indicator definitions:
+
+     python3 scoring.py [FLID ...] [--year YEAR]
+
+ Changes to the scores of a file are serialized by an advisory lock on the file,
+ so two edits at the same time cannot leave a total made from stale indicators;
+ a rebuild of all files takes a lock that excludes the others.
+"""
+import time, argparse
+
+# local modules
+import dbauth
+
+# key of the advisory locks (the lock on key 0 covers all the files, see lock_files)
+lock_key = 'f500.scoring'
+
+# company files in scope (all if %(FLIDS)s is NULL), with their year and type
+files_sql = """SELECT f.flid, d.ayear, d.cotype FROM f500.filelist AS f INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid
+    WHERE %(FLIDS)s::INT[] IS NULL OR f.flid = ANY(%(FLIDS)s::INT[])"""
+
+# indicator points from the score cells (text that is not a number scores 0), for the indicators and
+# commodities in %(INID)s and %(CID)s or all of them.  The last value of a cell saved twice is used
+indicators_sql = """WITH files AS (%s),
+    parts AS (SELECT f.flid, s.inid, s.cid, s.maxpts, (SELECT CASE WHEN trim(x.xltext) ~ '^-?[0-9]+([.][0-9]+)?$'
+                THEN trim(x.xltext)::REAL ELSE 0 END FROM f500.xldata AS x
+            WHERE x.flid=f.flid AND x.xlcell=s.xlcell ORDER BY x.xlid DESC LIMIT 1) AS score
+        FROM files AS f INNER JOIN f500.score_cells AS s ON s.ayear=f.ayear AND s.cotype=f.cotype
+        WHERE %%(INID)s::INT[] IS NULL
+            OR (s.inid, s.cid) IN (SELECT * FROM unnest(%%(INID)s::INT[], %%(CID)s::INT[])))
+    INSERT INTO f500.indicator_scores (flid, inid, cid, points, maxpts)
+    SELECT flid, inid, cid, LEAST(COALESCE(SUM(score), 0), COALESCE(MAX(maxpts), COUNT(*))),
+        COALESCE(MAX(maxpts), COUNT(*))
+    FROM parts GROUP BY flid, inid, cid
+    ON CONFLICT (flid, inid, cid) DO UPDATE SET points=EXCLUDED.points, maxpts=EXCLUDED.maxpts
+        WHERE (indicator_scores.points, indicator_scores.maxpts) IS DISTINCT FROM (EXCLUDED.points, EXCLUDED.maxpts)
+    """ % files_sql
+
+# commodity and total scores from the indicator points, for the commodities in %(CIDS)s or all of them
+# (the total is always recomputed).  Only rows that change are written, so the listing's data version
+# (see httpcache.py) is only changed when a score is
+commodities_sql = """WITH files AS (%s),
+    assessed AS (SELECT f.flid, c.cid, bool_or(COALESCE((SELECT x.xltext ~ '^([Yy]|1)' FROM f500.xldata AS x
+            WHERE x.flid=f.flid AND x.xlcell=c.cass ORDER BY x.xlid DESC LIMIT 1), FALSE)) AS assd
+        FROM files AS f INNER JOIN f500.cscore_cells AS c ON c.ayear=f.ayear WHERE f.cotype='CO'
+        GROUP BY f.flid, c.cid),
+    sums AS (SELECT i.flid, i.cid, SUM(i.points) AS points, SUM(i.maxpts) AS maxpts,
+            COALESCE(bool_or(a.assd), i.cid=0) AS counted
+        FROM files AS f INNER JOIN f500.indicator_scores AS i ON i.flid=f.flid
+        LEFT JOIN assessed AS a ON a.flid=i.flid AND a.cid=i.cid GROUP BY i.flid, i.cid),
+    targets AS (SELECT flid, 0 AS cid, TRUE AS assd FROM files
+        UNION ALL SELECT flid, cid, assd FROM assessed
+            WHERE %%(CIDS)s::INT[] IS NULL OR cid = ANY(%%(CIDS)s::INT[]))
+    INSERT INTO f500.commodity_scores (flid, cid, score, assd)
+    SELECT t.flid, t.cid, COALESCE(SUM(s.points) / NULLIF(SUM(s.maxpts), 0), 0), t.assd
+    FROM targets AS t INNER JOIN sums AS s ON s.flid=t.flid AND (s.cid=0 OR s.cid=t.cid OR (t.cid=0 AND s.counted))
+    GROUP BY t.flid, t.cid, t.assd
+    ON CONFLICT (flid, cid) DO UPDATE SET score=EXCLUDED.score, assd=EXCLUDED.assd
+        WHERE (commodity_scores.score, commodity_scores.assd) IS DISTINCT FROM (EXCLUDED.score, EXCLUDED.assd)
+    """ % files_sql
+
+# indicators and commodities a list of cells of a file count towards: ('S', inid, cid) for a score cell,
+# ('A', 0, cid) for an assessed commodity flag
+contributions_sql = """WITH files AS (%s)
+    SELECT 'S' AS kind, s.inid, s.cid FROM files AS f
+        INNER JOIN f500.score_cells AS s ON s.ayear=f.ayear AND s.cotype=f.cotype WHERE s.xlcell = ANY(%%(CELLS)s)
+    UNION SELECT 'A', 0, c.cid FROM files AS f
+        INNER JOIN f500.cscore_cells AS c ON c.ayear=f.ayear WHERE f.cotype='CO' AND c.cass = ANY(%%(CELLS)s)
+    """ % files_sql
+
+def lock_files(qry, flids=None):
+    # takes the advisory locks for changing the scores of the files in list 'flids' (in order, so two
+    # transactions cannot deadlock), or of all files.  They are held to the end of the transaction
+    if flids is None:
+        qry.execute("SELECT pg_advisory_xact_lock(hashtext(%s), 0)", (lock_key,))
+        return
+    qry.execute("SELECT pg_advisory_xact_lock_shared(hashtext(%s), 0)", (lock_key,))
+    qry.execute("""SELECT pg_advisory_xact_lock(hashtext(%s), flid) FROM (SELECT DISTINCT unnest(%s::INT[]) AS flid
+        ORDER BY 1) AS f""", (lock_key, list(flids)))
+
+def update_indicators(qry, flids=None, indicators=None):
+    # recomputes the indicator points of the files in list 'flids' (or all), for the (inid, cid) pairs
+    # in list 'indicators' (or all).  Returns the number of rows changed
+    (inids, cids) = (None, None)
+    if indicators is not None:
+        inids = [inid for (inid, cid) in indicators]
+        cids = [cid for (inid, cid) in indicators]
+    qry.execute(indicators_sql, {'FLIDS': flids, 'INID': inids, 'CID': cids})
+    return qry.rowcount
+
+def update_commodities(qry, flids=None, cids=None):
+    # recomputes the total score of the files in list 'flids' (or all), and their scores for the
+    # commodities in list 'cids' (or all).  Returns the number of rows changed
+    qry.execute(commodities_sql, {'FLIDS': flids, 'CIDS': cids})
+    return qry.rowcount
+
+def rescore_cells(qry, flid, cells):
+    # recomputes the scores that the cells in list 'cells' of company file 'flid' count towards, after they
+    # have been saved, in the caller's transaction (which must not be in autocommit, so the lock is held).
+    # Returns the number of indicator and commodity score rows changed
+    flid = int(flid)
+    qry.execute(contributions_sql, {'FLIDS': [flid], 'CELLS': list(cells)})
+    rows = qry.fetchall()
+    if len(rows) == 0:
+        # not a score cell or assessed commodity flag
+        return 0
+    lock_files(qry, [flid])
+    indicators = sorted(set((row[1], row[2]) for row in rows if row[0] == 'S'))
+    changed = update_indicators(qry, [flid], indicators) if len(indicators) > 0 else 0
+    # a general indicator or an assessed flag counts towards every commodity score of the file
+    cids = sorted(set(row[2] for row in rows))
+    if 0 in cids or any(row[0] == 'A' for row in rows):
+        cids = None
+    return changed + update_commodities(qry, [flid], cids)
+
+def rebuild(qry, flids=None):
+    # recomputes all the scores of the files in list 'flids', or of all files, in the caller's
+    # transaction.  Indicators no longer defined for a file are removed.  Returns (indicator rows,
+    # commodity score rows) changed
+    if flids is not None:
+        flids = sorted(set(int(flid) for flid in flids))
+        if len(flids) == 0:
+            return (0, 0)
+    lock_files(qry, flids)
+    qry.execute("""DELETE FROM f500.indicator_scores AS i WHERE (%(FLIDS)s::INT[] IS NULL
+            OR i.flid = ANY(%(FLIDS)s::INT[])) AND NOT EXISTS (SELECT 1 FROM (""" + files_sql + """) AS f
+        INNER JOIN f500.score_cells AS s ON s.ayear=f.ayear AND s.cotype=f.cotype
+        WHERE f.flid=i.flid AND s.inid=i.inid AND s.cid=i.cid)""", {'FLIDS': flids})
+    return (qry.rowcount + update_indicators(qry, flids), update_commodities(qry, flids))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute the Forest 500 indicator, commodity and total scores')
+    parser.add_argument('flids', type=int, nargs='*', help='company files (default all)')
+    parser.add_argument('--year', type=int, help='only the files of this assessment year')
+    args = parser.parse_args()
+    db = dbauth.dbconn()
+    qry = db.cursor()
+    flids = args.flids or None
+    if args.year is not None:
+        qry.execute("""SELECT f.flid FROM f500.filelist AS f INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid
+            WHERE d.ayear=%s AND (%s::INT[] IS NULL OR f.flid = ANY(%s::INT[]))""", (args.year, flids, flids))
+        flids = [row[0] for row in qry.fetchall()]
+    t0 = time.perf_counter()
+    (indicators, commodities) = rebuild(qry, flids)
+    db.commit()
+    db.close()
+    print('-- %s indicator and %s commodity score rows changed in %.1f secs --' % (indicators, commodities,
+        time.perf_counter() - t0))
@@ -0,0 +1,173 @@
+"""
+ ------------- sqltool.py  ------------
+ Server-side cursors for the SQL query tool (processQuery in gc_dz.py, Ajax
+ action 'sql.query').  The tool used to append LIMIT/OFFSET to each SELECT, so
+ every page of the result ran the whole query again and skipped the rows before
+ it, and a runaway query had no time limit.  Now each session running the tool
+ has its own database connection, in which a SELECT is declared as a named
+ (server-side) SCROLL cursor.  The cursor is held between requests, and a page
+ of the result is fetched by moving the cursor to its first row, so the query is
+ run only once, however many pages are viewed, and rows are only sent to the
+ web server when they are shown.
+
+ The number of rows is estimated by the planner (EXPLAIN), rather than counted
+ by fetching them all; it becomes exact once the end of the result is reached.
+
+ Every statement on these connections is limited by statement_timeout, and a
+ cursor left open is closed after idle_secs (the server also ends the
+ transaction after this time, with idle_in_transaction_session_timeout, in
+ case the process holding it has gone).  A statement can be cancelled from
+ another request (Ajax action 'sql.cancel'): the connections are named with
+ application_name, so this works whichever mod_wsgi process is running it.
+ Cursors are held in the process that declared them; a page requested from
+ another process declares the cursor again there.
+
+ The tool is read-only.  Only a single SELECT (or WITH ... SELECT) is accepted
+ (see check_query), and it runs in a read-only transaction, in which the server
+ refuses any change to the tables, including one made by a function it calls.
+"""
+import time, hashlib, threading, re
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# local modules
+import dbauth
+import dbtrace
+
+# settings: longest time for one statement (secs), time a cursor is held without being used (secs),
+# and most cursors held by one process (the least recently used is closed first)
+statement_timeout = 30
+idle_secs = 600
+max_held = 20
+
+# queries held for each session ID, and lock for the dictionary
+held = {}
+held_lock = threading.Lock()
+
+class HeldQuery:
+    # connection of a session, with its open cursor (if any) and what is known of the cursor's result
+    def __init__(self, sid):
+        self.conn = connect(sid)
+        self.cursor = None
+        self.sql = None
+        self.estimate = 0
+        self.total = None
+        self.used = time.time()
+        # held while a request is using the connection
+        self.lock = threading.Lock()
+
+    def close_cursor(self):
+        # closes the cursor and ends its transaction
+        if self.cursor is not None and not self.conn.closed:
+            self.conn.rollback()
+        (self.cursor, self.sql, self.estimate, self.total) = (None, None, 0, None)
+
+    def close(self):
+        # closes the connection
+        if not self.conn.closed:
+            self.conn.close()
+
+# parts of a statement where a semicolon does not end it: quoted strings (E'' strings with backslash
+# escapes), quoted names, dollar-quoted strings and comments
+quoted = re.compile(r"(?<![\w$])[Ee]'(?:[^'\\]|\\.|'')*'" r"|'(?:[^']|'')*'" r'|"(?:[^"]|"")*"'
+    r"|(?<![\w$])\$((?:[A-Za-z_]\w*)?)\$.*?\$\1\$" r"|--[^\n]*|/\*.*?\*/", re.S)
+
+def check_query(sql):
+    # raises ValueError unless 'sql' is a single SELECT statement (which may start with WITH)
+    if not re.match(r'\s*(SELECT|WITH)\b', sql, re.I):
+        raise ValueError("Only SELECT queries can be run with this tool")
+    if ';' in quoted.sub(' ', sql):
+        raise ValueError("Only one statement can be run at a time")
+
+def app_name(sid):
+    # application_name of the connection of session 'sid' (a hash, so the session ID is not shown)
+    return 'gcdz-sql %s' % hashlib.sha1(sid.encode('utf-8')).hexdigest()[:16]
+
+def connect(sid):
+    # opens a connection for session 'sid' with the time limits set
+    db = dbauth.dbconn()
+    dbtrace.connection_opened()
+    qry = db.cursor()
+    qry.execute("SET statement_timeout = %s", (statement_timeout * 1000,))
+    qry.execute("SET idle_in_transaction_session_timeout = %s", ((idle_secs + 60) * 1000,))
+    qry.execute("SET application_name = %s", (app_name(sid),))
+    qry.execute("SET default_transaction_read_only = on")
+    db.commit()
+    return db
+
+def expire():
+    # closes the connections not used for idle_secs, and the least recently used above max_held
+    now = time.time()
+    with held_lock:
+        ordered = sorted(held.items(), key=lambda item: item[1].used, reverse=True)
+        for (n, (sid, entry)) in enumerate(ordered):
+            if (now - entry.used > idle_secs or n >= max_held) and entry.lock.acquire(False):
+                del held[sid]
+                entry.close()
+                entry.lock.release()
+
+def session_query(sid):
+    # returns the HeldQuery of session 'sid', connecting if it has none or its connection has been closed
+    expire()
+    with held_lock:
+        entry = held.get(sid)
+        if entry is None or entry.conn.closed:
+            entry = HeldQuery(sid)
+            held[sid] = entry
+        entry.used = time.time()
+        return entry
+
+def discard(sid, entry):
+    # closes a connection after an error, so the next request starts again with a new one
+    with held_lock:
+        if held.get(sid) is entry:
+            del held[sid]
+    entry.close()
+
+def estimate_rows(qry, sql):
+    # number of rows of a SELECT estimated by the planner
+    qry.execute("EXPLAIN (FORMAT JSON) " + sql)
+    plan = qry.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def fetch_page(sid, sql, start, count):
+    # returns (columns, rows, total, exact) for rows 'start' (from 0) to start+count-1 of SELECT 'sql'.
+    # total is the number of rows in the result, estimated unless 'exact' is True.  The cursor is
+    # declared by the first request for 'sql', and used again for the other pages
+    check_query(sql)
+    entry = session_query(sid)
+    with entry.lock:
+        try:
+            if entry.cursor is None or entry.sql != sql:
+                entry.close_cursor()
+                qry = entry.conn.cursor(cursor_factory=dbtrace.TracingCursor)
+                # set for each transaction as well, in case a query has changed the session's default
+                qry.execute("SET TRANSACTION READ ONLY")
+                entry.estimate = estimate_rows(qry, sql)
+                entry.cursor = entry.conn.cursor('gcdz_sql', cursor_factory=dbtrace.TracingCursor,
+                    scrollable=True)
+                entry.cursor.execute(sql)
+                entry.sql = sql
+            # MOVE ABSOLUTE n leaves the cursor on row n (from 1), so the next row fetched is 'start'
+            entry.cursor.scroll(start, mode='absolute')
+            rows = entry.cursor.fetchmany(count)
+            columns = [col[0] for col in entry.cursor.description]
+        except psycopg2.Error:
+            discard(sid, entry)
+            raise
+        if len(rows) < count and (len(rows) > 0 or start == 0):
+            # the end of the result has been reached, so its size is known
+            entry.total = start + len(rows)
+        entry.used = time.time()
+        if entry.total is not None:
+            return (columns, rows, entry.total, True)
+        return (columns, rows, max(entry.estimate, start + len(rows)), False)
+
+def cancel(qry, sid):
+    # cancels the statement running for session 'sid' (in any process), with cursor 'qry' on another
+    # connection.  Returns the number of statements cancelled
+    qry.execute("""SELECT pg_cancel_backend(pid) FROM pg_stat_activity
+        WHERE application_name=%s AND state='active'""", (app_name(sid),))
+    return sum(1 for row in qry.fetchall() if row[0])
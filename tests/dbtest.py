@@ -0,0 +1,76 @@
+"""
+ ------------- dbtest.py  ------------
+ Throwaway PostgreSQL database for the tests that need one, made the same way as
+ the benchmark's (see benchmark.py): a server in a temporary directory, with the
+ base tables and schema_updates.sql applied.  It is started by the first test
+ class that asks for it, shared by the rest of the run, and removed at exit.
+ The application modules connect to it through GCDZ_DSN (see dbauth.py).
+
+ The PostgreSQL server programs must be on the PATH, or in PG_BIN; tests that
+ need the database are skipped otherwise.
+"""
+import os, shutil, atexit, tempfile, unittest
+
+import psycopg2
+
+import benchmark
+
+# connection string of the running database, once started
+dsn = None
+
+def database():
+    # returns the connection string of the test database, starting it first if needed
+    global dsn
+    if dsn is None:
+        try:
+            benchmark.find_program('initdb')
+        except RuntimeError as e:
+            raise unittest.SkipTest(str(e))
+        datadir = tempfile.mkdtemp(prefix='gcdz-test-')
+        atexit.register(shutil.rmtree, datadir, True)
+        dsn = benchmark.start_server(datadir)
+        atexit.register(benchmark.stop_server, datadir)
+        db = psycopg2.connect(dsn)
+        db.autocommit = True
+        benchmark.create_schema(db.cursor())
+        db.close()
+        os.environ['GCDZ_DSN'] = dsn
+    return dsn
+
+def import_app():
+    # imports gc_dz.py, or skips the test if the application's dependencies are not installed
+    try:
+        import gc_dz
+    except ImportError as e:
+        raise unittest.SkipTest('gc_dz.py cannot be imported: %s' % e)
+    return gc_dz
+
+class DatabaseTest(unittest.TestCase):
+    # test case with a connection to the test database in self.db (autocommit) and a cursor in self.qry
+
+    @classmethod
+    def setUpClass(cls):
+        database()
+
+    def setUp(self):
+        self.db = psycopg2.connect(dsn)
+        self.db.autocommit = True
+        self.qry = self.db.cursor()
+
+    def tearDown(self):
+        self.db.close()
+
+    def session(self, *modules):
+        # opens a session for a new user permitted to use the modules given (see gcdz.menus), and returns
+        # its session ID
+        self.qry.execute("""INSERT INTO gcdz.menus (module, menutext, permitflag, prtorder)
+            SELECT m, m, 1, 0 FROM unnest(%s::TEXT[]) AS m WHERE NOT EXISTS (SELECT 1 FROM gcdz.menus WHERE module=m)""",
+            (list(modules),))
+        self.qry.execute("""INSERT INTO gcdz.users (userid, username, email, permit)
+            SELECT COALESCE((SELECT max(userid) FROM gcdz.users), 0) + 1, 'test', 'test@example.com',
+                COALESCE((SELECT bit_or(permitflag) FROM gcdz.menus WHERE module = ANY(%s)), 0) RETURNING userid""",
+            (list(modules),))
+        userid = self.qry.fetchone()[0]
+        sessid = 'TestSession%05d' % userid
+        self.qry.execute("INSERT INTO gcdz.logins VALUES (%s, %s, NOW(), '127.0.0.1', NULL)", (userid, sessid))
+        return sessid
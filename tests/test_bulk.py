@@ -0,0 +1,55 @@
+"""
+ ------------- test_bulk.py  ------------
+ Tests of the bulk Ajax actions of the F500 tools in gc_dz.py: commodity
+ checkboxes (f500_comChkBox_bulk) and company links (f500_colink_bulk).  Where a
+ batch changes the same checkbox or link more than once, the last change applies.
+"""
+import unittest
+
+from tests.dbtest import DatabaseTest, import_app
+
+class BulkActionsTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.app = import_app()
+        self.sessid = self.session('f500b')
+        self.qry.execute("TRUNCATE f500.comtraders, f500.coflids")
+
+    def ticked(self):
+        self.qry.execute("SELECT flid, cid FROM f500.comtraders ORDER BY 1, 2")
+        return self.qry.fetchall()
+
+    def test_checkboxes(self):
+        reply = self.app.f500_comChkBox_bulk(self.sessid, [(1, 10, 1), (1, 11, 1), (2, 10, 1), (2, 10, 1)])
+        self.assertEqual((reply['valid'], reply['count']), (1, 4))
+        self.assertEqual(self.ticked(), [(1, 10), (1, 11), (2, 10)])
+        self.app.f500_comChkBox_bulk(self.sessid, [(1, 11, 0), (3, 12, 1)])
+        self.assertEqual(self.ticked(), [(1, 10), (2, 10), (3, 12)])
+
+    def test_checkboxes_last_change(self):
+        # ticked then unticked in the same batch stays unticked, and the other way round
+        self.app.f500_comChkBox_bulk(self.sessid, [(1, 10, 1)])
+        self.app.f500_comChkBox_bulk(self.sessid, [(2, 10, 1), (2, 10, 0), (1, 10, 0), (1, 10, 1), (3, 10, 0), 
+            (3, 10, 1), (3, 10, 0)])
+        self.assertEqual(self.ticked(), [(1, 10)])
+
+    def test_checkboxes_invalid(self):
+        self.app.f500_comChkBox_bulk(self.sessid, [(1, 10, 1)])
+        reply = self.app.f500_comChkBox_bulk(self.sessid, [(1, 10, 0), (2, 10, 2)])
+        self.assertEqual(reply['valid'], 0)
+        self.assertIn('Invalid tick value', reply['msg'])
+        self.assertEqual(self.ticked(), [(1, 10)])
+        reply = self.app.f500_comChkBox_bulk('NoSuchSession', [(2, 10, 1)])
+        self.assertEqual(reply['valid'], 0)
+        self.assertEqual(self.ticked(), [(1, 10)])
+
+    def test_links_last_change(self):
+        self.qry.execute("INSERT INTO f500.coflids VALUES (1, 100, FALSE), (2, 200, FALSE)")
+        reply = self.app.f500_colink_bulk(self.sessid, [(1, 1, 0), (4, 1, 0), (2, 2, 100), (3, 2, 0), (2, 2, 300)])
+        self.assertEqual(reply['valid'], 1)
+        self.qry.execute("SELECT flid, ucid, main FROM f500.coflids ORDER BY 1")
+        self.assertEqual(self.qry.fetchall(), [(1, 100, False), (2, 300, False)])
+
+if __name__ == '__main__':
+    unittest.main()
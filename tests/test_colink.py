@@ -0,0 +1,40 @@
+"""
+ ------------- test_colink.py  ------------
+ Tests of apply_suggestions in colink.py: accepted suggestions link their files
+ to the proposed company ID, or a new one for each cluster, including files
+ that have no f500.coflids row yet.
+"""
+import unittest
+
+import psycopg2.extras
+
+import colink
+from tests.dbtest import DatabaseTest
+
+class ApplyTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("DELETE FROM f500.coflids WHERE flid >= 9200")
+        self.qry.execute("DELETE FROM f500.colink_suggest WHERE flid >= 9200")
+
+    def suggest(self, flid, ucid, cluster):
+        self.qry.execute("""INSERT INTO f500.colink_suggest (flid, ucid_proposed, cluster, score)
+            VALUES (%s, %s, %s, 0.9) RETURNING sugid""", (flid, ucid, cluster))
+        return self.qry.fetchone()[0]
+
+    def test_apply(self):
+        self.qry.execute("INSERT INTO f500.coflids (flid, ucid, main) VALUES (9201, NULL, TRUE), (9203, NULL, FALSE)")
+        self.qry.execute("SELECT COALESCE(max(ucid), 0) FROM f500.coflids")
+        newid = self.qry.fetchone()[0] + 1
+        sugids = [self.suggest(9201, 7, 1), self.suggest(9202, 7, 1), self.suggest(9203, None, 2),
+            self.suggest(9204, None, 2)]
+        self.assertEqual(colink.apply_suggestions(self.db.cursor(cursor_factory=psycopg2.extras.DictCursor), sugids), 4)
+        self.qry.execute("SELECT flid, ucid, main FROM f500.coflids WHERE flid >= 9200 ORDER BY flid")
+        self.assertEqual(self.qry.fetchall(), [(9201, 7, True), (9202, 7, None), (9203, newid, False),
+            (9204, newid, None)])
+        self.qry.execute("SELECT DISTINCT status FROM f500.colink_suggest WHERE flid >= 9200")
+        self.assertEqual(self.qry.fetchall(), [('accepted',)])
+
+if __name__ == '__main__':
+    unittest.main()
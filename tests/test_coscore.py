@@ -0,0 +1,50 @@
+"""
+ ------------- test_coscore.py  ------------
+ Tests of the vectorised name scoring in coscore.py: best_all() gives the same
+ best match for each name as ranked(.., limit=1), whatever the block size.
+"""
+import random, unittest
+
+import coscore
+
+words = ['wilmar', 'cargill', 'agri', 'resources', 'golden', 'oil', 'palm', 'foods', 'sime', 'darby', 'bunge', 'olam',
+    'global', 'asia', 'pacific', 'musim', 'mas', 'sinar', 'astra', 'lestari', 'plantation', 'trading', 'sugar', 'cocoa']
+
+class BestAllTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(7)
+        name = lambda: ' '.join(rnd.sample(words, rnd.randint(1, 3))).title() + rnd.choice(['', ' Ltd', ' S.A.', ' Inc'])
+        self.items = [{'flid': n, 'coname': name()} for n in range(300)]
+        self.names = [name() for n in range(200)] + ['', 'Ltd', 'Unknown Words', self.items[5]['coname']]
+        self.scorer = coscore.build_scorer(self.items)
+
+    def expected(self, threshold, method):
+        best = []
+        for name in self.names:
+            found = coscore.ranked(self.scorer, name, threshold, limit=1, method=method)
+            best.append((round(found[0][0], 9), found[0][1]['flid']) if len(found) > 0 else None)
+        return best
+
+    def test_same_as_ranked(self):
+        for method in ('cosine', 'jaccard'):
+            for threshold in (0.3, 0.8, 1.0):
+                for block_cells in (300, 7 * 300, 4000000):
+                    with self.subTest(method=method, threshold=threshold, block_cells=block_cells):
+                        found = coscore.best_all(self.scorer, self.names, threshold, method, block_cells)
+                        self.assertEqual([(round(b[0], 9), b[1]['flid']) if b is not None else None for b in found],
+                            self.expected(threshold, method))
+
+    def test_ties(self):
+        # the same name twice: the lower item number is the best
+        scorer = coscore.build_scorer([{'coname': 'Bunge Foods'}, {'coname': 'Olam'}, {'coname': 'Bunge Foods Ltd'}])
+        self.assertIs(coscore.best_all(scorer, ['bunge foods'])[0][1], scorer['items'][0])
+
+    def test_empty(self):
+        self.assertEqual(coscore.best_all(self.scorer, []), [])
+        self.assertEqual(coscore.best_all(coscore.build_scorer([]), ['Olam', '']), [None, None])
+        with self.assertRaises(RuntimeError):
+            coscore.best_all(self.scorer, ['Olam'], method='euclid')
+
+if __name__ == '__main__':
+    unittest.main()
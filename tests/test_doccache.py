@@ -0,0 +1,87 @@
+"""
+ ------------- test_doccache.py  ------------
+ Tests of the cached copies of linked documents (doccache.py, module 'doc' in
+ gc_dz.py): only types that cannot run script are shown in the browser, the rest
+ are sent as downloads, and the module is permitted to the users of the
+ assessments once schema_updates.sql has been applied.
+"""
+import os, shutil, hashlib, tempfile, unittest
+
+import benchmark
+import doccache
+from tests.dbtest import DatabaseTest, import_app
+
+class HeadersTest(unittest.TestCase):
+
+    def test_inline(self):
+        self.assertEqual(doccache.document_headers('application/pdf', 5),
+            ('application/pdf', [('X-Content-Type-Options', 'nosniff')]))
+        self.assertEqual(doccache.document_headers('Text/Plain; charset=utf-8', 5),
+            ('text/plain', [('X-Content-Type-Options', 'nosniff'), ('Content-Security-Policy', 'sandbox')]))
+
+    def test_download(self):
+        for ctype in ('text/html', 'image/svg+xml', None, 'application/x-unknown'):
+            with self.subTest(ctype=ctype):
+                (sent, headers) = doccache.document_headers(ctype, 5)
+                self.assertEqual(sent, 'application/octet-stream')
+                self.assertEqual(headers[:2], [('X-Content-Type-Options', 'nosniff'),
+                    ('Content-Security-Policy', 'sandbox')])
+                self.assertEqual(headers[2][0], 'Content-Disposition')
+                self.assertTrue(headers[2][1].startswith('attachment; filename="document-5'))
+        self.assertEqual(doccache.document_headers('text/html', 5)[1][2][1], 'attachment; filename="document-5.html"')
+
+class DocumentPageTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.app = import_app()
+        self.saved = doccache.store_dir
+        doccache.store_dir = tempfile.mkdtemp(prefix='gcdz-doccache-')
+        self.sessid = self.session('f500a')
+        # the module is added by schema_updates.sql, for the users of f500a and f500b
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema_updates.sql')) as fh:
+            self.qry.execute(fh.read())
+
+    def tearDown(self):
+        shutil.rmtree(doccache.store_dir, True)
+        doccache.store_dir = self.saved
+        super().tearDown()
+
+    def add_document(self, contents, ctype):
+        sha256 = hashlib.sha256(contents).hexdigest()
+        path = doccache.store_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(contents)
+        self.qry.execute("""INSERT INTO f500.documents (flid, inid, sid, cid, cell, url, sessid, ts, sha256, ctype)
+            VALUES (1, 1, 1, 0, 'E10', 'https://example.com/doc', 'test', NOW(), %s, %s) RETURNING docid""",
+            (sha256, ctype))
+        return self.qry.fetchone()[0]
+
+    def get(self, docid):
+        # status, headers and body of a request for the cached copy of document 'docid'
+        reply = {}
+        def start_response(status, headers):
+            reply.update(status=status, headers=dict(headers))
+        body = b''.join(self.app.application(benchmark.make_environ({'m': 'doc', 'u': self.sessid, 'docid': docid}),
+            start_response))
+        return (reply['status'], reply['headers'], body)
+
+    def test_html_download(self):
+        contents = b'<html><script>alert(1)</script></html>'
+        (status, headers, body) = self.get(self.add_document(contents, 'text/html'))
+        self.assertEqual((status, body), ('200 OK', contents))
+        self.assertEqual(headers['Content-type'], 'application/octet-stream')
+        self.assertTrue(headers['Content-Disposition'].startswith('attachment;'))
+        self.assertEqual(headers['Content-Security-Policy'], 'sandbox')
+        self.assertEqual(headers['X-Content-Type-Options'], 'nosniff')
+
+    def test_pdf_inline(self):
+        contents = b'%PDF-1.4 test'
+        (status, headers, body) = self.get(self.add_document(contents, 'application/pdf'))
+        self.assertEqual((status, headers['Content-type'], body), ('200 OK', 'application/pdf', contents))
+        self.assertNotIn('Content-Disposition', headers)
+        self.assertEqual(headers['X-Content-Type-Options'], 'nosniff')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+"""
+ ------------- test_htmltpl.py  ------------
+ Tests of the precompiled page skeletons (htmltpl.py): a template gives the text
+ of % with the slot values escaped, except for the raw slots, and a repeated
+ render gives the same text.
+"""
+import unittest
+
+import htmltpl
+
+class TemplateTest(unittest.TestCase):
+
+    def test_render(self):
+        text = '<TITLE>%(TITLE)s</TITLE>%(EXTRAS)s<H1 style="width: 100%%">%(TITLE)s</H1><P>%(N)s</P>'
+        template = htmltpl.Template(text, raw=('EXTRAS',))
+        values = {'TITLE': 'Smith & Sons <Ltd>', 'EXTRAS': '<SCRIPT src="f500.js"></SCRIPT>', 'N': 5}
+        expected = text % dict(values, TITLE='Smith &amp; Sons &lt;Ltd&gt;')
+        self.assertEqual(template.render(values), expected)
+        self.assertEqual(template.render(values), expected)
+        self.assertEqual(template.render(dict(values, N=6)), expected.replace('<P>5', '<P>6'))
+
+    def test_unhashable(self):
+        template = htmltpl.Template('<P>%(A)s</P>')
+        self.assertEqual(template.render({'A': ['x']}), "<P>[&#39;x&#39;]</P>")
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            htmltpl.Template('<P>%(A)s %(B)s</P>').render({'A': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+"""
+ ------------- test_httpcache.py  ------------
+ Tests of the data versions behind the ETags of the company listings
+ (httpcache.py): a change to the data a listing shows gives it a new ETag.
+"""
+import unittest
+
+import httpcache
+from tests.dbtest import DatabaseTest
+
+class ListingVersionsTest(DatabaseTest):
+
+    def test_users(self):
+        # listing option 4 shows the e-mail address of the user who last edited each file
+        sessid = self.session('f500')
+        before = httpcache.listing_versions(self.qry)
+        self.qry.execute("UPDATE gcdz.users SET email='editor@example.com' WHERE email='nobody@example.com'")
+        self.assertEqual(httpcache.listing_versions(self.qry), before)
+        self.qry.execute("""UPDATE gcdz.users SET email='editor@example.com'
+            WHERE userid=(SELECT userid FROM gcdz.logins WHERE sessionid=%s)""", (sessid,))
+        self.assertNotEqual(httpcache.listing_versions(self.qry), before)
+
+if __name__ == '__main__':
+    unittest.main()
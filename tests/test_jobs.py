@@ -0,0 +1,172 @@
+"""
+ ------------- test_jobs.py  ------------
+ Tests of the background job queue in jobs.py: claiming and running jobs, and
+ putting the jobs of workers that died back in the queue (or failing them after
+ max_tries starts), and stopping the workers and the processes of their jobs.
+"""
+import os, sys, time, signal, subprocess, unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+
+import jobs
+from tests import dbtest
+
+def echo_job(params, progress):
+    # job handler for the tests: reports progress for each word, and returns them joined
+    words = params['words']
+    for (n, word) in enumerate(words, 1):
+        progress(n, len(words), ' '.join(words[:n]))
+    if 'fail' in words:
+        raise RuntimeError('asked to fail')
+    return ' '.join(words)
+
+def pool_job(params, progress):
+    # job handler for the tests: starts a process pool, as xlexport does, and waits for a task that sleeps.
+    # Reports the process IDs of the worker and of the pool's process as its partial result
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        child = pool.submit(os.getpid).result()
+        task = pool.submit(time.sleep, params['secs'])
+        progress(0, 1, '%s %s' % (os.getpid(), child))
+        task.result()
+    return 'slept'
+
+def running(pid):
+    # True if process 'pid' exists
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+class JobsTest(dbtest.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.qry = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.qry.execute("DELETE FROM gcdz.jobs")
+        jobs.job_handlers['test'] = ('tests.test_jobs', 'echo_job')
+
+    def tearDown(self):
+        del jobs.job_handlers['test']
+        super().tearDown()
+
+    def job(self, jobid):
+        self.qry.execute("SELECT status, progress, total, result, error, worker, tries FROM gcdz.jobs WHERE jobid=%s",
+            (jobid,))
+        return dict(self.qry.fetchone())
+
+    def worker(self):
+        # connection of a worker, and its server process ID
+        db = psycopg2.connect(dbtest.dsn)
+        db.autocommit = True
+        qry = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        return (db, qry, db.get_backend_pid())
+
+    def stop(self, db, pid):
+        # closes a worker's connection, as when the worker process dies, and waits for its server process
+        db.close()
+        for n in range(100):
+            self.qry.execute("SELECT 1 FROM pg_stat_activity WHERE pid=%s", (pid,))
+            if self.qry.rowcount == 0:
+                return
+            time.sleep(0.05)
+        self.fail('server process %s did not end' % pid)
+
+    def test_run(self):
+        jobid = jobs.submit_job(self.qry, 'sess', 'test', {'words': ['a', 'b', 'c']})
+        (db, qry, pid) = self.worker()
+        job = jobs.claim_job(qry)
+        self.assertEqual(job['jobid'], jobid)
+        self.assertEqual(self.job(jobid)['worker'], pid)
+        self.assertIsNone(jobs.claim_job(qry))
+        jobs.run_job(qry, job)
+        self.assertEqual(self.job(jobid), {'status': 'done', 'progress': 3, 'total': 3, 'result': 'a b c', 'error': None,
+            'worker': pid, 'tries': 1})
+        # a job that raises an error fails, with the partial result kept
+        jobid = jobs.submit_job(self.qry, 'sess', 'test', {'words': ['x', 'fail']})
+        jobs.run_job(qry, jobs.claim_job(qry))
+        job = self.job(jobid)
+        self.assertEqual((job['status'], job['result']), ('failed', 'x fail'))
+        self.assertIn('asked to fail', job['error'])
+        db.close()
+
+    def test_requeue(self):
+        jobid = jobs.submit_job(self.qry, 'sess', 'test', {'words': ['a']})
+        (db, qry, pid) = self.worker()
+        jobs.claim_job(qry)
+        qry.execute("UPDATE gcdz.jobs SET progress=5, total=9")
+        # the worker is still connected, so its job is left alone
+        self.assertEqual(jobs.requeue_jobs(self.qry), 0)
+        self.assertEqual(self.job(jobid)['status'], 'running')
+        self.stop(db, pid)
+        self.assertEqual(jobs.requeue_jobs(self.qry), 1)
+        self.assertEqual(self.job(jobid), {'status': 'queued', 'progress': 0, 'total': 9, 'result': None, 'error': None,
+            'worker': None, 'tries': 1})
+        # another worker runs it
+        (db, qry, pid) = self.worker()
+        jobs.run_job(qry, jobs.claim_job(qry))
+        self.assertEqual(self.job(jobid)['status'], 'done')
+        self.assertEqual(self.job(jobid)['tries'], 2)
+        db.close()
+
+    def test_max_tries(self):
+        jobid = jobs.submit_job(self.qry, 'sess', 'test', {'words': ['a']})
+        for n in range(1, jobs.max_tries + 1):
+            (db, qry, pid) = self.worker()
+            self.assertEqual(jobs.claim_job(qry)['jobid'], jobid)
+            self.stop(db, pid)
+            self.assertEqual(jobs.requeue_jobs(self.qry), 1 if n < jobs.max_tries else 0)
+        job = self.job(jobid)
+        self.assertEqual((job['status'], job['tries']), ('failed', jobs.max_tries))
+        self.assertIn('stopped its worker', job['error'])
+
+    def test_old_jobs(self):
+        # jobs left running without a worker (from before the worker was recorded) go back in the queue
+        jobid = jobs.submit_job(self.qry, 'sess', 'test', {'words': ['a']})
+        self.qry.execute("UPDATE gcdz.jobs SET status='running' WHERE jobid=%s", (jobid,))
+        self.assertEqual(jobs.check_jobs(), 1)
+        self.assertEqual(self.job(jobid)['status'], 'queued')
+
+class StopTest(dbtest.DatabaseTest):
+    # the command 'python3 jobs.py' stopped with SIGTERM while a job is running
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("DELETE FROM gcdz.jobs")
+
+    def test_sigterm(self):
+        jobs.job_handlers['test'] = ('tests.test_jobs', 'pool_job')
+        try:
+            jobid = jobs.submit_job(self.qry, 'sess', 'test', {'secs': 60})
+        finally:
+            del jobs.job_handlers['test']
+        cmd = subprocess.Popen([sys.executable, '-c',
+            "import jobs; jobs.job_handlers['test'] = ('tests.test_jobs', 'pool_job'); jobs.run_workers(1)"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), stdout=subprocess.DEVNULL,
+            start_new_session=True)
+        try:
+            for n in range(200):
+                self.qry.execute("SELECT result FROM gcdz.jobs WHERE jobid=%s", (jobid,))
+                pids = self.qry.fetchone()[0]
+                if pids is not None or cmd.poll() is not None:
+                    break
+                time.sleep(0.05)
+            self.assertIsNotNone(pids, 'the job did not start')
+            (worker, child) = [int(pid) for pid in pids.split()]
+            self.assertTrue(running(worker) and running(child))
+            cmd.send_signal(signal.SIGTERM)
+            self.assertEqual(cmd.wait(jobs.stop_secs), 0)
+        finally:
+            if cmd.poll() is None:
+                os.killpg(cmd.pid, signal.SIGKILL)
+                cmd.wait()
+        self.assertFalse(running(worker))
+        self.assertFalse(running(child))
+        # the job is back in the queue, and this start is not counted
+        self.qry.execute("SELECT status, progress, worker, tries FROM gcdz.jobs WHERE jobid=%s", (jobid,))
+        self.assertEqual(self.qry.fetchone(), ('queued', 0, None, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+"""
+ ------------- test_linkcheck.py  ------------
+ Tests of the document link checks in linkcheck.py against a local HTTP server:
+ HEAD requests, the fallback to a GET of the first byte when HEAD is refused,
+ redirects, the timeout, the per-URL cache of results in f500.link_checks, and
+ the Ajax action giving the result to the data input form.
+"""
+import json, time, threading, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2.extras
+
+import benchmark
+import linkcheck
+from tests.dbtest import DatabaseTest, import_app
+
+class StubHandler(BaseHTTPRequestHandler):
+    # paths of the stub server:
+    #   /doc.pdf      a document, answers HEAD and GET
+    #   /nohead/..    refuses HEAD with the code given in the path, answers GET
+    #   /missing      404 for both
+    #   /moved        redirects to /doc.pdf, /moved-missing to /missing
+    #   /slow         waits 'delay' seconds before answering
+    # Each request is recorded in 'requests' as (method, path, Range header)
+    requests = []
+    delay = 2.0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    def answer(self):
+        self.requests.append((self.command, self.path, self.headers.get('Range')))
+        if self.path == '/doc.pdf':
+            if self.command == 'GET' and self.headers.get('Range') == 'bytes=0-0':
+                self.reply(206, b'%', [('Content-Type', 'application/pdf'), ('Content-Range', 'bytes 0-0/1234')])
+            else:
+                self.reply(200, b'%' * 1234, [('Content-Type', 'application/pdf')])
+        elif self.path.startswith('/nohead/'):
+            if self.command == 'HEAD':
+                self.reply(int(self.path.split('/')[2]))
+            else:
+                self.reply(200, b'<html></html>', [('Content-Type', 'text/html')])
+        elif self.path == '/moved':
+            self.reply(302, headers=[('Location', '/doc.pdf')])
+        elif self.path == '/moved-missing':
+            self.reply(301, headers=[('Location', '/missing')])
+        elif self.path == '/slow':
+            time.sleep(self.delay)
+            self.reply(200)
+        else:
+            self.reply(404, b'not found')
+
+    do_HEAD = answer
+    do_GET = answer
+
+def start_stub(cls):
+    # starts the stub server for a test class, with its base URL in cls.base
+    cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    cls.server.daemon_threads = True
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    cls.base = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+class CheckUrlTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_stub(cls)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        del StubHandler.requests[:]
+
+    def check(self, path):
+        result = linkcheck.check_url(self.base + path)
+        return (result['status'], result['code'], result['ctype'], result['clen'])
+
+    def test_head(self):
+        self.assertEqual(self.check('/doc.pdf'), ('ok', 200, 'application/pdf', 1234))
+        self.assertEqual(StubHandler.requests, [('HEAD', '/doc.pdf', None)])
+
+    def test_get_fallback(self):
+        # HEAD refused: the first byte is asked for with GET, and the length is not known
+        for code in (400, 403, 405, 501):
+            del StubHandler.requests[:]
+            self.assertEqual(self.check('/nohead/%s' % code), ('ok', 200, 'text/html', None))
+            self.assertEqual(StubHandler.requests, [('HEAD', '/nohead/%s' % code, None),
+                ('GET', '/nohead/%s' % code, 'bytes=0-0')])
+
+    def test_missing(self):
+        # other errors are not tried again with GET
+        result = linkcheck.check_url(self.base + '/missing')
+        self.assertEqual((result['status'], result['code']), ('dead', 404))
+        self.assertIn('Not Found', result['msg'])
+        self.assertEqual(StubHandler.requests, [('HEAD', '/missing', None)])
+        self.assertEqual(self.check('/nohead/404'), ('dead', 404, None, None))
+
+    def test_redirects(self):
+        # followed with the same request, so a HEAD stays a HEAD and a GET keeps its Range
+        self.assertEqual(self.check('/moved'), ('ok', 200, 'application/pdf', 1234))
+        self.assertEqual(StubHandler.requests, [('HEAD', '/moved', None), ('HEAD', '/doc.pdf', None)])
+        self.assertEqual(self.check('/moved-missing'), ('dead', 404, None, None))
+        del StubHandler.requests[:]
+        self.server.RequestHandlerClass = type('NoHeadHandler', (StubHandler,), {'do_HEAD': lambda self: (
+            self.requests.append(('HEAD', self.path, None)), self.reply(405))})
+        try:
+            self.assertEqual(self.check('/moved'), ('ok', 206, 'application/pdf', None))
+        finally:
+            self.server.RequestHandlerClass = StubHandler
+        self.assertEqual(StubHandler.requests, [('HEAD', '/moved', None), ('GET', '/moved', 'bytes=0-0'),
+            ('GET', '/doc.pdf', 'bytes=0-0')])
+
+    def test_timeout(self):
+        saved = linkcheck.timeout
+        linkcheck.timeout = 0.3
+        try:
+            t0 = time.perf_counter()
+            result = linkcheck.check_url(self.base + '/slow')
+            secs = time.perf_counter() - t0
+        finally:
+            linkcheck.timeout = saved
+        self.assertEqual((result['status'], result['code']), ('dead', None))
+        self.assertIn('timed out', result['msg'])
+        self.assertLess(secs, StubHandler.delay)
+
+    def test_connection_refused(self):
+        result = linkcheck.check_url('http://127.0.0.1:1/doc.pdf')
+        self.assertEqual((result['status'], result['code']), ('dead', None))
+
+    def test_valid_url(self):
+        self.assertEqual([linkcheck.valid_url(url) for url in ('https://a.org/x.pdf', 'ftp://a.org/x', 'www.a.org',
+            'javascript:alert(1)', 'http://', 'http://[::1')], [True, True, False, False, False, False])
+
+class CacheTest(DatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        start_stub(cls)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("TRUNCATE f500.documents, f500.link_checks")
+
+    def add_document(self, url, status=None):
+        self.qry.execute("""INSERT INTO f500.documents (flid, inid, sid, cid, cell, url, sessid, ts)
+            VALUES (1, 1, 1, 0, 'E10', %s, 'test', NOW()) RETURNING docid""", (url,))
+        docid = self.qry.fetchone()[0]
+        if status is not None:
+            self.qry.execute("UPDATE f500.documents SET status=%s WHERE docid=%s", (status, docid))
+        return docid
+
+    def statuses(self):
+        self.qry.execute("SELECT url, status FROM f500.documents ORDER BY docid")
+        return [(url.replace(self.base, ''), status) for (url, status) in self.qry.fetchall()]
+
+    def test_new_links_pending(self):
+        self.add_document(self.base + '/doc.pdf')
+        self.assertEqual(self.statuses(), [('/doc.pdf', 'pending')])
+
+    def test_cache_ttl(self):
+        url = self.base + '/doc.pdf'
+        qry = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.assertIsNone(linkcheck.cached_status(qry, url))
+        self.add_document(url)
+        self.add_document(url)
+        linkcheck.save_result(linkcheck.check_url(url))
+        self.assertEqual(self.statuses(), [('/doc.pdf', 'ok'), ('/doc.pdf', 'ok')])
+        cached = linkcheck.cached_status(qry, url)
+        self.assertEqual((cached['status'], cached['code'], cached['clen']), ('ok', 200, 1234))
+        # expired results are checked again
+        self.qry.execute("UPDATE f500.link_checks SET checked = NOW() - %s::INTERVAL - INTERVAL '1 hour'",
+            (linkcheck.cache_ttl,))
+        self.assertIsNone(linkcheck.cached_status(qry, url))
+
+    def test_background_check(self):
+        url = self.base + '/missing'
+        self.add_document(url)
+        linkcheck.submit_check(url)
+        linkcheck.submit_check(url)
+        for n in range(100):
+            if url not in linkcheck.pending:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.statuses(), [('/missing', 'dead')])
+        self.assertEqual([path for (method, path, rng) in StubHandler.requests].count('/missing'), 1)
+
+    def test_check_pending(self):
+        # links saved before the checks, or whose check was lost, are checked by check_pending.  A link with
+        # a current cached result is given it without being checked again
+        del StubHandler.requests[:]
+        self.add_document(self.base + '/doc.pdf')
+        self.add_document(self.base + '/missing')
+        self.add_document(self.base + '/nohead/405')
+        self.add_document(self.base + '/moved', 'ok')
+        self.add_document(self.base + '/missing')
+        linkcheck.save_result({'url': self.base + '/nohead/405', 'status': 'ok', 'code': 200, 'ctype': None,
+            'clen': None, 'msg': 'OK'})
+        self.qry.execute("UPDATE f500.documents SET status='pending' WHERE url LIKE '%nohead%'")
+        self.assertEqual(linkcheck.check_pending(), (2, 1))
+        self.assertEqual(self.statuses(), [('/doc.pdf', 'ok'), ('/missing', 'dead'), ('/nohead/405', 'ok'),
+            ('/moved', 'ok'), ('/missing', 'dead')])
+        self.assertEqual(sorted(path for (method, path, rng) in StubHandler.requests), ['/doc.pdf', '/missing'])
+        self.assertEqual(linkcheck.check_pending(), (0, 0))
+
+    def test_status_action(self):
+        # the result is given only to a session permitted to use the data input form
+        gc_dz = import_app()
+        docid = self.add_document(self.base + '/doc.pdf')
+        def status(sessid):
+            environ = benchmark.make_environ({}, {'action': 'f500b.link_status', 'sessid': sessid, 'docid': docid},
+                ajax=True)
+            return json.loads(b''.join(gc_dz.application(environ, lambda status, headers: None)))
+        # a user of another module only
+        self.qry.execute("""INSERT INTO gcdz.menus (module, menutext, permitflag, prtorder) SELECT 'linktest', 'Test',
+            1 << 20, 0 WHERE NOT EXISTS (SELECT 1 FROM gcdz.menus WHERE module='linktest')""")
+        self.assertEqual(status(self.session('linktest'))['valid'], 0)
+        self.assertEqual(status('0')['valid'], 0)
+        reply = status(self.session('f500b'))
+        self.assertEqual((reply['url'], reply['status']), (self.base + '/doc.pdf', 'pending'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+ ------------- test_mailq.py  ------------
+ Tests of the outbound mail queue in mailq.py against a local SMTP server: a
+ batch of messages sent over one connection, the retry delays after a 4xx reply,
+ permanent failure after a 5xx reply or max_attempts, and the messages put back
+ in the queue when the server closes the connection.
+"""
+import threading, socketserver, unittest
+
+import psycopg2.extras
+
+import mailq
+from tests.dbtest import DatabaseTest
+
+class SMTPStub(socketserver.StreamRequestHandler):
+    # enough of an SMTP server for smtplib.  Replies to RCPT and to the end of DATA can be set for a
+    # recipient in the server's 'rcpt_replies' and 'data_replies'; a 421 reply closes the connection.
+    # The server counts connections and QUITs, and records the messages accepted as (recipient, text)
+
+    def send(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.send('220 stub ESMTP')
+        rcpt = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd = line.decode('ascii').strip()
+            verb = cmd[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.send('250 stub')
+            elif verb == 'MAIL':
+                self.send('250 OK')
+            elif verb == 'RCPT':
+                rcpt = cmd.split(':', 1)[1].strip(' <>')
+                reply = server.rcpt_replies.get(rcpt, '250 OK')
+                self.send(reply)
+                if reply.startswith('421'):
+                    break
+            elif verb == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line.decode('utf-8'))
+                reply = server.data_replies.get(rcpt, '250 queued')
+                if reply.startswith('250'):
+                    server.messages.append((rcpt, ''.join(data)))
+                self.send(reply)
+                if reply.startswith('421'):
+                    break
+            elif verb in ('RSET', 'NOOP'):
+                self.send('250 OK')
+            elif verb == 'QUIT':
+                server.quits += 1
+                self.send('221 bye')
+                break
+            else:
+                self.send('500 unknown command')
+
+class MailQueueTest(DatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStub)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.saved = (mailq.smtp_host, mailq.smtp_port, mailq.smtp_timeout, mailq.batch_size)
+        (mailq.smtp_host, mailq.smtp_port) = cls.server.server_address
+        mailq.smtp_timeout = 5
+
+    @classmethod
+    def tearDownClass(cls):
+        (mailq.smtp_host, mailq.smtp_port, mailq.smtp_timeout, mailq.batch_size) = cls.saved
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("TRUNCATE gcdz.mail_queue")
+        self.dictqry = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.server.connections = 0
+        self.server.quits = 0
+        self.server.messages = []
+        self.server.rcpt_replies = {}
+        self.server.data_replies = {}
+
+    def queue(self, *to):
+        return [mailq.queue_mail(self.qry, 'gcdz@example.com', addr, 'Test %s' % addr, 'Hello %s' % addr)
+            for addr in to]
+
+    def send_due(self):
+        # claims the messages due and sends them over one new connection, as the sender does
+        smtp = mailq.send_batch(self.dictqry, mailq.smtp_connect(), mailq.claim_batch(self.dictqry))
+        if smtp is not None:
+            smtp.quit()
+
+    def state(self, mailid):
+        # status and attempts of a message, and the seconds until it is next tried
+        self.qry.execute("""SELECT status, attempts, round(extract(epoch FROM next_try - NOW()))::INT
+            FROM gcdz.mail_queue WHERE mailid=%s""", (mailid,))
+        return self.qry.fetchone()
+
+    def test_batch_one_connection(self):
+        # the sender sends every message over one connection, in batches of batch_size, then closes it
+        mailq.batch_size = 3
+        try:
+            ids = self.queue(*['user%s@example.com' % n for n in range(7)])
+            stop = threading.Event()
+            stop.set()
+            thread = threading.Thread(target=mailq.sender, kwargs={'wait': 0.1, 'stop': stop})
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        finally:
+            mailq.batch_size = self.saved[3]
+        self.assertEqual((self.server.connections, self.server.quits), (1, 1))
+        self.assertEqual([rcpt for (rcpt, text) in self.server.messages], ['user%s@example.com' % n for n in range(7)])
+        self.assertIn('Subject: Test user0@example.com\r\n', self.server.messages[0][1])
+        self.assertTrue(self.server.messages[0][1].endswith('Hello user0@example.com\r\n'))
+        self.assertEqual([mailq.mail_status(self.dictqry, mailid)['status'] for mailid in ids], ['sent'] * 7)
+
+    def test_backoff(self):
+        # a 4xx reply, at RCPT or the end of DATA, puts the message back in the queue for retry_delay,
+        # doubled for each attempt, while the other messages of the batch are sent
+        self.server.rcpt_replies['grey@example.com'] = '450 greylisted, try later'
+        self.server.data_replies['busy@example.com'] = '452 insufficient storage'
+        (grey, ok, busy) = self.queue('grey@example.com', 'ok@example.com', 'busy@example.com')
+        self.send_due()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([rcpt for (rcpt, text) in self.server.messages], ['ok@example.com'])
+        self.assertEqual(self.state(grey), ('queued', 1, mailq.retry_delay))
+        self.assertEqual(self.state(busy), ('queued', 1, mailq.retry_delay))
+        self.assertEqual(self.state(ok)[:2], ('sent', 1))
+        self.assertIn('greylisted', mailq.mail_status(self.dictqry, grey)['error'])
+        self.assertEqual(mailq.mail_status(self.dictqry, busy)['error'], '452 insufficient storage')
+        # not due yet
+        self.send_due()
+        self.assertEqual(self.state(grey)[:2], ('queued', 1))
+        self.qry.execute("UPDATE gcdz.mail_queue SET next_try=NOW()")
+        self.send_due()
+        self.assertEqual(self.state(grey), ('queued', 2, mailq.retry_delay * 2))
+        self.assertEqual(self.state(busy), ('queued', 2, mailq.retry_delay * 2))
+
+    def test_failed_after_max_attempts(self):
+        self.server.data_replies['busy@example.com'] = '451 local error'
+        (busy,) = self.queue('busy@example.com')
+        for n in range(mailq.max_attempts):
+            self.qry.execute("UPDATE gcdz.mail_queue SET next_try=NOW()")
+            self.send_due()
+        status = mailq.mail_status(self.dictqry, busy)
+        self.assertEqual((status['status'], status['attempts'], status['error']),
+            ('failed', mailq.max_attempts, '451 local error'))
+        self.qry.execute("UPDATE gcdz.mail_queue SET next_try=NOW()")
+        self.assertEqual(mailq.claim_batch(self.dictqry), [])
+
+    def test_permanent_failure(self):
+        # 5xx replies fail at once
+        self.server.rcpt_replies['nobody@example.com'] = '550 no such user'
+        self.server.data_replies['spam@example.com'] = '554 rejected'
+        (nobody, spam, ok) = self.queue('nobody@example.com', 'spam@example.com', 'ok@example.com')
+        self.send_due()
+        self.assertEqual(self.state(nobody)[:2], ('failed', 1))
+        self.assertEqual(self.state(spam)[:2], ('failed', 1))
+        self.assertEqual(self.state(ok)[:2], ('sent', 1))
+        self.assertIn('no such user', mailq.mail_status(self.dictqry, nobody)['error'])
+
+    def test_connection_closed(self):
+        # a 421 reply closes the connection: that message counts an attempt, the rest of the batch goes back
+        # in the queue as it was, and is sent over the next connection
+        self.server.data_replies['second@example.com'] = '421 shutting down'
+        (first, second, third) = self.queue('first@example.com', 'second@example.com', 'third@example.com')
+        self.send_due()
+        self.assertEqual(self.state(first)[:2], ('sent', 1))
+        self.assertEqual(self.state(second), ('queued', 1, mailq.retry_delay))
+        self.assertEqual(self.state(third), ('queued', 0, 0))
+        self.server.rcpt_replies['third@example.com'] = '421 too busy'
+        self.send_due()
+        self.assertEqual(self.state(third), ('queued', 1, mailq.retry_delay))
+        self.server.rcpt_replies = {}
+        self.server.data_replies = {}
+        self.qry.execute("UPDATE gcdz.mail_queue SET next_try=NOW()")
+        self.send_due()
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.state(second)[:2], ('sent', 2))
+        self.assertEqual(self.state(third)[:2], ('sent', 2))
+
+if __name__ == '__main__':
+    unittest.main()
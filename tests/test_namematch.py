@@ -0,0 +1,59 @@
+"""
+ ------------- test_namematch.py  ------------
+ Tests of the batch name matching in namematch.py: blocking, the token and
+ phonetic Jaccard scores worked out over the candidate arrays, and the order and
+ limit of the results.
+"""
+import unittest
+
+import namematch
+
+universe = [{'flid': n, 'coname': name} for (n, name) in enumerate([
+    'Wilmar Oleo Ltd', 'Wilmar Trading', 'Golden Agri-Resources', 'Agri Resources Golden',
+    'Sime Darby Plantation', 'Sime Darby', 'Cargill Inc', 'Bunge', 'Wilmar', 'Cargil Foods'])]
+
+class MatchNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = namematch.build_index(universe)
+
+    def match(self, name, threshold=0.0, limit=10):
+        (results, stats) = namematch.match_names([name], self.index, threshold, limit)
+        return [(round(score, 6), co['flid']) for (score, co) in results[name]]
+
+    def test_exact(self):
+        # stopwords are dropped, so 'Wilmar Oleo Ltd' is the same as 'Wilmar International'
+        self.assertEqual(self.match('Wilmar Oleo', 1.0), [(1.0, 0)])
+
+    def test_scores(self):
+        # Jaccard similarity of the token sets, an unknown word only counts towards the union
+        self.assertEqual(self.match('Wilmar Agri', 0.3), [(0.5, 8), (round(1 / 3, 6), 0), (round(1 / 3, 6), 1)])
+        self.assertEqual(self.match('Sime Darby Oil'), [(round(2 / 3, 6), 5), (0.5, 4)])
+
+    def test_phonetic(self):
+        # a misspelling scores 0.9 of the Jaccard similarity of the phonetic keys
+        self.assertEqual(self.match('Wilmer', 0.8), [(0.9, 8)])
+        self.assertEqual(self.match('Cargil Inc'), [(0.9, 6), (0.5, 9)])
+        # 'oil' and 'oleo' have the same key, so this scores 0.9 rather than 1/3 with 'Wilmar Oleo'
+        self.assertEqual(self.match('Wilmar Oil', 0.4), [(0.9, 0), (0.5, 8)])
+
+    def test_blocks(self):
+        # names sharing no blocking key with a company are not compared with it
+        self.assertEqual(self.match('Resources Golden Agri'), [(1.0, 2), (1.0, 3)])
+        self.assertEqual(self.match('Plantation Sime'), [])
+
+    def test_order_and_limit(self):
+        # ties are in universe order
+        self.assertEqual(self.match('Wilmar', 0.0, 2), [(1.0, 8), (0.5, 0)])
+
+    def test_no_words(self):
+        (results, stats) = namematch.match_names(['', 'Ltd', 'Unknown Name', ''], self.index)
+        self.assertEqual(results, {'': [], 'Ltd': [], 'Unknown Name': []})
+        self.assertEqual((stats['names'], stats['distinct']), (4, 3))
+
+    def test_phonetic_key(self):
+        self.assertEqual([namematch.phonetic_key(w) for w in ('robert', 'rupert', 'ashcraft', 'tymczak', 'a', '')],
+            ['r163', 'r163', 'a261', 't522', 'a000', ''])
+
+if __name__ == '__main__':
+    unittest.main()
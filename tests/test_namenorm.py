@@ -0,0 +1,84 @@
+"""
+ ------------- test_namenorm.py  ------------
+ Golden test of namenorm.name_frags() against name_frags_legacy(), the original
+ version from gc_dz.py, on a fixed corpus of company names.  The corpus covers the
+ cases the precompiled version handles differently inside: names that need
+ transliterating (accents, non-latin scripts, non-ASCII spaces and punctuation),
+ runs of stopwords next to each other and stopwords that are part of other words,
+ single letters to be merged, and workbook file names.
+
+     python3 -m pytest tests      (or python3 -m unittest discover tests)
+"""
+import itertools, unittest
+
+import namenorm
+
+# names as found in the company lists and workbook file names
+corpus = [
+    'Cargill', 'Cargill Inc', 'Cargill, Inc.', 'CARGILL INC.', 'Wilmar International Ltd', 'Wilmar International Limited',
+    'Golden Agri-Resources Ltd', 'Sinar Mas Group', 'PT Astra Agro Lestari Tbk', 'P.T. Astra Agro Lestari',
+    'Archer Daniels Midland Co', 'Archer-Daniels-Midland Company', 'The Coca-Cola Company', 'Procter & Gamble Co',
+    'Procter and Gamble', 'Johnson & Johnson', 'Marks and Spencer Group plc', 'J Sainsbury plc', 'J. Sainsbury PLC',
+    'A P Moller - Maersk', 'A.P. Moller-Maersk A/S', 'H & M Hennes & Mauritz AB', 'L Oreal', "L'Oréal SA",
+    'JBS S.A.', 'JBS SA', 'Marfrig Global Foods S.A.', 'Grupo Bimbo S.A.B. de C.V.', 'Bunge Ltd', 'Louis Dreyfus Company B.V.',
+    'Olam International Limited', 'Sime Darby Plantation Berhad', 'Holdings Holding Group', 'Group Holdings Ltd Co',
+    'ltd co group', 'co co co', 'the of and', 'de la Rue', 'Banco de Bogotá', 'Bank of America Corporation',
+    'Deutsche Bank AG', 'Allianz SE', 'BNP Paribas SA', 'Crédit Agricole S.A.', 'Société Générale', 'Nestlé S.A.',
+    'Nestle', 'Müller Group', 'Mueller', 'Ülker Bisküvi Sanayi A.Ş.', 'São Martinho S.A.', 'Minerva Foods S/A',
+    'OOO Rusagro', 'ООО Русагро', 'Сбербанк России', 'COFCO International', '中粮集团有限公司', 'ＡＢＣ Ｃｏ', 'Ａjinomoto',
+    'Kao Corporation', '花王株式会社', 'Itaú Unibanco Holding S.A.', 'Grupo Éxito', 'Açúcar Guarani', 'Øresund',
+    'Straße AG', 'İş Bankası', 'Caña de Azúcar y Derivados', 'Y Y Y', 'i j k', 'I. J. K. Holdings',
+    'Fábrica   de  Tecidos', 'tab\tseparated\tname', 'line\nbreak', 'non breaking space', 'em space',
+    'dash–en and—em', '“quoted” name', 'Company™ Brands®', '  padded name  ', '', ' ', '&',
+    'Cargill 2019.xlsx', 'F500_2019_JBS.xlsm', 'Nestlé.xlsx  ', 'Name.xls', 'name.xlsxx', 'Cargill.XLSX',
+    'International Paper', 'Corporación Internacional', 'Asian Agri', 'Asia Pacific Resources International Holdings Ltd',
+    'Gmbh GmbH & Co KG', 'Tchibo GmbH', 'AAK AB', 'a b c d', 'x y', 'xy z', 'a bc d', 'abc d e',
+]
+
+class NameFragsTest(unittest.TestCase):
+
+    def assert_same(self, names):
+        for name in names:
+            with self.subTest(name=name):
+                self.assertEqual(namenorm.name_frags(name), namenorm.name_frags_legacy(name))
+
+    def test_corpus(self):
+        self.assert_same(corpus)
+
+    def test_corpus_from_cold(self):
+        # the same results when the memo and transliteration caches are empty
+        namenorm.name_key.cache_clear()
+        namenorm.translit.cache_clear()
+        self.assert_same(reversed(corpus))
+
+    def test_stopword_runs(self):
+        # every pair of stopwords, alone, before and after a name and around a non-ASCII word, so that
+        # removals that consume the spaces either side of a word are covered
+        names = []
+        for (a, b) in itertools.product(namenorm.stopwords, repeat=2):
+            names += ['%s %s' % (a, b), 'Acme %s %s' % (a, b), '%s %s Acme' % (a, b), '%s Açaí %s' % (a, b),
+                '%s%s' % (a, b), '%s.%s' % (a.upper(), b.upper())]
+        self.assert_same(names)
+
+    def test_stopwords_inside_words(self):
+        # words that contain or start with a stopword are kept
+        self.assert_same(['Colgate', 'Grouped', 'Saab', 'Incorporated', 'Corpus', 'Deere', 'Asda', 'Plcx', 'Ageas'])
+        self.assertEqual(namenorm.name_frags('Colgate Palmolive Co'), ['colgate', 'palmolive', ''])
+
+    def test_non_ascii(self):
+        self.assertEqual(namenorm.name_frags('Nestlé'), namenorm.name_frags('Nestle'))
+        self.assertEqual(namenorm.name_frags('Crédit Agricole S.A.'), ['credit', 'agricole', ''])
+        self.assert_same([chr(c) + ' Foods' for c in range(0x80, 0x800, 7)])
+
+    def test_new_list(self):
+        # callers may change the list they get without changing later results
+        frags = namenorm.name_frags('Wilmar International')
+        frags.append('x')
+        self.assertEqual(namenorm.name_frags('Wilmar International'), ['wilmar', ''])
+
+    def test_check_names(self):
+        (mismatches, legacy_rate, cold_rate, warm_rate) = namenorm.check_names(corpus)
+        self.assertEqual(mismatches, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+ ------------- test_sqltool.py  ------------
+ Tests that the SQL query tool (sqltool.py, processQuery in gc_dz.py) is
+ read-only: statements other than a single SELECT are refused, and a SELECT
+ cannot write, or switch its transaction to read-write.
+"""
+import unittest
+
+import psycopg2
+
+import sqltool
+from tests.dbtest import DatabaseTest, import_app
+
+class CheckQueryTest(unittest.TestCase):
+
+    def test_accepted(self):
+        for sql in ("SELECT 1", " select\n1", "WITH x AS (SELECT 1) SELECT * FROM x", "SELECT 'a;b'",
+                "SELECT 'it''s; ok'", "SELECT E'\\';'", 'SELECT "a;b" FROM t', "SELECT $$;$$", "SELECT $q$ ; $q$",
+                "SELECT 1 -- ;", "SELECT /* ; */ 1"):
+            with self.subTest(sql=sql):
+                sqltool.check_query(sql)
+
+    def test_not_select(self):
+        for sql in ("DELETE FROM t", "UPDATE t SET a=1", "SET default_transaction_read_only = off", "COMMIT",
+                "SELECTx", "-- comment\nDROP TABLE t", "EXPLAIN ANALYZE DELETE FROM t"):
+            with self.subTest(sql=sql):
+                with self.assertRaisesRegex(ValueError, 'Only SELECT'):
+                    sqltool.check_query(sql)
+
+    def test_one_statement(self):
+        # a semicolon outside quotes and comments would start a second statement
+        for sql in ("SELECT 1; DELETE FROM t", "SELECT 1; COMMIT; DELETE FROM t", "SELECT $$;$$; DELETE FROM t",
+                "SELECT 'a'';'; DELETE FROM t", "SELECT typenamE'\\';DELETE FROM t;--'", "SELECT $1$; DELETE FROM t"):
+            with self.subTest(sql=sql):
+                with self.assertRaisesRegex(ValueError, 'one statement'):
+                    sqltool.check_query(sql)
+
+class ReadOnlyTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("CREATE TABLE IF NOT EXISTS public.sqltool_test (n INTEGER)")
+        self.qry.execute("TRUNCATE public.sqltool_test")
+        self.qry.execute("""CREATE OR REPLACE FUNCTION public.sqltool_write() RETURNS INTEGER AS
+            'INSERT INTO public.sqltool_test VALUES (1) RETURNING n' LANGUAGE SQL""")
+        self.sid = 'SqlToolTest%s' % self._testMethodName
+
+    def tearDown(self):
+        with sqltool.held_lock:
+            entry = sqltool.held.pop(self.sid, None)
+        if entry is not None:
+            entry.close()
+        super().tearDown()
+
+    def rows(self):
+        self.qry.execute("SELECT count(*) FROM public.sqltool_test")
+        return self.qry.fetchone()[0]
+
+    def test_select(self):
+        (columns, rows, total, exact) = sqltool.fetch_page(self.sid, "SELECT n FROM generate_series(1, 25) AS n", 10, 5)
+        self.assertEqual((columns, [row[0] for row in rows]), (['n'], [11, 12, 13, 14, 15]))
+
+    def test_writes_refused(self):
+        for sql in ("SELECT public.sqltool_write()",
+                "WITH x AS (INSERT INTO public.sqltool_test VALUES (1) RETURNING n) SELECT * FROM x"):
+            with self.subTest(sql=sql):
+                with self.assertRaises(psycopg2.Error):
+                    sqltool.fetch_page(self.sid, sql, 0, 10)
+        self.assertEqual(self.rows(), 0)
+
+    def test_read_write_refused(self):
+        # a query cannot switch its transaction, or the session's later ones, to read-write
+        with self.assertRaises(psycopg2.Error):
+            sqltool.fetch_page(self.sid, "SELECT set_config('transaction_read_only', 'off', true), public.sqltool_write()",
+                0, 10)
+        sqltool.fetch_page(self.sid, "SELECT set_config('default_transaction_read_only', 'off', false)", 0, 10)
+        with self.assertRaises(psycopg2.Error):
+            sqltool.fetch_page(self.sid, "SELECT public.sqltool_write()", 0, 10)
+        self.assertEqual(self.rows(), 0)
+
+    def test_process_query(self):
+        gc_dz = import_app()
+        reply = gc_dz.processQuery(self.sid, "INSERT INTO public.sqltool_test VALUES (1)")
+        self.assertIn('Only SELECT queries', reply['html'])
+        reply = gc_dz.processQuery(self.sid, "SELECT 1; INSERT INTO public.sqltool_test VALUES (1);")
+        self.assertIn('Only one statement', reply['html'])
+        reply = gc_dz.processQuery(self.sid, "SELECT public.sqltool_write();")
+        self.assertIn('read-only transaction', reply['html'])
+        self.assertEqual(self.rows(), 0)
+        reply = gc_dz.processQuery(self.sid, "SELECT n FROM generate_series(1, 25) AS n", 21, 10)
+        self.assertEqual((reply['rec_from'], reply['rec_to'], reply['rec_total']), (21, 25, 25))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+ ------------- test_trasematch.py  ------------
+ Tests of the trase/NA lookups in gc_dz.py (traseMatch, nameCheck) with a local
+ stub of the API client in place of the trase service: lookups run in parallel up
+ to the number of workers, repeat lookups are answered from gcdz.match_cache until
+ they expire, and a failed lookup does not lose the results of the others.
+"""
+import time, threading, unittest
+
+from tests.dbtest import DatabaseTest, import_app
+
+class StubAPI:
+    # stand-in for trasesdk.TraseCompaniesDB.  match() waits 'delay' seconds, as a request to the
+    # service would, and raises an error for the names in 'fail'.  Counts the calls and the most
+    # made at the same time
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.calls = []
+        self.active = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def match(self, nm, threshold=0.9, balance=0.5):
+        with self.lock:
+            self.calls.append((nm, threshold, balance))
+            self.active += 1
+            self.most = max(self.most, self.active)
+        try:
+            time.sleep(self.delay)
+            if nm in self.fail:
+                raise RuntimeError('lookup of %s failed' % nm)
+            return [{'match': {'name': nm.upper(), 'id': 'T-%s' % len(nm), 'label': [nm]}, 'score': 0.95}]
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class TraseMatchTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.app = import_app()
+        self.qry.execute("TRUNCATE gcdz.match_cache")
+
+    def test_concurrent(self):
+        api = StubAPI(delay=0.05)
+        names = ['Company %s' % chr(ord('A') + n) for n in range(12)]
+        t0 = time.perf_counter()
+        found = self.app.traseMatch(names, api, workers=4)
+        secs = time.perf_counter() - t0
+        self.assertEqual(len(api.calls), 12)
+        self.assertEqual(api.most, 4)
+        self.assertLess(secs, 12 * 0.05)
+        self.assertEqual([found[nm][0]['match']['name'] for nm in names], [nm.upper() for nm in names])
+
+    def test_cache(self):
+        api = StubAPI()
+        first = self.app.traseMatch(['Cargill Inc', 'Bunge'], api)
+        self.assertEqual(len(api.calls), 2)
+        # names with the same fragments share a cache entry, and repeats are not looked up again
+        again = self.app.traseMatch(['Bunge', 'CARGILL', 'Cargill Ltd.', 'Bunge'], api)
+        self.assertEqual(len(api.calls), 2)
+        self.assertEqual(again['CARGILL'], first['Cargill Inc'])
+        self.assertEqual(again['Bunge'], first['Bunge'])
+        # the match parameters are part of the key
+        self.app.traseMatch(['Bunge'], api, threshold=0.8)
+        self.assertEqual(api.calls[-1], ('Bunge', 0.8, 0.5))
+        self.qry.execute("SELECT count(*) FROM gcdz.match_cache")
+        self.assertEqual(self.qry.fetchone()[0], 3)
+
+    def test_ttl(self):
+        api = StubAPI()
+        self.app.traseMatch(['Olam'], api)
+        self.qry.execute("UPDATE gcdz.match_cache SET ts = NOW() - INTERVAL '2 days'")
+        self.app.traseMatch(['Olam'], api, ttl='3 days')
+        self.assertEqual(len(api.calls), 1)
+        # expired: looked up again, and the cache entry renewed
+        self.app.traseMatch(['Olam'], api, ttl='1 day')
+        self.assertEqual(len(api.calls), 2)
+        self.qry.execute("SELECT count(*) FROM gcdz.match_cache WHERE ts > NOW() - INTERVAL '1 hour'")
+        self.assertEqual(self.qry.fetchone()[0], 1)
+
+    def test_error(self):
+        api = StubAPI(fail=['Wilmar'])
+        with self.assertRaisesRegex(RuntimeError, 'lookup of Wilmar failed'):
+            self.app.traseMatch(['Sime Darby', 'Wilmar', 'Musim Mas'], api)
+        self.assertEqual(len(api.calls), 3)
+        # the other results were kept, so only the failed name is looked up again
+        api.fail = set()
+        found = self.app.traseMatch(['Sime Darby', 'Wilmar', 'Musim Mas'], api)
+        self.assertEqual([nm for (nm, threshold, balance) in api.calls[3:]], ['Wilmar'])
+        self.assertEqual(found['Wilmar'][0]['match']['name'], 'WILMAR')
+
+    def test_name_check(self):
+        api = StubAPI()
+        html = self.app.nameCheck(['Golden <Agri>', '---'], 'trase', api)
+        self.assertIn('GOLDEN &lt;AGRI&gt;', html)
+        self.assertNotIn('<Agri>', html)
+        self.assertEqual([nm for (nm, threshold, balance) in api.calls], ['Golden <Agri>'])
+
+if __name__ == '__main__':
+    unittest.main()
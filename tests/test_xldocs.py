@@ -0,0 +1,59 @@
+"""
+ ------------- test_xldocs.py  ------------
+ Tests of the documents of the assessment sheets (xldocs.py): the triggers that
+ keep them in step with f500.xldata, and the migration in schema_updates.sql,
+ which builds the documents of the files whose cells were saved before it.
+"""
+import os, unittest
+
+import psycopg2.extras
+
+import xldocs
+from tests.dbtest import DatabaseTest
+
+class XLDocsTest(DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("DELETE FROM f500.xldata WHERE flid >= 9000")
+        self.qry.execute("DELETE FROM f500.xldocs WHERE flid >= 9000")
+
+    def cells(self, flid, values):
+        # saves cells of file 'flid' given as a dictionary of cell reference: text, in one statement
+        psycopg2.extras.execute_values(self.qry, "INSERT INTO f500.xldata (flid, xlcell, xltext) VALUES %s",
+            [(flid, cell, text) for (cell, text) in values.items()])
+
+    def test_sync(self):
+        self.cells(9001, {'E10': 'Yes', 'F10': '1'})
+        self.assertEqual(xldocs.load(self.qry, 9001), {'E10': 'Yes', 'F10': '1'})
+        self.qry.execute("UPDATE f500.xldata SET xltext='No' WHERE flid=9001 AND xlcell='E10'")
+        self.cells(9001, {'G10': None})
+        self.qry.execute("DELETE FROM f500.xldata WHERE flid=9001 AND xlcell='F10'")
+        self.assertEqual(xldocs.load(self.qry, 9001), {'E10': 'No', 'G10': None})
+        # a cell held twice has the value of the last row
+        self.cells(9001, {'E10': 'Maybe'})
+        self.assertEqual(xldocs.load(self.qry, 9001)['E10'], 'Maybe')
+        self.assertEqual(xldocs.verify(self.qry, [9001]), [])
+
+    def test_migration(self):
+        # cells saved before the triggers were made have no document until the migration is run
+        self.qry.execute("ALTER TABLE f500.xldata DISABLE TRIGGER xldata_docs_insert")
+        try:
+            self.cells(9002, {'E10': 'Yes', 'F10': '2'})
+            self.cells(9003, {'E11': 'No'})
+        finally:
+            self.qry.execute("ALTER TABLE f500.xldata ENABLE TRIGGER xldata_docs_insert")
+        self.cells(9004, {'E12': 'Yes'})
+        self.qry.execute("UPDATE f500.xldocs SET cells='{\"E12\": \"kept\"}' WHERE flid=9004")
+        self.assertEqual(xldocs.load(self.qry, 9002), {})
+        self.assertEqual(xldocs.verify(self.qry, [9002, 9003, 9004]), [9002, 9003, 9004])
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema_updates.sql')) as fh:
+            self.qry.execute(fh.read())
+        self.assertEqual(xldocs.load(self.qry, 9002), {'E10': 'Yes', 'F10': '2'})
+        self.assertEqual(xldocs.load(self.qry, 9003), {'E11': 'No'})
+        # documents that exist are left alone
+        self.assertEqual(xldocs.load(self.qry, 9004), {'E12': 'kept'})
+        self.assertEqual(xldocs.verify(self.qry, [9002, 9003, 9004]), [9004])
+
+if __name__ == '__main__':
+    unittest.main()
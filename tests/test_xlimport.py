@@ -0,0 +1,85 @@
+"""
+ ------------- test_xlimport.py  ------------
+ Tests of the merge of imported workbooks into f500.xldata (xlimport.py): the
+ cells changed in a file imported before are audited, and a file is not imported
+ over cells edited on the data input form since its previous import, unless
+ forced.
+"""
+import datetime, unittest
+
+import xlimport
+from tests.dbtest import DatabaseTest
+
+class MergeTest(DatabaseTest):
+
+    flid = 9101
+
+    def setUp(self):
+        super().setUp()
+        self.qry.execute("DELETE FROM f500.xldata_audit WHERE sid IN (%s, 'form')", (xlimport.audit_sid,))
+        self.qry.execute("DELETE FROM f500.xldata WHERE flid=%s", (self.flid,))
+        self.qry.execute("DELETE FROM f500.filelist WHERE flid=%s", (self.flid,))
+
+    def merge(self, day, cells, force=False):
+        # imports file self.flid with modification time 'day' of January 2020, and 'cells' as a dictionary
+        # of cell reference: text.  Returns the result of merge_batch
+        data = ''.join('%d\t%s\t%s\n' % (self.flid, cell, text) for (cell, text) in cells.items()).encode('utf-8')
+        fltime = datetime.datetime(2020, 1, day)
+        db = self.db
+        db.autocommit = False
+        try:
+            return xlimport.merge_batch(db, [((self.flid, 1, 'F500_2020_Test.xlsx', fltime, 'Test'), 'h%d' % day,
+                data)], force)
+        finally:
+            db.autocommit = True
+
+    def cells(self):
+        self.qry.execute("SELECT xlcell, xltext FROM f500.xldata WHERE flid=%s", (self.flid,))
+        return dict(self.qry.fetchall())
+
+    def audit(self):
+        self.qry.execute("""SELECT x.xlcell, a.oldval, a.newval FROM f500.xldata_audit AS a
+            LEFT JOIN f500.xldata AS x USING (xlid) WHERE a.sid=%s ORDER BY a.oldval, a.newval""",
+            (xlimport.audit_sid,))
+        return self.qry.fetchall()
+
+    def form_edit(self, cell, text):
+        # saves a cell as the data input form does (see f500_audit_save in gc_dz.py), after the import
+        self.qry.execute("""INSERT INTO f500.xldata_audit (xlid, sid, ts, oldval, newval)
+            SELECT xlid, 'form', '2020-01-05', xltext, %s FROM f500.xldata WHERE flid=%s AND xlcell=%s""",
+            (text, self.flid, cell))
+        self.qry.execute("UPDATE f500.xldata SET xltext=%s WHERE flid=%s AND xlcell=%s", (text, self.flid, cell))
+
+    def test_audit(self):
+        # the first import of a file is not audited, later ones are
+        self.assertEqual(self.merge(1, {'E10': 'Yes', 'F10': '1'}), (0, 0, 2, []))
+        self.assertEqual(self.audit(), [])
+        self.assertEqual(self.merge(2, {'E10': 'No', 'G10': 'x'}), (1, 1, 1, []))
+        self.assertEqual(self.cells(), {'E10': 'No', 'G10': 'x'})
+        self.assertEqual(self.audit(), [(None, '1', None), ('E10', 'Yes', 'No'), ('G10', None, 'x')])
+
+    def test_form_edits_kept(self):
+        self.merge(1, {'E10': 'Yes', 'F10': '1'})
+        self.form_edit('E10', 'No')
+        # an import that would change the edited cell is refused, and nothing of the file is changed
+        self.assertEqual(self.merge(10, {'E10': 'Yes', 'F10': '2'}), (0, 0, 0, [self.flid]))
+        self.assertEqual(self.cells(), {'E10': 'No', 'F10': '1'})
+        self.qry.execute("SELECT fltime FROM f500.filelist WHERE flid=%s", (self.flid,))
+        self.assertEqual(self.qry.fetchone()[0], datetime.datetime(2020, 1, 1))
+        # as is one that would delete it
+        self.assertEqual(self.merge(10, {'F10': '2'})[3], [self.flid])
+        # one that has the edit (copied to the workbook) is imported
+        self.assertEqual(self.merge(10, {'E10': 'No', 'F10': '2'}), (0, 1, 0, []))
+        self.assertEqual(self.cells(), {'E10': 'No', 'F10': '2'})
+
+    def test_force(self):
+        self.merge(1, {'E10': 'Yes'})
+        self.form_edit('E10', 'No')
+        self.assertEqual(self.merge(10, {'E10': 'Yes'}, force=True), (0, 1, 0, []))
+        self.assertEqual(self.cells(), {'E10': 'Yes'})
+        self.assertEqual(self.audit(), [('E10', 'No', 'Yes')])
+        # the edit was overwritten by the import, so does not hold up the next one
+        self.assertEqual(self.merge(11, {'E10': 'Maybe'}), (0, 1, 0, []))
+
+if __name__ == '__main__':
+    unittest.main()
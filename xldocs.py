@@ -0,0 +1,102 @@
+"""
+ ------------- xldocs.py  ------------
+ Document storage of the Forest 500 assessment sheets.  f500.xldata holds one
+ row for each cell of each company file, so reading a form gathers hundreds of
+ rows from an index, for each indicator table shown.  Table f500.xldocs keeps the
+ same values as one JSONB document per file, keyed by cell reference, eg
+ {"E20": "Yes", "F20": "1", ...}: reading the whole form is then the fetch of a
+ single row, which is also several times smaller than the cell rows and their
+ indexes, as the document is compressed.
+
+ xldata is still where the values are written (the input form, imports and the
+ audit trail all use it), and the documents are kept in step with it by
+ statement triggers on xldata (see schema_updates.sql), in the same transaction
+ as the change: a cell saved on the input form becomes a single-key update of
+ its file's document.  A file with no document yet gets one made from all its
+ cells when one of them changes.
+
+ The forms read from the documents if read_docs is True (see f500_assess,
+ f500_input_table_ajax and f500_indNotes in gc_dz.py), otherwise from xldata as
+ before.  schema_updates.sql builds the documents of the files already in
+ xldata, in one transaction.  They can also be built a batch at a time (eg to
+ rebuild them all), or checked against xldata, from the command line:
+
+     python3 xldocs.py [--all] [--verify] [--batch N]
+
+ Without --all, only files without a document are built.  Each batch of files
+ is built in a transaction that holds a SHARE lock on xldata, so no cells change
+ while their documents are made (input form saves wait for the batch).
+"""
+import time, argparse
+
+# local modules
+import dbauth
+
+# settings: read the forms from the documents (False for the cells in xldata), and files built by each
+# transaction of the backfill
+read_docs = True
+default_batch = 200
+
+def load(qry, flid):
+    # returns the values of company file 'flid' as a dictionary of cell reference: text (empty if the file has
+    # no document)
+    qry.execute("SELECT cells FROM f500.xldocs WHERE flid=%s", (flid,))
+    row = qry.fetchone()
+    return {} if row is None else row[0]
+
+def attach(rows, cells, name='xltext', cell='xlcell'):
+    # returns the rows of a query (eg the parts of an indicator) as dictionaries, with the value of the cell
+    # given by field 'cell' added as field 'name' (None if the cell has no value)
+    return [dict(row, **{name: cells.get(row[cell])}) for row in rows]
+
+def build(qry, flids):
+    # makes the documents of the files in list 'flids' from their cells in xldata.  Returns the number of
+    # documents written (those that were already the same are not)
+    qry.execute("LOCK TABLE f500.xldata IN SHARE MODE")
+    qry.execute("""INSERT INTO f500.xldocs (flid, cells)
+        SELECT flid, jsonb_object_agg(xlcell, xltext ORDER BY xlid) FROM f500.xldata
+        WHERE flid = ANY(%s) AND xlcell IS NOT NULL GROUP BY flid
+        ON CONFLICT (flid) DO UPDATE SET cells=EXCLUDED.cells, updated=NOW()
+            WHERE xldocs.cells IS DISTINCT FROM EXCLUDED.cells""", (list(flids),))
+    return qry.rowcount
+
+def verify(qry, flids=None):
+    # returns the files (in list 'flids', or all) whose document does not hold the same values as xldata, or
+    # that have cells but no document
+    qry.execute("""SELECT x.flid FROM (SELECT flid, jsonb_object_agg(xlcell, xltext ORDER BY xlid) AS cells
+            FROM f500.xldata WHERE (%(FLIDS)s::INT[] IS NULL OR flid = ANY(%(FLIDS)s::INT[])) AND xlcell IS NOT NULL
+            GROUP BY flid) AS x
+        LEFT JOIN f500.xldocs AS d ON d.flid=x.flid WHERE d.cells IS DISTINCT FROM x.cells ORDER BY 1""",
+        {'FLIDS': flids})
+    return [row[0] for row in qry.fetchall()]
+
+def backfill(db, rebuild=False, batch=default_batch):
+    # builds the documents of the files with cells in xldata that have none (or of all files, if 'rebuild'),
+    # a batch at a time, and prints progress.  Returns (files, documents written)
+    qry = db.cursor()
+    qry.execute("""SELECT DISTINCT x.flid FROM f500.xldata AS x WHERE %s OR NOT EXISTS
+        (SELECT 1 FROM f500.xldocs AS d WHERE d.flid=x.flid) ORDER BY 1""", (rebuild,))
+    flids = [row[0] for row in qry.fetchall()]
+    db.commit()
+    written = 0
+    for n in range(0, len(flids), batch):
+        written += build(qry, flids[n:n + batch])
+        db.commit()
+        print('-- %s of %s files --' % (min(n + batch, len(flids)), len(flids)))
+    return (len(flids), written)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the documents of the Forest 500 assessment sheets from xldata')
+    parser.add_argument('--all', action='store_true', help='build the documents of all files, not only those without')
+    parser.add_argument('--verify', action='store_true', help='only check the documents against xldata')
+    parser.add_argument('--batch', type=int, default=default_batch, help='files built by each transaction')
+    args = parser.parse_args()
+    db = dbauth.dbconn()
+    t0 = time.perf_counter()
+    if args.verify:
+        bad = verify(db.cursor())
+        print('-- %s files differ from xldata%s --' % (len(bad), ': %s' % ', '.join(map(str, bad)) if bad else ''))
+    else:
+        (files, written) = backfill(db, args.all, args.batch)
+        print('-- %s files, %s documents written in %.1f secs --' % (files, written, time.perf_counter() - t0))
+    db.close()
@@ -0,0 +1,228 @@
+"""
+ ------------- xlexport.py  ------------
+ Export of Forest 500 assessments from f500.xldata back to Excel workbooks, in
+ the cell layout of the original sheets (xldata keeps each value under its cell
+ reference, xlcell, with the column and row in xlcol and xlrow).  A workbook is
+ written for one company file, or for all the files of a year (optionally of
+ one company type), which are then put in a zip archive.
+
+ Cells are read from a server-side cursor, in row order, and written with
+ openpyxl's write-only workbook, which streams the rows to a temporary file,
+ so memory use does not grow with the size of the sheet.  The files of a year
+ are exported by a pool of worker processes, each with its own connection.
+ Numbers and dates stored as text are written as numbers and dates again, and
+ text that would be taken for a formula is written as text.
+
+ Exports run as background jobs (kind 'xlexport', see jobs.py), submitted by
+ the Ajax action 'f500.xlexport', and the finished file is downloaded from
+ module 'xlx' by the user who asked for it.  Exported files are kept for
+ keep_days in export_dir.  A year can also be exported from the command line:
+
+     python3 xlexport.py YEAR [--cotype CO|FI] [--workers N] [--out DIR]
+"""
+import os, re, json, time, shutil, zipfile, tempfile, argparse, datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# postgreSQL interface module
+import psycopg2
+
+# Excel workbook writer (write-only mode)
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import column_index_from_string
+
+# local modules
+import dbauth
+import jobs
+
+# settings: directory for exported files, days they are kept, worker processes for a year (0 for one
+# per CPU), and rows fetched from the server at a time
+export_dir = '/var/lib/gcdz/xlexport'
+keep_days = 7
+default_workers = 0
+fetch_rows = 5000
+
+# content types of the exported files
+content_types = {'.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.zip': 'application/zip'}
+
+# text written as a number, as it was in the original sheet (no leading zeros, which would be lost)
+number_rgx = re.compile(r'^-?(0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?$')
+# text written as a date, as the dates in the workbooks are imported (see xlimport.cell_text)
+date_rgx = re.compile(r'^\d{4}-\d\d-\d\d( \d\d:\d\d:\d\d)?$')
+# characters not allowed in file names and sheet titles
+flname_rgx = re.compile(r'[^\w.-]+')
+title_rgx = re.compile(r'[\[\]:*?/\\]')
+
+# connection of each worker process in the pool, opened by its first task (see export_task)
+worker_db = None
+
+def cell_value(ws, text):
+    # value written for the text of a cell: a number, date, or a cell holding text
+    if number_rgx.match(text):
+        number = float(text)
+        return int(number) if number.is_integer() and '.' not in text and 'e' not in text.lower() else number
+    if date_rgx.match(text):
+        try:
+            return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S' if len(text) > 10 else '%Y-%m-%d')
+        except ValueError:
+            pass
+    text = ILLEGAL_CHARACTERS_RE.sub('', text)
+    if text.startswith('='):
+        # not a formula
+        cell = WriteOnlyCell(ws, value=text)
+        cell.data_type = 's'
+        return cell
+    return text
+
+def file_details(qry, flids):
+    # returns (flid, file name, sheet title) for the company files in list 'flids'.  The file name is the
+    # original workbook's, as .xlsx (macros are not kept)
+    qry.execute("""SELECT f.flid, f.flname, x.coname, d.ayear FROM f500.filelist AS f
+        INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid LEFT JOIN f500.xlcohdr AS x ON x.flid=f.flid
+        WHERE f.flid = ANY(%s) ORDER BY f.flid""", (list(flids),))
+    details = []
+    for (flid, flname, coname, ayear) in qry.fetchall():
+        name = os.path.splitext(flname or '')[0] or 'F500_%s_%s' % (ayear, flid)
+        title = title_rgx.sub(' ', coname or 'File %s' % flid)[:31]
+        details.append((flid, '%s.xlsx' % flname_rgx.sub('_', name), title))
+    return details
+
+def export_file(db, flid, path, title='Sheet1'):
+    # writes the cells of company file 'flid' to a workbook 'path', in one sheet called 'title'.  Returns
+    # the number of cells written
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    cur = db.cursor('xlexport_%s' % flid)
+    cur.itersize = fetch_rows
+    cur.execute("""SELECT xlrow, xlcol, xltext FROM f500.xldata WHERE flid=%s AND xlrow > 0 AND xlcol > ''
+        AND xltext > '' ORDER BY xlrow, length(xlcol), xlcol""", (flid,))
+    (rownum, cells, count) = (1, [], 0)
+    for (xlrow, xlcol, xltext) in cur:
+        # rows are written in order, including any empty rows before this one
+        while rownum < xlrow:
+            ws.append(cells)
+            (rownum, cells) = (rownum + 1, [])
+        col = column_index_from_string(xlcol)
+        if col <= len(cells):
+            # the same cell twice: the last value is kept
+            cells[col - 1] = cell_value(ws, xltext)
+            continue
+        cells.extend([None] * (col - 1 - len(cells)))
+        cells.append(cell_value(ws, xltext))
+        count += 1
+    if len(cells) > 0:
+        ws.append(cells)
+    cur.close()
+    db.commit()
+    wb.save(path)
+    return count
+
+def export_task(task):
+    # worker process: exports one file, given as (flid, path, sheet title).  Returns the cells written
+    global worker_db
+    (flid, path, title) = task
+    if worker_db is None:
+        worker_db = dbauth.dbconn()
+    return export_file(worker_db, flid, path, title)
+
+def export_year(ayear, cotype, outdir, workers=default_workers, progress=None):
+    # exports the files of year 'ayear' (and type 'cotype', or all types if empty) to directory 'outdir',
+    # in parallel.  Calls progress(done, total) as files are finished.  Returns (files, cells)
+    db = dbauth.dbconn()
+    qry = db.cursor()
+    qry.execute("""SELECT f.flid FROM f500.filelist AS f INNER JOIN f500.dirtree AS d ON f.dtid=d.dtid
+        WHERE d.ayear=%s AND (d.cotype=%s OR %s='') ORDER BY f.flid""", (ayear, cotype, cotype))
+    details = file_details(qry, [row[0] for row in qry.fetchall()])
+    db.close()
+    tasks = [(flid, os.path.join(outdir, '%s_%s' % (flid, flname)), title) for (flid, flname, title) in details]
+    if progress is not None:
+        progress(0, len(tasks))
+    cells = 0
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        for (n, count) in enumerate(pool.map(export_task, tasks), 1):
+            cells += count
+            if progress is not None:
+                progress(n, len(tasks))
+    return (len(tasks), cells)
+
+def zip_dir(srcdir, path):
+    # puts the workbooks in 'srcdir' in zip archive 'path' (stored, as workbooks are already compressed)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        for name in sorted(os.listdir(srcdir)):
+            zf.write(os.path.join(srcdir, name), name)
+
+def purge_exports():
+    # deletes exported files older than keep_days
+    limit = time.time() - keep_days * 86400
+    for name in os.listdir(export_dir):
+        path = os.path.join(export_dir, name)
+        if os.path.isfile(path) and os.path.getmtime(path) < limit:
+            os.remove(path)
+
+def submit_export(qry, sid, flid=0, ayear=0, cotype=''):
+    # submits a job exporting company file 'flid', or if this is 0 the files of year 'ayear' (and type
+    # 'cotype').  Returns (job ID, name of the exported file, see export_path)
+    name = os.urandom(12).hex() + ('.xlsx' if flid > 0 else '.zip')
+    jobid = jobs.submit_job(qry, sid, 'xlexport', {'flid': flid, 'ayear': ayear, 'cotype': cotype, 'file': name})
+    return (jobid, name)
+
+def export_path(qry, name, sid):
+    # returns (path, content type, download file name) of an exported file, if it was made by a job of the
+    # user of session 'sid' and is still kept, or None
+    qry.execute("""SELECT j.params FROM gcdz.jobs AS j
+        INNER JOIN gcdz.logins AS a ON j.sessionid=a.sessionid
+        INNER JOIN gcdz.logins AS b ON a.userid=b.userid
+        WHERE j.kind='xlexport' AND j.status='done' AND j.params::JSONB->>'file'=%s AND b.sessionid=%s""",
+        (name, sid))
+    path = os.path.join(export_dir, os.path.basename(name))
+    if qry.rowcount <= 0 or not os.path.isfile(path):
+        return None
+    params = json.loads(qry.fetchone()[0])
+    if params['flid'] > 0:
+        details = file_details(qry, [params['flid']])
+        download = details[0][1] if len(details) > 0 else name
+    else:
+        download = 'F500_%s%s.zip' % (params['ayear'], '_' + params['cotype'] if params['cotype'] else '')
+    return (path, content_types[os.path.splitext(name)[1]], download)
+
+def xlexport_job(params, progress):
+    # background job handler (see jobs.py) - exports a file or a year to export_dir, under the name given in
+    # params['file'], and returns a summary as HTML.  The page that submitted the job links to the file
+    os.makedirs(export_dir, exist_ok=True)
+    purge_exports()
+    path = os.path.join(export_dir, params['file'])
+    t0 = time.perf_counter()
+    if params['flid'] > 0:
+        progress(0, 1)
+        db = dbauth.dbconn()
+        details = file_details(db.cursor(), [params['flid']])
+        if len(details) == 0:
+            raise RuntimeError("Company file %s not found" % params['flid'])
+        (flid, flname, title) = details[0]
+        cells = export_file(db, flid, path + '.part', title)
+        db.close()
+        nfiles = 1
+    else:
+        tmpdir = tempfile.mkdtemp(dir=export_dir)
+        try:
+            (nfiles, cells) = export_year(params['ayear'], params['cotype'], tmpdir, progress=progress)
+            zip_dir(tmpdir, path + '.part')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    os.rename(path + '.part', path)
+    return "%s workbooks, %s cells exported in %.1f seconds." % (nfiles, cells, time.perf_counter() - t0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the Forest 500 assessments of a year as workbooks')
+    parser.add_argument('year', type=int, help='assessment year')
+    parser.add_argument('--cotype', default='', help='company type, CO or FI (default both)')
+    parser.add_argument('--workers', type=int, default=default_workers, help='worker processes (default one per CPU)')
+    parser.add_argument('--out', default='.', help='directory for the workbooks')
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    os.makedirs(args.out, exist_ok=True)
+    (nfiles, cells) = export_year(args.year, args.cotype, args.out, args.workers)
+    secs = time.perf_counter() - t0
+    print('-- %s workbooks, %s cells in %.1f secs (%.0f cells/sec) --' % (nfiles, cells, secs, cells / max(secs, 1e-6)))
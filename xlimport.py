@@ -0,0 +1,329 @@
+"""
+ ------------- xlimport.py  ------------
+ Bulk import of the Forest 500 assessment workbooks (.xlsx/.xlsm) into tables
+ f500.dirtree, filelist, xlcohdr and xldata.  Run from the command line with the
+ root of the directory tree holding the workbooks:
+
+     python3 xlimport.py ROOT [--workers N] [--batch N] [--force]
+
+ The assessment year and company type of each file come from the directories
+ above it (eg ROOT/2018/FI/F500_2018_Some_Bank.xlsx): the nearest directory
+ named with a year, and the nearest named CO or FI.  Files elsewhere are listed
+ and skipped.  A file is identified by its directory (dirtree) and name, and
+ keeps its flid when imported again.
+
+ The import is incremental.  A file whose modification time (fltime) has not
+ changed since it was imported is skipped without being read, and one whose
+ contents are the same (SHA-1 hash, filelist.flhash) only has its time updated.
+ --force reads every file again, and imports it over any edits on the form.
+
+ Workbooks are parsed in a pool of worker processes, with openpyxl in read-only
+ mode, which streams the sheet rather than building it in memory.  Each value
+ on the first sheet becomes a row (flid, xlcell, xltext), and a worker returns
+ its file's rows already in COPY format.  The main process loads them with COPY
+ into a staging table, a batch of files at a time, while the workers go on with
+ the next files, and merges each batch into f500.xldata with one statement
+ each for the cells deleted, changed and added, so the xlids (and audit trail)
+ of unchanged cells are kept.  The cells changed in a file imported before are
+ recorded in f500.xldata_audit, as the data input form does, under session ID
+ audit_sid (the first import of a file is not: its cells are the workbook).
+
+ An imported file replaces all the cells of its flid.  A file with cells that
+ the import would change, and that were edited on the data input form since
+ its previous import (fltime), is not imported but listed, so that the edits
+ can be copied to the workbook first.  --force imports it over the edits.
+
+ New files get a company name (xlcohdr) from cell coname_cell, or from the file
+ name if this is None; the names of files already imported are not changed.
+ Link new files to their companies with the colink tool (see colink.py).
+ The scores of the files read are rebuilt in the same transaction (see scoring.py).
+"""
+import os, io, re, time, hashlib, argparse, datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# postgreSQL interface module
+import psycopg2
+import psycopg2.extras
+
+# Excel workbook reader (read-only mode)
+import openpyxl
+from openpyxl.utils import get_column_letter
+
+# local modules
+import dbauth
+import scoring
+
+# workbooks imported (lock files left open by Excel, ~$name.xlsx, are skipped)
+xlfile_rgx = re.compile(r'^[^~].*\.xls[xm]$', re.I)
+# directory names giving the assessment year and company type of the files below them
+year_rgx = re.compile(r'(?<!\d)((?:19|20)\d\d)(?!\d)')
+cotype_rgx = re.compile(r'^(CO|FI)(?![A-Za-z])', re.I)
+# start of a file name before the company name, eg 'F500_2018_'
+flname_prefix_rgx = re.compile(r'^F500[ _-]*(?:(?:19|20)\d\d[ _-]*)?', re.I)
+
+# settings: sheet imported (index), cell holding the company name (None to use the file name),
+# worker processes (0 for one per CPU) and files loaded by each COPY and merge
+sheet_index = 0
+coname_cell = None
+default_workers = 0
+default_batch = 50
+
+# lock held by the import, so that two cannot allocate the same flids
+lock_key = 'f500.xlimport'
+# session ID of the changes made by the import in f500.xldata_audit
+audit_sid = 'xlimport'
+
+def cell_text(value):
+    # text stored in xldata for a cell value from openpyxl, as Excel would show it without formatting
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time(0):
+            return value.date().isoformat()
+        return value.isoformat(sep=' ')
+    return str(value)
+
+def copy_text(text):
+    # 'text' escaped for the COPY text format
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def read_workbook(task):
+    # worker process: reads one workbook, given as (flid, path, hash when last imported or None).  Returns
+    # (flid, hash, rows in COPY format as bytes, number of rows, company name, error message), with rows
+    # None if the file has not changed, or could not be read (error is then given)
+    (flid, path, oldhash) = task
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        flhash = hashlib.sha1(data).hexdigest()
+        if flhash == oldhash:
+            return (flid, flhash, None, 0, None, None)
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[sheet_index]
+            (lines, coname) = ([], None)
+            for (r, row) in enumerate(ws.iter_rows(min_row=1, min_col=1, values_only=True), 1):
+                for (c, value) in enumerate(row, 1):
+                    if value is None or value == '':
+                        continue
+                    xlcell = '%s%d' % (get_column_letter(c), r)
+                    text = cell_text(value)
+                    if xlcell == coname_cell:
+                        coname = text.strip()
+                    lines.append('%d\t%s\t%s\n' % (flid, xlcell, copy_text(text)))
+        finally:
+            wb.close()
+        return (flid, flhash, ''.join(lines).encode('utf-8'), len(lines), coname, None)
+    except Exception as err:
+        return (flid, None, None, 0, None, '%s: %s' % (type(err).__name__, err))
+
+def file_coname(flname):
+    # company name from a workbook's file name, eg 'F500_2018_Some_Bank.xlsx' -> 'Some Bank'
+    nm = os.path.splitext(flname)[0]
+    nm = flname_prefix_rgx.sub('', nm)
+    return ' '.join(nm.replace('_', ' ').split())
+
+def dir_keys(reldir):
+    # (company type, year) of the files in directory 'reldir' (relative to the root), or None if not known
+    (cotype, ayear) = (None, None)
+    for part in reversed(reldir.split(os.sep)):
+        if cotype is None and cotype_rgx.match(part):
+            cotype = part[:2].upper()
+        if ayear is None and year_rgx.search(part):
+            ayear = int(year_rgx.search(part).group(1))
+    if cotype is None or ayear is None:
+        return None
+    return (cotype, ayear)
+
+def scan_tree(root):
+    # generates (relative directory, file name, path, modification time) for the workbooks under 'root'
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for flname in sorted(filenames):
+            if xlfile_rgx.match(flname):
+                path = os.path.join(dirpath, flname)
+                fltime = datetime.datetime.fromtimestamp(int(os.path.getmtime(path)))
+                yield (os.path.relpath(dirpath, root), flname, path, fltime)
+
+def plan_import(qry, root, force=False):
+    # compares the tree under 'root' with filelist.  Adds any new dirtree rows, and returns (tasks, files,
+    # counts), where tasks are the files to read (see read_workbook), files gives the filelist row of each
+    # as flid -> [dtid, flname, fltime, coname], and counts has the files 'unchanged' and 'skipped'
+    qry.execute("SELECT dtid, cotype, ayear FROM f500.dirtree")
+    dtids = {(row[1], row[2]): row[0] for row in qry.fetchall()}
+    qry.execute("SELECT flid, dtid, flname, fltime, flhash FROM f500.filelist")
+    known = {(row[1], row[2]): row for row in qry.fetchall()}
+    qry.execute("SELECT COALESCE(max(flid), 0) FROM f500.filelist")
+    nextflid = qry.fetchone()[0] + 1
+    (tasks, files, counts) = ([], {}, {'unchanged': 0, 'skipped': 0})
+    for (reldir, flname, path, fltime) in scan_tree(root):
+        keys = dir_keys(reldir)
+        if keys is None:
+            print('-- skipped %s: year and company type not known from its directory --' % os.path.join(reldir, flname))
+            counts['skipped'] += 1
+            continue
+        if keys not in dtids:
+            qry.execute("""INSERT INTO f500.dirtree (dtid, cotype, ayear)
+                SELECT COALESCE(max(dtid), 0) + 1, %s, %s FROM f500.dirtree RETURNING dtid""", keys)
+            dtids[keys] = qry.fetchone()[0]
+        dtid = dtids[keys]
+        row = known.get((dtid, flname))
+        if row is None:
+            (flid, oldhash, nextflid) = (nextflid, None, nextflid + 1)
+        elif row['fltime'] == fltime and row['flhash'] is not None and not force:
+            counts['unchanged'] += 1
+            continue
+        else:
+            (flid, oldhash) = (row['flid'], None if force else row['flhash'])
+        tasks.append((flid, path, oldhash))
+        files[flid] = [dtid, flname, fltime, file_coname(flname)]
+    return (tasks, files, counts)
+
+def merge_batch(db, batch, force=False):
+    # loads a batch of files read by read_workbook, as a list of (filelist row, hash, rows in COPY format or
+    # None if unchanged), and merges them into the f500 tables in one transaction.  Returns the counts of
+    # cells (deleted, changed, added), and the flids of the files not imported because cells they change
+    # were edited on the form since their previous import (none if 'force')
+    qry = db.cursor()
+    qry.execute("""CREATE TEMP TABLE IF NOT EXISTS xlimport_files (flid INTEGER PRIMARY KEY, dtid INTEGER,
+        flname TEXT, fltime TIMESTAMP, flhash TEXT, coname TEXT, parsed BOOLEAN, imported BOOLEAN)""")
+    qry.execute("CREATE TEMP TABLE IF NOT EXISTS xlimport_cells (flid INTEGER, xlcell TEXT, xltext TEXT)")
+    qry.execute("TRUNCATE xlimport_files, xlimport_cells")
+    psycopg2.extras.execute_values(qry, "INSERT INTO xlimport_files VALUES %s",
+        [(flid, dtid, flname, fltime, flhash, coname, data is not None)
+         for ((flid, dtid, flname, fltime, coname), flhash, data) in batch])
+    qry.copy_expert("COPY xlimport_cells (flid, xlcell, xltext) FROM STDIN",
+        io.BytesIO(b''.join(data for (file, flhash, data) in batch if data is not None)))
+    qry.execute("ANALYZE xlimport_cells")
+    # files imported before, whose changes are audited
+    qry.execute("""UPDATE xlimport_files AS i SET imported=EXISTS (SELECT 1 FROM f500.filelist AS f
+        WHERE f.flid=i.flid)""")
+    edited = []
+    if not force:
+        # files with a cell that would be changed or deleted, whose last change is an edit on the form (not an
+        # import) made since the file's previous import
+        qry.execute("""SELECT DISTINCT x.flid FROM f500.xldata AS x
+            INNER JOIN xlimport_files AS i ON i.flid=x.flid AND i.parsed AND i.imported
+            INNER JOIN f500.filelist AS f ON f.flid=x.flid
+            LEFT JOIN xlimport_cells AS s ON s.flid=x.flid AND s.xlcell=x.xlcell
+            WHERE (s.flid IS NULL OR x.xltext IS DISTINCT FROM s.xltext)
+            AND EXISTS (SELECT 1 FROM f500.xldata_audit AS a WHERE a.xlid=x.xlid AND a.ts > f.fltime
+                AND a.sid IS DISTINCT FROM %s AND NOT EXISTS (SELECT 1 FROM f500.xldata_audit AS b
+                WHERE b.xlid=a.xlid AND b.sid=%s AND b.ts >= a.ts))
+            ORDER BY x.flid""", (audit_sid, audit_sid))
+        edited = [row[0] for row in qry.fetchall()]
+        if len(edited) > 0:
+            qry.execute("DELETE FROM xlimport_files WHERE flid = ANY(%s)", (edited,))
+            qry.execute("DELETE FROM xlimport_cells WHERE flid = ANY(%s)", (edited,))
+    qry.execute("""INSERT INTO f500.filelist (flid, dtid, flname, fltime, flhash)
+        SELECT flid, dtid, flname, fltime, flhash FROM xlimport_files
+        ON CONFLICT (flid) DO UPDATE SET fltime=EXCLUDED.fltime, flhash=EXCLUDED.flhash""")
+    qry.execute("""INSERT INTO f500.xlcohdr (flid, coname) SELECT flid, coname FROM xlimport_files
+        WHERE coname > '' ON CONFLICT (flid) DO NOTHING""")
+    # set-based merge of the cells of the files read: deleted, changed, then added.  Each statement passes
+    # the cells it changes to an INSERT into the audit table, for the files imported before
+    qry.execute("""WITH cells AS (DELETE FROM f500.xldata AS x
+            WHERE x.flid IN (SELECT flid FROM xlimport_files WHERE parsed)
+            AND NOT EXISTS (SELECT 1 FROM xlimport_cells AS s WHERE s.flid=x.flid AND s.xlcell=x.xlcell)
+            RETURNING x.xlid, x.flid, x.xltext),
+        audit AS (INSERT INTO f500.xldata_audit (xlid, sid, ts, oldval, newval)
+            SELECT c.xlid, %s, NOW(), c.xltext, NULL FROM cells AS c
+            WHERE c.flid IN (SELECT flid FROM xlimport_files WHERE imported))
+        SELECT count(*) FROM cells""", (audit_sid,))
+    deleted = qry.fetchone()[0]
+    qry.execute("""WITH cells AS (UPDATE f500.xldata AS x SET xltext=s.xltext FROM xlimport_cells AS s, f500.xldata AS o
+            WHERE x.flid=s.flid AND x.xlcell=s.xlcell AND x.xltext IS DISTINCT FROM s.xltext AND o.xlid=x.xlid
+            RETURNING x.xlid, x.flid, o.xltext AS oldval, x.xltext AS newval),
+        audit AS (INSERT INTO f500.xldata_audit (xlid, sid, ts, oldval, newval)
+            SELECT c.xlid, %s, NOW(), c.oldval, c.newval FROM cells AS c
+            WHERE c.flid IN (SELECT flid FROM xlimport_files WHERE imported))
+        SELECT count(*) FROM cells""", (audit_sid,))
+    changed = qry.fetchone()[0]
+    qry.execute("""WITH cells AS (INSERT INTO f500.xldata (flid, xlcell, xltext) SELECT s.flid, s.xlcell, s.xltext
+            FROM xlimport_cells AS s WHERE NOT EXISTS (SELECT 1 FROM f500.xldata AS x
+            WHERE x.flid=s.flid AND x.xlcell=s.xlcell)
+            RETURNING xlid, flid, xltext),
+        audit AS (INSERT INTO f500.xldata_audit (xlid, sid, ts, newval)
+            SELECT c.xlid, %s, NOW(), c.xltext FROM cells AS c
+            WHERE c.flid IN (SELECT flid FROM xlimport_files WHERE imported))
+        SELECT count(*) FROM cells""", (audit_sid,))
+    added = qry.fetchone()[0]
+    # scores of the files read, from their new cells
+    scoring.rebuild(qry, [flid for ((flid, dtid, flname, fltime, coname), flhash, data) in batch
+        if data is not None and flid not in edited])
+    db.commit()
+    return (deleted, changed, added, edited)
+
+def import_tree(root, workers=default_workers, batch_size=default_batch, force=False):
+    # imports the workbooks under 'root', and prints progress and the rates achieved.  Returns a dictionary
+    # of counts and times
+    db = dbauth.dbconn()
+    qry = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    qry.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (lock_key,))
+    if not qry.fetchone()[0]:
+        raise RuntimeError("Another import is running")
+    t0 = time.perf_counter()
+    (tasks, files, counts) = plan_import(qry, root, force)
+    db.commit()
+    counts.update({'read': 0, 'same': 0, 'failed': 0, 'edited': 0, 'cells': 0, 'deleted': 0, 'changed': 0,
+        'added': 0})
+    (batch, cells, loadsecs) = ([], 0, 0.0)
+    def load():
+        # merges the batch of files read so far
+        nonlocal batch, cells, loadsecs
+        t1 = time.perf_counter()
+        (deleted, changed, added, edited) = merge_batch(db, batch, force)
+        loadsecs += time.perf_counter() - t1
+        for flid in edited:
+            print('-- not imported %s: cells it changes were edited on the form since its last import '
+                '(copy them to the workbook, or use --force) --' % files[flid][1])
+        counts['read'] -= len(edited)
+        counts['edited'] += len(edited)
+        cells -= sum(data.count(b'\n') for ((flid, dtid, flname, fltime, coname), flhash, data) in batch
+            if flid in edited)
+        counts['deleted'] += deleted
+        counts['changed'] += changed
+        counts['added'] += added
+        counts['cells'] += cells
+        print('-- %s of %s files, %s cells loaded --' % (counts['read'] + counts['same'] + counts['failed']
+            + counts['edited'], len(tasks), counts['cells']))
+        (batch, cells) = ([], 0)
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        for (flid, flhash, data, nrows, coname, error) in pool.map(read_workbook, tasks, chunksize=4):
+            (dtid, flname, fltime, default_coname) = files[flid]
+            if error is not None:
+                print('-- failed %s: %s --' % (flname, error))
+                counts['failed'] += 1
+                continue
+            counts['same' if data is None else 'read'] += 1
+            batch.append(((flid, dtid, flname, fltime, coname or default_coname), flhash, data))
+            cells += nrows
+            if len(batch) >= batch_size:
+                load()
+        if len(batch) > 0:
+            load()
+    if counts['read'] > 0:
+        qry.execute("ANALYZE f500.xldata")
+        db.commit()
+    secs = time.perf_counter() - t0
+    db.close()
+    counts.update({'secs': secs, 'load_secs': loadsecs})
+    print('-- %s files: %s read, %s with the same contents, %s unchanged, %s failed, %s skipped, '
+        '%s not imported over edits on the form --' % (len(tasks) + counts['unchanged'] + counts['skipped'],
+        counts['read'], counts['same'], counts['unchanged'], counts['failed'], counts['skipped'], counts['edited']))
+    print('-- %s cells in %.1f secs (%.0f cells/sec); COPY and merge %.1f secs (%.0f rows/sec): '
+        '%s added, %s changed, %s deleted --' % (counts['cells'], secs, counts['cells'] / max(secs, 1e-6),
+        loadsecs, counts['cells'] / max(loadsecs, 1e-6), counts['added'], counts['changed'], counts['deleted']))
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import Forest 500 assessment workbooks into the f500 tables')
+    parser.add_argument('root', help='directory tree holding the workbooks')
+    parser.add_argument('--workers', type=int, default=default_workers, help='worker processes (default one per CPU)')
+    parser.add_argument('--batch', type=int, default=default_batch, help='files loaded by each COPY and merge')
+    parser.add_argument('--force', action='store_true',
+        help='read every file, even if unchanged, and import it over any edits on the data input form')
+    args = parser.parse_args()
+    import_tree(args.root, args.workers, args.batch, args.force)